@@ -79,25 +79,72 @@ class DigitCapsLayer(nn.Module):
 
     def forward(self, x):
         batch_size, num_maps, num_in_caps, _ = x.size()          # [bs, 32, 36, 8]
-        u = x[:, :, :, None, :, None]
-        # [bs, 32, 36, 10, 8, 1]
-        u_hat = torch.matmul(self.W, u)
-        # [10, 32, 36, 10, 16, 1]
+        # votes laid out as [bs, 10, 32, 36, 16] so that the routing sums are
+        # batched matmuls over contiguous memory, W is never expanded to the batch
+        if self.W.size(2) == 1:
+            u_hat = torch.einsum('bmni,mdoi->bdmno', x, self.W[0, :, 0])
+        else:
+            u_hat = torch.einsum('bmni,mndoi->bdmno', x, self.W[0])
+        u_hat = u_hat.contiguous()
+        # [bs, 10, 32, 36, 16]
 
         if options.add_coord:
-            u_hat = coord_addition(u_hat, norm_coord=options.norm_coord)   # [10, 32, 36, 10, 16, 1]
+            u_hat = coord_addition(u_hat.permute(0, 2, 3, 1, 4)[..., None], norm_coord=options.norm_coord)
+            u_hat = u_hat[..., 0].permute(0, 3, 1, 2, 4).contiguous()   # [bs, 10, 32, 36, 16]
 
-        b = torch.zeros(batch_size, num_maps, num_in_caps, self.num_digit_cap, 1, 1).cuda()
-        # [bs, 32, 36, 10, 1, 1]
+        b = x.new_zeros(batch_size, num_maps, num_in_caps, self.num_digit_cap)
+        # [bs, 32, 36, 10]
         for i in range(self.num_iterations):
 
             # c = F.softmax(b, dim=2)  # original is dim=3
             #
-            c = F.softmax(b.view(batch_size, num_maps, num_in_caps*self.num_digit_cap, 1, 1), dim=2)  # original is dim=3
+            c = F.softmax(b.view(batch_size, num_maps, num_in_caps*self.num_digit_cap), dim=2)  # original is dim=3
+            c = c.view(batch_size, num_maps, num_in_caps, self.num_digit_cap).permute(0, 3, 1, 2)
+            # [bs, 10, 32, 36]
+
+            # sum over the capsules of every map of the weighted votes c * u_hat,
+            # which are never materialized
+            c_u_hat_maps = torch.matmul(c[:, :, :, None, :], u_hat)
+            # [bs, 10, 32, 1, 16]
+            s = c_u_hat_maps.sum(dim=2)
+            # [bs, 10, 1, 16]
+            outputs = squash(s, dim=-1)
+
+            if i != self.num_iterations - 1:
+                # agreement of every vote with the outputs, broadcast instead of tiled
+                u_produce_v = torch.matmul(u_hat.view(batch_size, self.num_digit_cap, -1, self.out_cap_dim),
+                                           outputs.transpose(-1, -2))
+                # [bs, 10, 32 * 36, 1]
+                b = b + u_produce_v.view(batch_size, self.num_digit_cap, num_maps, num_in_caps).permute(0, 2, 3, 1)
+
+        map_size = int(np.sqrt(num_in_caps))
+
+        # ||c * u_hat|| = c * ||u_hat|| since c >= 0
+        c_maps = c * (u_hat ** 2).sum(dim=-1) ** 0.5
+        c_maps = c_maps.permute(0, 2, 3, 1).reshape(batch_size, num_maps, map_size, map_size, self.num_digit_cap)
+        # [bs, 32, 6, 6, 10]
+        # c_maps = c.reshape(batch_size, num_maps, map_size, map_size, self.num_digit_cap)
+        # (batch_size, 32, 6, 6, 10)
+
+        features = (c_u_hat_maps[:, :, :, 0] / num_in_caps).transpose(1, 2)  # [bs, 32, 10, 16]
+
+        return outputs[:, :, 0], c_maps, features
+
+    def _forward_reference(self, x):
+        # Tiled routing that forward replaced, kept for benchmark_digit_caps_routing
+        batch_size, num_maps, num_in_caps, _ = x.size()
+        u = x[:, :, :, None, :, None]
+        u_hat = torch.matmul(self.W, u)
+
+        if options.add_coord:
+            u_hat = coord_addition(u_hat, norm_coord=options.norm_coord)
+
+        b = torch.zeros(batch_size, num_maps, num_in_caps, self.num_digit_cap, 1, 1, device=x.device)
+        for i in range(self.num_iterations):
+            c = F.softmax(b.view(batch_size, num_maps, num_in_caps*self.num_digit_cap, 1, 1), dim=2)
             c = c.view(batch_size, num_maps, num_in_caps, self.num_digit_cap, 1, 1)
 
             s = (c * u_hat).sum(dim=1, keepdim=True).sum(dim=2, keepdim=True)
-            # [10, 1, 1, 10, 16, 1]
             outputs = squash(s, dim=-2)
 
             if i != self.num_iterations - 1:
@@ -108,16 +155,71 @@ class DigitCapsLayer(nn.Module):
         map_size = int(np.sqrt(num_in_caps))
 
         x = (c * u_hat).view(batch_size, num_maps, map_size, map_size, self.num_digit_cap, self.out_cap_dim)
-        # [bs, 32, 6, 6, 10, 16]
         c_maps = (x ** 2).sum(dim=-1) ** 0.5
-        # c_maps = c.reshape(batch_size, num_maps, map_size, map_size, self.num_digit_cap)
-        # (batch_size, 32, 6, 6, 10)
 
-        features = (c * u_hat).mean(dim=2).squeeze(-1)  # [bs, 32, 10, 16]
+        features = (c * u_hat).mean(dim=2).squeeze(-1)
 
         return outputs.squeeze(2).squeeze(1).squeeze(-1), c_maps, features
 
 
+def benchmark_digit_caps_routing(batch_size=4, num_prim_map=4, map_size=20, in_cap_dim=64,
+                                 num_digit_cap=2, out_cap_dim=16, repeats=5):
+    ''' Latency and activation memory (bytes of the tensors saved for the
+    backward pass, plus the CUDA peak when running on GPU) of the routing of
+    DigitCapsLayer, against the tiled version, for several num_iterations and
+    share_weight settings. Run: python decaps.py '''
+    import time
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    share_weight = options.share_weight
+
+    def run(forward, x):
+        saved = dict()
+
+        def pack(tensor):
+            saved[tensor.untyped_storage().data_ptr()] = tensor.untyped_storage().nbytes()
+            return tensor
+
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        since = time.time()
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+            outputs, c_maps, features = forward(x)
+        (outputs.sum() + c_maps.sum() + features.sum()).backward()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        elapsed = time.time() - since
+        peak = torch.cuda.max_memory_allocated() if device.type == 'cuda' else 0
+        return (outputs, c_maps, features), elapsed, sum(saved.values()), peak
+
+    try:
+        for options.share_weight in [True, False]:
+            for num_iterations in [1, 3, 5]:
+                torch.manual_seed(0)
+                layer = DigitCapsLayer(num_digit_cap, map_size ** 2, num_prim_map, in_cap_dim,
+                                       out_cap_dim, num_iterations, use_simnet=False).to(device)
+                x = squash(torch.randn(batch_size, num_prim_map, map_size ** 2, in_cap_dim, device=device))
+
+                results = dict()
+                for name, forward in [('tiled', layer._forward_reference), ('broadcast', layer.forward)]:
+                    elapsed = []
+                    for _ in range(repeats):
+                        outs, seconds, saved_bytes, peak = run(forward, x)
+                        elapsed.append(seconds)
+                    results[name] = (outs, np.median(elapsed), saved_bytes, peak)
+
+                max_diff = max((new - old).abs().max().item() for new, old in
+                               zip(results['broadcast'][0], results['tiled'][0]))
+                print(f'share_weight={options.share_weight} num_iterations={num_iterations}: ' +
+                      ', '.join(f'{name} {seconds * 1e3:.1f} ms, saved {saved_bytes / 1024 ** 2:.1f} MB' +
+                                (f', peak {peak / 1024 ** 2:.1f} MB' if device.type == 'cuda' else '')
+                                for name, (_, seconds, saved_bytes, peak) in results.items()) +
+                      f' (max abs diff {max_diff:.1e})')
+    finally:
+        options.share_weight = share_weight
+
+
 class CapsuleNet(nn.Module):
     def __init__(self, args):
         super(CapsuleNet, self).__init__()
@@ -218,3 +320,7 @@ class CapsuleNet(nn.Module):
         attention_map = attention_map.view(batch_size, 1, H, W)  # (B, 1, H, W)
 
         return y_pred_ohe, img_reconst, v_length, attention_map, feats, attention_maps, x
+
+
+if __name__ == '__main__':
+    benchmark_digit_caps_routing()
@@ -10,6 +10,7 @@ from configs import options
 import torch
 import torch.nn.functional as F
 from utils.eval_utils import binary_cls_compute_metrics
+from utils.other_utils import attention_crop_boxes, crop_and_resize
 import torch.nn as nn
 from torchvision import transforms
 from features_classification import custom_transforms
@@ -49,26 +50,11 @@ def evaluate():
             ##################################
             # Object Localization and Refinement
             ##################################
-            bbox_coords = []
             upsampled_attention_map = F.upsample_bilinear(attention_map, size=(data.size(2), data.size(3)))
             crop_mask = upsampled_attention_map > theta_c
-            crop_images = []
-            for batch_index in range(crop_mask.size(0)):
-                nonzero_indices = torch.nonzero(crop_mask[batch_index, 0, ...])
-
-                height_min = nonzero_indices[:, 0].min()
-                height_max = nonzero_indices[:, 0].max()
-                width_min = nonzero_indices[:, 1].min()
-                width_max = nonzero_indices[:, 1].max()
-
-                bbox_coord = np.array([height_min, height_max, width_min, width_max])
-                bbox_coords.append(bbox_coord)
-
-                crop_images.append(F.upsample_bilinear(
-                    data[batch_index:batch_index + 1, :, height_min:height_max, width_min:width_max],
-                    size=options.img_h))
-
-            crop_images = torch.cat(crop_images, dim=0)
+            # (height_min, height_max, width_min, width_max) of every sample
+            bbox_coords = attention_crop_boxes(crop_mask)
+            crop_images = crop_and_resize(data, bbox_coords, size=options.img_h)
 
             y_pred_crop, _, output_crop, _, _, c_maps_crop, out_vec_crop = capsule_net(crop_images, target_ohe)
             loss = capsule_loss(output_crop, target)
@@ -11,6 +11,7 @@ from configs import options
 import torch
 import torch.nn.functional as F
 from utils.eval_utils import compute_accuracy, binary_cls_compute_metrics
+from utils.other_utils import attention_crop_boxes, crop_and_resize
 from utils.logger_utils import Logger
 import torch.nn as nn
 from torchvision import transforms
@@ -86,50 +87,10 @@ def train():
             ##################################
             # Attention Cropping
             ##################################
-            empty_map_count = 0
-            one_nonzero_count = 0
-            width_count = 0
-            height_count = 0
             with torch.no_grad():
                 crop_mask = F.upsample_bilinear(attention_map, size=(data.size(2), data.size(3))) > theta_c
-                crop_images = []
-                for batch_index in range(crop_mask.size(0)):
-                    if torch.sum(crop_mask[batch_index]) == 0:
-                        height_min, width_min = 0, 0
-                        height_max, width_max = 200, 200
-                        # print('0, batch: {}, map: {}'.format(batch_index, map_index))
-                        empty_map_count += 1
-                    else:
-                        nonzero_indices = torch.nonzero(crop_mask[batch_index, 0, ...])
-                        if nonzero_indices.size(0) == 1:
-                            height_min, width_min = 0, 0
-                            height_max, width_max = 200, 200
-                            # print('1, batch: {}, map: {}'.format(batch_index, map_index))
-                            one_nonzero_count += 1
-                        else:
-                            height_min = nonzero_indices[:, 0].min()
-                            height_max = nonzero_indices[:, 0].max()
-                            width_min = nonzero_indices[:, 1].min()
-                            width_max = nonzero_indices[:, 1].max()
-                        if width_min == width_max:
-                            if width_min == 0:
-                                width_max += 1
-                            else:
-                                width_min -= 1
-                            width_count += 1
-                        if height_min == height_max:
-                            if height_min == 0:
-                                height_max += 1
-                            else:
-                                height_min -= 1
-                            height_count += 1
-                    crop_images.append(F.upsample_bilinear(
-                        data[batch_index:batch_index + 1, :, height_min:height_max, width_min:width_max],
-                        size=options.img_h))
-                # print('Batch {} :  empty map: {},  one nonzero idx: {}, width_issue: {}, height_issue: {}'
-                #       .format(i, empty_map_count, one_nonzero_count, width_count, height_count))
-
-            crop_images = torch.cat(crop_images, dim=0).cuda()
+                # boxes of the whole batch on the device, one resampling call for all crops
+                crop_images = crop_and_resize(data, attention_crop_boxes(crop_mask), size=options.img_h)
 
             # crop images forward
             y_pred_crop, _, output_crop, _, _, _, _ = capsule_net(crop_images, target_ohe)
@@ -233,10 +194,6 @@ def evaluate(**kwargs):
     test_loss = np.zeros(3)
     targets, predictions_raw, predictions_crop, predictions_combined = [], [], [], []
     outputs_raw, outputs_crop, outputs_combined = [], [], []
-    empty_map_count = 0
-    one_nonzero_count = 0
-    width_count = 0
-    height_count = 0
 
     with torch.no_grad():
         for batch_id, (data, target) in enumerate(test_loader):
@@ -253,41 +210,7 @@ def evaluate(**kwargs):
             # Object Localization and Refinement
             ##################################
             crop_mask = F.upsample_bilinear(attention_map, size=(data.size(2), data.size(3))) > theta_c
-            crop_images = []
-            for batch_index in range(crop_mask.size(0)):
-                if torch.sum(crop_mask[batch_index]) == 0:
-                    height_min, width_min = 0, 0
-                    height_max, width_max = 200, 200
-                    # print('0, batch: {}, map: {}'.format(batch_index, map_index))
-                    empty_map_count += 1
-                else:
-                    nonzero_indices = torch.nonzero(crop_mask[batch_index, 0, ...])
-                    if nonzero_indices.size(0) == 1:
-                        height_min, width_min = 0, 0
-                        height_max, width_max = 200, 200
-                        # print('1, batch: {}, map: {}'.format(batch_index, map_index))
-                        one_nonzero_count += 1
-                    else:
-                        height_min = nonzero_indices[:, 0].min()
-                        height_max = nonzero_indices[:, 0].max()
-                        width_min = nonzero_indices[:, 1].min()
-                        width_max = nonzero_indices[:, 1].max()
-                    if width_min == width_max:
-                        if width_min == 0:
-                            width_max += 1
-                        else:
-                            width_min -= 1
-                        width_count += 1
-                    if height_min == height_max:
-                        if height_min == 0:
-                            height_max += 1
-                        else:
-                            height_min -= 1
-                        height_count += 1
-                crop_images.append(F.upsample_bilinear(
-                    data[batch_index:batch_index + 1, :, height_min:height_max, width_min:width_max],
-                    size=options.img_h))
-            crop_images = torch.cat(crop_images, dim=0)
+            crop_images = crop_and_resize(data, attention_crop_boxes(crop_mask), size=options.img_h)
 
             y_pred_crop, _, output_crop, c_maps, _, _, out_vec_crop = capsule_net(crop_images, target_ohe)
             loss = capsule_loss(output_crop, target)
@@ -1,4 +1,5 @@
 import torch
+import torch.nn.functional as F
 import numpy as np
 
 
@@ -55,7 +56,69 @@ def coord_addition(input_tensor, norm_coord=False):
     coords = np.stack([h_offset_vals] + [w_offset_vals], axis=-1)   # [H, W, 2]
     zeros = np.zeros((H, W, caps_dim-2))
     coords = torch.tensor(np.reshape(np.concatenate((zeros, coords), axis=-1), (H*W, caps_dim)))  # [H*W, caps_dim]
-    coords = coords[None, None, :, None, :, None].repeat(batch_size, num_maps, 1, num_cls, 1, 1).float().cuda()
+    # broadcast over the batch, the maps and the classes, on the device of the input
+    coords = coords[None, None, :, None, :, None].to(input_tensor)
 
     out_tensor = input_tensor + coords
     return out_tensor
+
+
+def attention_crop_boxes(crop_mask, fallback_size=200):
+    """
+    bounding boxes of the attention masks of a whole batch, computed on the device
+    :param crop_mask: bool tensor of shape [batch_size, 1, H, W]
+    :return: long tensor of shape [batch_size, 4], (height_min, height_max, width_min, width_max),
+             the max bounds being exclusive when the boxes are used as slices.
+             Empty and one-pixel masks fall back to [0, fallback_size) x [0, fallback_size),
+             boxes with height_min == height_max (or width_min == width_max) are widened by one pixel
+    """
+    batch_size, _, H, W = crop_mask.size()
+    crop_mask = crop_mask.view(batch_size, H, W)
+    rows = crop_mask.any(dim=2)  # [batch_size, H]
+    cols = crop_mask.any(dim=1)  # [batch_size, W]
+    h_indices = torch.arange(H, device=crop_mask.device)
+    w_indices = torch.arange(W, device=crop_mask.device)
+
+    height_min = torch.where(rows, h_indices, H).amin(dim=1)
+    height_max = torch.where(rows, h_indices, -1).amax(dim=1)
+    width_min = torch.where(cols, w_indices, W).amin(dim=1)
+    width_max = torch.where(cols, w_indices, -1).amax(dim=1)
+
+    for bound_min, bound_max in [(height_min, height_max), (width_min, width_max)]:
+        degenerate = bound_min == bound_max
+        bound_max += (degenerate & (bound_min == 0)).long()
+        bound_min -= (degenerate & (bound_min != 0)).long()
+
+    boxes = torch.stack([height_min, height_max, width_min, width_max], dim=1)
+    fallback = crop_mask.flatten(1).sum(dim=1) <= 1
+    fallback_box = boxes.new_tensor([0, fallback_size, 0, fallback_size])
+    return torch.where(fallback[:, None], fallback_box, boxes)
+
+
+def crop_and_resize(images, boxes, size):
+    """
+    F.upsample_bilinear(images[i:i+1, :, h_min:h_max, w_min:w_max], size=size) for every
+    box of the batch, in a single grid_sample call
+    :param images: tensor of shape [batch_size, C, H, W]
+    :param boxes: long tensor of shape [batch_size, 4], as returned by attention_crop_boxes
+    :return: tensor of shape [batch_size, C, size, size]
+    """
+    batch_size, _, H, W = images.size()
+    boxes = boxes.to(images.device)
+    height_min, height_max, width_min, width_max = boxes.unbind(dim=1)
+    # slices stop at the border of the image
+    height_max = height_max.clamp(max=H)
+    width_max = width_max.clamp(max=W)
+
+    # align_corners sampling positions of upsample_bilinear, in pixels of the whole image
+    steps = torch.linspace(0, 1, size, device=images.device, dtype=images.dtype)
+    ys = height_min[:, None] + steps[None] * (height_max - height_min - 1)[:, None]
+    xs = width_min[:, None] + steps[None] * (width_max - width_min - 1)[:, None]
+
+    # to the [-1, 1] coordinates of grid_sample
+    ys = ys * 2 / max(H - 1, 1) - 1
+    xs = xs * 2 / max(W - 1, 1) - 1
+    grid = torch.stack([xs[:, None, :].expand(batch_size, size, size),
+                        ys[:, :, None].expand(batch_size, size, size)], dim=-1)
+
+    return F.grid_sample(images, grid, mode='bilinear', padding_mode='border', align_corners=True)
@@ -83,16 +83,13 @@ class Classifier(caffe.Net):
             input_ = input_[:, crop[0]:crop[2], crop[1]:crop[3], :]
 
         # Classify
-        caffe_in = np.zeros(np.array(input_.shape)[[0, 3, 1, 2]],
-                            dtype=np.float32)
-        for ix, in_ in enumerate(input_):
-            caffe_in[ix] = self.transformer.preprocess(self.inputs[0], in_)
+        caffe_in = self.transformer.preprocess_batch(self.inputs[0], input_)
         out = self.forward_all(**{self.inputs[0]: caffe_in})
         predictions = out[self.outputs[0]]
 
         # For oversampling, average predictions across crops.
         if oversample:
-            predictions = predictions.reshape((len(predictions) / 10, 10, -1))
+            predictions = predictions.reshape((len(predictions) // 10, 10, -1))
             predictions = predictions.mean(1)
 
         return predictions
@@ -15,6 +15,8 @@ proposal mode is available at
 """
 import numpy as np
 import os
+import collections
+from concurrent.futures import ThreadPoolExecutor
 
 import caffe
 
@@ -53,7 +55,8 @@ class Detector(caffe.Net):
 
         self.configure_crop(context_pad)
 
-    def detect_windows(self, images_windows):
+    def detect_windows(self, images_windows, batch_size=256, num_workers=4,
+                       max_pending_images=8):
         """
         Do windowed detection over given images and windows. Windows are
         extracted then warped to the input dimensions of the net.
@@ -61,42 +64,101 @@ class Detector(caffe.Net):
         Parameters
         ----------
         images_windows: (image filename, window list) iterable.
-        context_crop: size of context border to crop in pixels.
+        batch_size, num_workers, max_pending_images: see
+            detect_windows_iter().
 
         Returns
         -------
         detections: list of {filename: image filename, window: crop coordinates,
             predictions: prediction vector} dicts.
         """
-        # Extract windows.
-        window_inputs = []
-        for image_fname, windows in images_windows:
-            image = caffe.io.load_image(image_fname).astype(np.float32)
-            for window in windows:
-                window_inputs.append(self.crop(image, window))
+        return list(self.detect_windows_iter(
+            images_windows, batch_size=batch_size, num_workers=num_workers,
+            max_pending_images=max_pending_images))
 
-        # Run through the net (warping windows to input dimensions).
+    def detect_windows_iter(self, images_windows, batch_size=256,
+                            num_workers=4, max_pending_images=8):
+        """
+        Do windowed detection over given images and windows, yielding the
+        detections as soon as their batch has been through the net. The
+        images are loaded and their windows cropped on a pool of
+        num_workers threads, at most max_pending_images images ahead, so
+        that only those crops and one batch of batch_size windows are held
+        in memory whatever the number of images and windows.
+
+        Parameters
+        ----------
+        images_windows: (image filename, window list) iterable.
+        batch_size: number of windows run through the net at once.
+        num_workers: number of threads loading and cropping the images.
+        max_pending_images: number of images loaded and cropped ahead.
+
+        Yields
+        ------
+        detection: {filename: image filename, window: crop coordinates,
+            predictions: prediction vector} dict, in the order of the input
+            images and windows.
+        """
         in_ = self.inputs[0]
-        caffe_in = np.zeros((len(window_inputs), window_inputs[0].shape[2])
-                            + self.blobs[in_].data.shape[2:],
-                            dtype=np.float32)
-        for ix, window_in in enumerate(window_inputs):
-            caffe_in[ix] = self.transformer.preprocess(in_, window_in)
-        out = self.forward_all(**{in_: caffe_in})
-        predictions = out[self.outputs[0]]
-
-        # Package predictions with images and windows.
-        detections = []
-        ix = 0
-        for image_fname, windows in images_windows:
-            for window in windows:
-                detections.append({
+        for window_inputs, window_infos in self.window_batches(
+                images_windows, batch_size, num_workers, max_pending_images):
+            # Run through the net (warping windows to input dimensions).
+            caffe_in = self.transformer.preprocess_batch(in_, window_inputs)
+            out = self.forward_all(**{in_: caffe_in})
+            predictions = out[self.outputs[0]]
+
+            # Package predictions with images and windows.
+            for (image_fname, window), prediction in zip(window_infos, predictions):
+                yield {
                     'window': window,
-                    'prediction': predictions[ix],
+                    'prediction': prediction,
                     'filename': image_fname
-                })
-                ix += 1
-        return detections
+                }
+
+    def window_batches(self, images_windows, batch_size=256, num_workers=4,
+                       max_pending_images=8):
+        """
+        Load the images and crop their windows on a pool of threads, and
+        group the crops in batches of batch_size windows (the last one may be
+        smaller).
+
+        Yields
+        ------
+        (window_inputs, window_infos): list of crops and the list of their
+            (image filename, window).
+        """
+        pool = ThreadPoolExecutor(max_workers=num_workers)
+        pending = collections.deque()
+        images_windows = iter(images_windows)
+        window_inputs, window_infos = [], []
+        try:
+            while True:
+                # bounded queue of the images being loaded and cropped
+                for image_fname, windows in images_windows:
+                    pending.append((image_fname, windows, pool.submit(
+                        self._load_windows, image_fname, windows)))
+                    if len(pending) >= max_pending_images:
+                        break
+                if not pending:
+                    break
+
+                image_fname, windows, crops = pending.popleft()
+                for window, crop in zip(windows, crops.result()):
+                    window_inputs.append(crop)
+                    window_infos.append((image_fname, window))
+                    if len(window_inputs) == batch_size:
+                        yield window_inputs, window_infos
+                        window_inputs, window_infos = [], []
+            if window_inputs:
+                yield window_inputs, window_infos
+        finally:
+            for _, _, crops in pending:
+                crops.cancel()
+            pool.shutdown(wait=True)
+
+    def _load_windows(self, image_fname, windows):
+        image = caffe.io.load_image(image_fname).astype(np.float32)
+        return self.crop_windows(image, windows)
 
     def detect_selective_search(self, image_fnames):
         """
@@ -136,47 +198,77 @@ class Detector(caffe.Net):
         -------
         crop: cropped window.
         """
-        # Crop window from the image.
-        crop = im[window[0]:window[2], window[1]:window[3]]
+        return self.crop_windows(im, [window])[0]
 
-        if self.context_pad:
-            box = window.copy()
-            crop_size = self.blobs[self.inputs[0]].width  # assumes square
-            scale = crop_size / (1. * crop_size - self.context_pad * 2)
-            # Crop a box + surrounding context.
-            half_h = (box[2] - box[0] + 1) / 2.
-            half_w = (box[3] - box[1] + 1) / 2.
-            center = (box[0] + half_h, box[1] + half_w)
-            scaled_dims = scale * np.array((-half_h, -half_w, half_h, half_w))
-            box = np.round(np.tile(center, 2) + scaled_dims)
-            full_h = box[2] - box[0] + 1
-            full_w = box[3] - box[1] + 1
-            scale_h = crop_size / full_h
-            scale_w = crop_size / full_w
-            pad_y = round(max(0, -box[0]) * scale_h)  # amount out-of-bounds
-            pad_x = round(max(0, -box[1]) * scale_w)
-
-            # Clip box to image dimensions.
-            im_h, im_w = im.shape[:2]
-            box = np.clip(box, 0., [im_h, im_w, im_h, im_w])
-            clip_h = box[2] - box[0] + 1
-            clip_w = box[3] - box[1] + 1
-            assert(clip_h > 0 and clip_w > 0)
-            crop_h = round(clip_h * scale_h)
-            crop_w = round(clip_w * scale_w)
-            if pad_y + crop_h > crop_size:
-                crop_h = crop_size - pad_y
-            if pad_x + crop_w > crop_size:
-                crop_w = crop_size - pad_x
+    def crop_windows(self, im, windows):
+        """
+        Crop windows from the image for detection; see crop(). The context
+        boxes and paddings of all the windows are computed at once.
 
+        Parameters
+        ----------
+        im: H x W x K image ndarray to crop.
+        windows: (N x 4) bounding box coordinates as ymin, xmin, ymax, xmax.
+
+        Returns
+        -------
+        crops: list of the N cropped windows.
+        """
+        windows = np.asarray(windows).reshape(-1, 4)
+        if not self.context_pad:
+            # Crop window from the image.
+            return [im[window[0]:window[2], window[1]:window[3]]
+                    for window in windows]
+
+        boxes, pads, crop_hws = self.context_boxes(windows, im.shape[:2])
+
+        crops = []
+        for box, (pad_y, pad_x), (crop_h, crop_w) in zip(boxes, pads, crop_hws):
             # collect with context padding and place in input
             # with mean padding
             context_crop = im[box[0]:box[2], box[1]:box[3]]
             context_crop = caffe.io.resize_image(context_crop, (crop_h, crop_w))
             crop = np.ones(self.crop_dims, dtype=np.float32) * self.crop_mean
             crop[pad_y:(pad_y + crop_h), pad_x:(pad_x + crop_w)] = context_crop
+            crops.append(crop)
+        return crops
+
+    def context_boxes(self, windows, im_shape):
+        """
+        Boxes of the windows with their surrounding context, clipped to the
+        image, and where to place them in the network input.
+
+        Parameters
+        ----------
+        windows: (N x 4) bounding box coordinates as ymin, xmin, ymax, xmax.
+        im_shape: (height, width) of the image.
+
+        Returns
+        -------
+        boxes: (N x 4) int context boxes clipped to the image.
+        pads: (N x 2) int amounts of the boxes out of bounds (y, x).
+        crop_hws: (N x 2) int sizes of the boxes in the network input.
+        """
+        windows = np.asarray(windows, dtype=float).reshape(-1, 4)
+        crop_size = self.blobs[self.inputs[0]].width  # assumes square
+        scale = crop_size / (1. * crop_size - self.context_pad * 2)
+        # Crop a box + surrounding context.
+        half_hw = (windows[:, 2:] - windows[:, :2] + 1) / 2.
+        center = windows[:, :2] + half_hw
+        scaled_dims = scale * np.hstack((-half_hw, half_hw))
+        boxes = np.round(np.tile(center, 2) + scaled_dims)
+        full_hw = boxes[:, 2:] - boxes[:, :2] + 1
+        scale_hw = crop_size / full_hw
+        pads = np.round(np.maximum(0, -boxes[:, :2]) * scale_hw)  # amount out-of-bounds
+
+        # Clip box to image dimensions.
+        im_h, im_w = im_shape
+        boxes = np.clip(boxes, 0., [im_h, im_w, im_h, im_w])
+        clip_hw = boxes[:, 2:] - boxes[:, :2] + 1
+        assert(np.all(clip_hw > 0))
+        crop_hws = np.minimum(np.round(clip_hw * scale_hw), crop_size - pads)
 
-        return crop
+        return boxes.astype(int), pads.astype(int), crop_hws.astype(int)
 
     def configure_crop(self, context_pad):
         """
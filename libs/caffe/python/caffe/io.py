@@ -184,6 +184,91 @@ class Transformer:
             decaf_in = decaf_in.transpose(np.argsort(transpose))
         return decaf_in
 
+    def preprocess_batch(self, in_, data, block_size=2 ** 16):
+        """
+        Format a batch of inputs for Caffe; see preprocess(). Same results as
+        preprocess() image by image, but the images are formatted by blocks of
+        about block_size values (kept small enough to stay in cache), every
+        step being applied to a whole block at once. The images which are not
+        at the input dimensions are resized one by one beforehand.
+
+        Parameters
+        ----------
+        in_ : name of input blob to preprocess for
+        data : (N x H' x W' x K) ndarray or list of (H' x W' x K) ndarrays
+        block_size : number of values formatted at once
+
+        Returns
+        -------
+        caffe_in : (N x K x H x W) ndarray for input to a Net
+        """
+        self.__check_input(in_)
+        transpose = self.transpose.get(in_)
+        channel_swap = self.channel_swap.get(in_)
+        raw_scale = self.raw_scale.get(in_)
+        mean = self.mean.get(in_)
+        input_scale = self.input_scale.get(in_)
+        in_dims = self.inputs[in_][2:]
+        if not (isinstance(data, np.ndarray) and data.shape[1:3] == in_dims):
+            batch = np.empty((len(data),) + tuple(in_dims) + (data[0].shape[-1],),
+                             dtype=np.float32)
+            for ix, im in enumerate(data):
+                im = im.astype(np.float32, copy=False)
+                if im.shape[:2] != in_dims:
+                    im = resize_image(im, in_dims)
+                batch[ix] = im
+            data = batch
+        if transpose is not None:
+            data = data.transpose((0,) + tuple(t + 1 for t in transpose))
+        if channel_swap is None:
+            channel_swap = range(data.shape[1])
+        caffe_in = np.empty(data.shape, dtype=np.float32)
+        step = max(1, block_size // max(1, data[0].size))
+        for start in range(0, len(data), step):
+            block = caffe_in[start:start + step]
+            for ix, channel in enumerate(channel_swap):
+                block[:, ix] = data[start:start + step, channel]
+            if raw_scale is not None:
+                block *= raw_scale
+            if mean is not None:
+                block -= mean
+            if input_scale is not None:
+                block *= input_scale
+        return caffe_in
+
+    def deprocess_batch(self, in_, data):
+        """
+        Invert Caffe formatting of a batch; see preprocess_batch().
+
+        Parameters
+        ----------
+        in_ : name of input blob
+        data : (N x K x H x W) ndarray
+
+        Returns
+        -------
+        decaf_in : (N x H x W x K) ndarray
+        """
+        self.__check_input(in_)
+        decaf_in = data.copy()
+        transpose = self.transpose.get(in_)
+        channel_swap = self.channel_swap.get(in_)
+        raw_scale = self.raw_scale.get(in_)
+        mean = self.mean.get(in_)
+        input_scale = self.input_scale.get(in_)
+        if input_scale is not None:
+            decaf_in /= input_scale
+        if mean is not None:
+            decaf_in += mean
+        if raw_scale is not None:
+            decaf_in /= raw_scale
+        if channel_swap is not None:
+            decaf_in = decaf_in[:, np.argsort(channel_swap)]
+        if transpose is not None:
+            decaf_in = decaf_in.transpose(
+                (0,) + tuple(t + 1 for t in np.argsort(transpose)))
+        return decaf_in
+
     def set_transpose(self, in_, order):
         """
         Set the input channel order for e.g. RGB to BGR conversion
@@ -338,7 +423,7 @@ def resize_image(im, new_dims, interp_order=1):
     return resized_im.astype(np.float32)
 
 
-def oversample(images, crop_dims):
+def oversample(images, crop_dims, view=False):
     """
     Crop images into the four corners, center, and their mirrored versions.
 
@@ -346,19 +431,69 @@ def oversample(images, crop_dims):
     ----------
     image : iterable of (H x W x K) ndarrays
     crop_dims : (height, width) tuple for the crops.
+    view : return the crops as views of the images instead of copying them.
 
     Returns
     -------
-    crops : (10*N x H x W x K) ndarray of crops for number of inputs N.
+    crops : (10*N x H x W x K) ndarray of crops for number of inputs N,
+        or with view, list of the 10 (N x H x W x K) views of the images
+        for each crop in the same order.
+    """
+    images = np.asarray(images)
+    crops_ix = oversample_boxes(images.shape[1:3], crop_dims)
+
+    # Mirrors are the same boxes with the columns reversed.
+    views = [images[:, crop[0]:crop[2], crop[1]:crop[3], :] for crop in crops_ix]
+    views += [crop[:, :, ::-1, :] for crop in views]
+    if view:
+        return views
+
+    # Extract crops
+    crops = np.empty((len(images), 10) + views[0].shape[1:], dtype=np.float32)
+    for ix, crop in enumerate(views):
+        crops[:, ix] = crop
+    return crops.reshape((-1,) + crops.shape[2:])
+
+
+def oversample_iter(images, crop_dims):
+    """
+    Crop images one at a time into the four corners, center, and their
+    mirrored versions; see oversample().
+
+    Parameters
+    ----------
+    image : iterable of (H x W x K) ndarrays
+    crop_dims : (height, width) tuple for the crops.
+
+    Yields
+    ------
+    crops : (10 x H x W x K) ndarray of crops for each input.
+    """
+    for im in images:
+        yield oversample(im[np.newaxis], crop_dims)
+
+
+def oversample_boxes(im_dims, crop_dims):
+    """
+    Boxes of the four corners and center crops.
+
+    Parameters
+    ----------
+    im_dims : (height, width) tuple of the images.
+    crop_dims : (height, width) tuple for the crops.
+
+    Returns
+    -------
+    crops_ix : (5 x 4) int ndarray of ymin, xmin, ymax, xmax.
     """
     # Dimensions and center.
-    im_shape = np.array(images[0].shape)
+    im_dims = np.array(im_dims)
     crop_dims = np.array(crop_dims)
-    im_center = im_shape[:2] / 2.0
+    im_center = im_dims / 2.0
 
     # Make crop coordinates
-    h_indices = (0, im_shape[0] - crop_dims[0])
-    w_indices = (0, im_shape[1] - crop_dims[1])
+    h_indices = (0, im_dims[0] - crop_dims[0])
+    w_indices = (0, im_dims[1] - crop_dims[1])
     crops_ix = np.empty((5, 4), dtype=int)
     curr = 0
     for i in h_indices:
@@ -369,15 +504,78 @@ def oversample(images, crop_dims):
         -crop_dims / 2.0,
          crop_dims / 2.0
     ])
-    crops_ix = np.tile(crops_ix, (2, 1))
+    return crops_ix
 
-    # Extract crops
-    crops = np.empty((10 * len(images), crop_dims[0], crop_dims[1],
-                      im_shape[-1]), dtype=np.float32)
-    ix = 0
-    for im in images:
-        for crop in crops_ix:
-            crops[ix] = im[crop[0]:crop[2], crop[1]:crop[3], :]
-            ix += 1
-        crops[ix-5:ix] = crops[ix-5:ix, :, ::-1, :]  # flip for mirrors
-    return crops
+
+def benchmark_preprocess_batch(batches=((256, (227, 227)), (4096, (32, 32))), channels=3):
+    """
+    Transformer.preprocess image by image vs preprocess_batch, with the
+    ImageNet-style settings of Classifier (transpose, channel swap, raw scale,
+    mean). Pure NumPy: runs without the compiled _caffe module, e.g.
+    python python/caffe/io.py
+    """
+    import time
+
+    in_ = 'data'
+    for num_images, dims in batches:
+        transformer = Transformer({in_: (num_images, channels) + tuple(dims)})
+        transformer.set_transpose(in_, (2, 0, 1))
+        transformer.set_channel_swap(in_, tuple(range(channels))[::-1])
+        transformer.set_raw_scale(in_, 255)
+        transformer.set_mean(in_, np.linspace(100, 120, channels))
+        transformer.set_input_scale(in_, 0.5)
+
+        images = np.random.RandomState(0).rand(
+            num_images, dims[0], dims[1], channels).astype(np.float32)
+
+        since = time.time()
+        caffe_in = np.zeros((num_images, channels) + tuple(dims), dtype=np.float32)
+        for ix, im in enumerate(images):
+            caffe_in[ix] = transformer.preprocess(in_, im)
+        loop_time = time.time() - since
+
+        since = time.time()
+        batch_in = transformer.preprocess_batch(in_, images)
+        batch_time = time.time() - since
+
+        assert np.array_equal(caffe_in, batch_in)
+        assert np.allclose(transformer.deprocess_batch(in_, batch_in), images, atol=1e-5)
+        print('{} images {}x{}: preprocess {:.0f} images/sec, '
+              'preprocess_batch {:.0f} images/sec'.format(
+                  num_images, dims[0], dims[1],
+                  num_images / loop_time, num_images / batch_time))
+
+
+def benchmark_oversample(num_images=128, image_dims=(256, 256), crop_dims=(227, 227),
+                         channels=3):
+    """
+    oversample copying the 10*N crops vs as views vs image by image with
+    oversample_iter. Pure NumPy, see benchmark_preprocess_batch().
+    """
+    import time
+
+    images = np.random.RandomState(0).rand(
+        num_images, image_dims[0], image_dims[1], channels).astype(np.float32)
+
+    since = time.time()
+    crops = oversample(images, crop_dims)
+    copy_time = time.time() - since
+
+    since = time.time()
+    views = oversample(images, crop_dims, view=True)
+    view_time = time.time() - since
+
+    since = time.time()
+    for ix, im_crops in enumerate(oversample_iter(images, crop_dims)):
+        assert np.array_equal(im_crops, crops[10 * ix:10 * (ix + 1)])
+    iter_time = time.time() - since
+
+    assert np.array_equal(np.stack(views, axis=1).reshape(crops.shape), crops)
+    print('oversample {} images: copy {:.3f}s ({:.0f} MB), views {:.5f}s, '
+          'oversample_iter {:.3f}s (checks included)'.format(
+              num_images, copy_time, crops.nbytes / 1024 ** 2, view_time, iter_time))
+
+
+if __name__ == '__main__':
+    benchmark_preprocess_batch()
+    benchmark_oversample()
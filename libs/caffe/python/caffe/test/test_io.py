@@ -54,3 +54,65 @@ class TestArrayToDatum(unittest.TestCase):
         self.assertGreater(
             len(d1.SerializeToString()),
             len(d2.SerializeToString()))
+
+
+class TestTransformerBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.transformer = caffe.io.Transformer({'data': (4, 3, 10, 12)})
+        self.transformer.set_transpose('data', (2, 0, 1))
+        self.transformer.set_channel_swap('data', (2, 1, 0))
+        self.transformer.set_raw_scale('data', 255)
+        self.transformer.set_mean('data', np.array([104., 117., 123.]))
+        self.transformer.set_input_scale('data', 0.5)
+
+    def test_preprocess_batch(self):
+        images = np.random.rand(5, 10, 12, 3).astype(np.float32)
+        expected = np.array([self.transformer.preprocess('data', im)
+                             for im in images.copy()])
+        caffe_in = self.transformer.preprocess_batch('data', images, block_size=1000)
+        self.assertEqual(caffe_in.shape, (5, 3, 10, 12))
+        self.assertTrue(np.array_equal(caffe_in, expected))
+
+    def test_preprocess_batch_resize(self):
+        images = [np.random.rand(10, 12, 3), np.random.rand(20, 7, 3)]
+        expected = np.array([self.transformer.preprocess('data', im)
+                             for im in images])
+        caffe_in = self.transformer.preprocess_batch('data', images)
+        self.assertTrue(np.array_equal(caffe_in, expected))
+
+    def test_deprocess_batch(self):
+        images = np.random.rand(3, 10, 12, 3).astype(np.float32)
+        caffe_in = self.transformer.preprocess_batch('data', images)
+        decaf_in = self.transformer.deprocess_batch('data', caffe_in)
+        self.assertEqual(decaf_in.shape, images.shape)
+        self.assertTrue(np.allclose(decaf_in, images, atol=1e-5))
+
+
+class TestOversample(unittest.TestCase):
+
+    def setUp(self):
+        self.images = np.random.rand(3, 12, 11, 3).astype(np.float32)
+        self.crop_dims = (8, 6)
+
+    def test_oversample(self):
+        crops = caffe.io.oversample(self.images, self.crop_dims)
+        self.assertEqual(crops.shape, (30, 8, 6, 3))
+        # upper left corner, center, and the mirror of the lower right corner
+        self.assertTrue(np.array_equal(crops[10], self.images[1, :8, :6]))
+        self.assertTrue(np.array_equal(crops[14], self.images[1, 2:10, 2:8]))
+        self.assertTrue(np.array_equal(crops[18], self.images[1, 4:, 5:][:, ::-1]))
+
+    def test_oversample_view(self):
+        crops = caffe.io.oversample(self.images, self.crop_dims)
+        views = caffe.io.oversample(self.images, self.crop_dims, view=True)
+        self.assertEqual(len(views), 10)
+        for view in views:
+            self.assertTrue(np.shares_memory(view, self.images))
+        self.assertTrue(np.array_equal(np.stack(views, axis=1).reshape(crops.shape), crops))
+
+    def test_oversample_iter(self):
+        crops = caffe.io.oversample(self.images, self.crop_dims)
+        im_crops = list(caffe.io.oversample_iter(self.images, self.crop_dims))
+        self.assertEqual(len(im_crops), 3)
+        self.assertTrue(np.array_equal(np.concatenate(im_crops), crops))
@@ -39,6 +39,7 @@ class CapsuleNet(nn.Module):
             from layers.em_routing import PrimaryCaps, ConvCaps
             kwargs['iters'] = args.num_rout_iters
             kwargs['final_lambda'] = 1e-2
+            kwargs['chunk_size'] = args.rout_chunk_size
 
         elif args.routing == 'SR':
             self.mode = 'SR'
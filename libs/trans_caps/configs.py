@@ -75,6 +75,8 @@ parser.add_option('--rout', '--routing', dest='routing', default='TR',
                   help='Routing type: {DR, EM, SR, TR} (default: TR)')
 parser.add_option('--nri', '--num_rout_iters', dest='num_rout_iters', default=3, type='int',
                   help='number of routing iterations for DR and EM (default: 3)')
+parser.add_option('--rcs', '--rout_chunk_size', dest='rout_chunk_size', default=0, type='int',
+                  help='number of output positions routed at once by EM, 0 for all (default: 0)')
 parser.add_option('--nh', '--num_heads', dest='num_heads', default=1, type='int',
                   help='number of attention heads for TR (default: 1)')
 
@@ -5,7 +5,7 @@ import torch
 from torchvision import datasets
 from torchvision import transforms
 from torch.utils.data import Subset
-from norb import smallNORBViewPoint, smallNORB
+from norb import smallNORBViewPoint, smallNORB, NORBBatchTransform
 from config.cfg_loader import proj_paths_json
 from features_classification import custom_transforms
 
@@ -119,6 +119,7 @@ def get_train_valid_loader(data_dir,
                            num_workers=4,
                            pin_memory=False):
     data_dir = data_dir + '/' + dataset
+    train_collate_fn = valid_collate_fn = None
 
     if dataset == "cifar10":
         trans = [transforms.RandomCrop(32, padding=4),
@@ -146,20 +147,18 @@ def get_train_valid_loader(data_dir,
                                 transform=transforms.Compose(trans))
 
     elif dataset == "smallnorb":
-        trans = [transforms.Resize(48),
-                 transforms.RandomCrop(32),
-                 transforms.ColorJitter(brightness=32. / 255, contrast=0.3),
-                 transforms.ToTensor(),
-                 # transforms.Normalize((0.7199,), (0.117,))
-                 ]
+        # Resize(48), RandomCrop(32), ColorJitter(brightness=32. / 255, contrast=0.3), ToTensor()
+        # applied on whole batches of uint8 images
+        train_collate_fn = valid_collate_fn = NORBBatchTransform(resize=48, crop=32, random_crop=True,
+                                                                 brightness=32. / 255, contrast=0.3)
         if exp in VIEWPOINT_EXPS:
             train_set = smallNORBViewPoint(data_dir, exp=exp, train=True, download=True,
-                                           transform=transforms.Compose(trans))
-            trans = trans[:1] + [transforms.CenterCrop(32)] + trans[3:]
+                                           tensor_images=True)
+            valid_collate_fn = NORBBatchTransform(resize=48, crop=32)
             valid_set = smallNORBViewPoint(data_dir, exp=exp, train=False, familiar=False, download=False,
-                                           transform=transforms.Compose(trans))
+                                           tensor_images=True)
         elif exp == "full":
-            dataset = smallNORB(data_dir, train=True, download=True, transform=transforms.Compose(trans))
+            dataset = smallNORB(data_dir, train=True, download=True, tensor_images=True)
 
     if exp not in VIEWPOINT_EXPS:
         num_train = len(dataset)
@@ -179,11 +178,13 @@ def get_train_valid_loader(data_dir,
     train_loader = torch.utils.data.DataLoader(
         train_set, batch_size=batch_size, shuffle=True,
         num_workers=num_workers, pin_memory=pin_memory,
+        collate_fn=train_collate_fn,
     )
 
     valid_loader = torch.utils.data.DataLoader(
         valid_set, batch_size=batch_size, shuffle=False,
         num_workers=num_workers, pin_memory=pin_memory,
+        collate_fn=valid_collate_fn,
     )
 
     return train_loader, valid_loader
@@ -197,6 +198,7 @@ def get_test_loader(data_dir,
                     num_workers=4,
                     pin_memory=False):
     data_dir = data_dir + '/' + dataset
+    collate_fn = None
 
     if dataset == "cifar10":
         trans = [transforms.ToTensor(),
@@ -213,21 +215,18 @@ def get_test_loader(data_dir,
                                 transform=transforms.Compose(trans))
 
     elif dataset == "smallnorb":
-        trans = [transforms.Resize(48),
-                 transforms.CenterCrop(32),
-                 transforms.ToTensor(),
-                 # transforms.Normalize((0.7199,), (0.117,))
-                 ]
+        # Resize(48), CenterCrop(32), ToTensor() applied on whole batches of uint8 images
+        collate_fn = NORBBatchTransform(resize=48, crop=32)
         if exp in VIEWPOINT_EXPS:
             dataset = smallNORBViewPoint(data_dir, exp=exp, familiar=familiar, train=False, download=True,
-                                         transform=transforms.Compose(trans))
+                                         tensor_images=True)
         elif exp == "full":
-            dataset = smallNORB(data_dir, train=False, download=True,
-                                transform=transforms.Compose(trans))
+            dataset = smallNORB(data_dir, train=False, download=True, tensor_images=True)
 
     data_loader = torch.utils.data.DataLoader(
         dataset, batch_size=batch_size, shuffle=False,
         num_workers=num_workers, pin_memory=pin_memory,
+        collate_fn=collate_fn,
     )
 
     return data_loader
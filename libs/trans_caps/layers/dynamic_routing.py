@@ -1,8 +1,7 @@
 import math
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
-from utils.other_utils import squash
+from utils.other_utils import squash, unfold_capsules, capsule_votes
 
 
 class PrimaryCaps(nn.Module):
@@ -44,18 +43,12 @@ class ConvCaps(nn.Module):
     def forward(self, pose):
         # x: [b, AC, h, w]
         b, _, h, w = pose.shape
-        # [b, ACkk, l]
-        pose = F.unfold(pose, self.k, stride=self.stride, padding=self.pad)
-        l = pose.shape[-1]
         # [b, A, C, kk, l]
-        pose = pose.view(b, self.A, self.C, self.kk, l)
-        # [b, l, kk, A, C]
-        pose = pose.permute(0, 4, 3, 1, 2).contiguous()
-        # [b, l, kkA, C, 1]
-        pose = pose.view(b, l, self.kkA, self.C, 1)
+        pose = unfold_capsules(pose, self.A, self.k, stride=self.stride, padding=self.pad)
+        l = pose.shape[-1]
 
         # [b, l, kkA, BD]
-        pose_out = torch.matmul(self.W, pose).squeeze(-1)
+        pose_out = capsule_votes(pose, self.W)
         # [b, l, kkA, B, D]
         pose_out = pose_out.view(b, l, self.kkA, self.B, self.D)
 
@@ -2,6 +2,8 @@ import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
+from utils.other_utils import unfold_capsules, capsule_votes
 
 eps = 1e-12
 
@@ -40,6 +42,8 @@ class ConvCaps(nn.Module):
         self.last_layer = last_layer
 
         self.iters = kwargs['iters']
+        # number of output positions routed at once, None/0 routes all of them at once
+        self.chunk_size = kwargs.get('chunk_size', None)
 
         self.W = nn.Parameter(torch.FloatTensor(1, 1, self.kkA, B, self.mat_dim, self.mat_dim))
         nn.init.kaiming_uniform_(self.W.data)
@@ -105,33 +109,40 @@ class ConvCaps(nn.Module):
         # [b, l, kkA, B, 1]
         return r.unsqueeze(-1)
 
+    def routing(self, pose, a_in):
+        # pose: [b, A, psize, kk, l]
+        # a_in: [b, l, kkA]
+        b, l = a_in.shape[:2]
+
+        # [b, l, kkA, B, mat_dim, mat_dim]
+        pose_out = capsule_votes(pose, self.W.view(self.kkA, self.B, self.mat_dim, self.mat_dim))
+
+        # [b, l, kkA, B, psize]
+        v = pose_out.reshape(b, l, self.kkA, self.B, -1)
+
+        r = a_in.new_ones(b, l, self.kkA, self.B, 1)
+        for i in range(self.iters):
+            # this is from open review
+            self.lambda_ = self.final_lambda * (1 - 0.95 ** (i+1))
+            a_out, pose_out, sigma_sq = self.m_step(v, a_in, r)
+            if i < self.iters - 1:
+                r = self.e_step(v, a_out, pose_out, sigma_sq)
+
+        # [b, l, B], [b, l, 1, B, psize]
+        return a_out, pose_out
+
     def forward(self, x):
         # pose: [batch_size, A, psize]
         # a: [batch_size, A]
         a_in, pose = x
-        batch_size = a_in.shape[0]
 
         # a: [b, A, h, w]
         # pose: [b, A*psize, h, w]
         b, _, h, w = a_in.shape
 
-        # [b, A*psize*kk, l]
-        pose = F.unfold(pose, self.k, stride=self.stride, padding=self.pad)
-        l = pose.shape[-1]
         # [b, A, psize, kk, l]
-        pose = pose.view(b, self.A, self.psize, self.kk, l)
-        # [b, l, kk, A, psize]
-        pose = pose.permute(0, 4, 3, 1, 2).contiguous()
-        # [b, l, kkA, psize]
-        pose = pose.view(b, l, self.kkA, self.psize)
-        # [b, l, kkA, 1, mat_dim, mat_dim]
-        pose = pose.view(batch_size, l, self.kkA, self.mat_dim, self.mat_dim).unsqueeze(3)
-
-        # [b, l, kkA, B, mat_dim, mat_dim]
-        pose_out = torch.matmul(pose, self.W)
-
-        # [b, l, kkA, B, psize]
-        v = pose_out.view(batch_size, l, self.kkA, self.B, -1)
+        pose = unfold_capsules(pose, self.A, self.k, stride=self.stride, padding=self.pad)
+        l = pose.shape[-1]
 
         # [b, kkA, l]
         a_in = F.unfold(a_in, self.k, stride=self.stride, padding=self.pad)
@@ -142,13 +153,24 @@ class ConvCaps(nn.Module):
         # [b, l, kkA]
         a_in = a_in.view(b, l, self.kkA)
 
-        r = a_in.new_ones(batch_size, l, self.kkA, self.B, 1)
-        for i in range(self.iters):
-            # this is from open review
-            self.lambda_ = self.final_lambda * (1 - 0.95 ** (i+1))
-            a_out, pose_out, sigma_sq = self.m_step(v, a_in, r)
-            if i < self.iters - 1:
-                r = self.e_step(v, a_out, pose_out, sigma_sq)
+        if not self.chunk_size or self.chunk_size >= l:
+            a_out, pose_out = self.routing(pose, a_in)
+        else:
+            # The routing of every output position is independent, so the votes
+            # and the EM iterations only exist for chunk_size positions at a time.
+            # When training, each chunk is recomputed during the backward pass
+            # instead of keeping its votes alive.
+            a_outs, pose_outs = [], []
+            for start in range(0, l, self.chunk_size):
+                chunk = (pose[..., start:start + self.chunk_size], a_in[:, start:start + self.chunk_size])
+                if torch.is_grad_enabled():
+                    a_out, pose_out = torch.utils.checkpoint.checkpoint(self.routing, *chunk,
+                                                                        use_reentrant=False)
+                else:
+                    a_out, pose_out = self.routing(*chunk)
+                a_outs.append(a_out)
+                pose_outs.append(pose_out)
+            a_out, pose_out = torch.cat(a_outs, dim=1), torch.cat(pose_outs, dim=1)
 
         # [b, l, B*psize]
         pose_out = pose_out.squeeze(2).view(b, l, -1)
@@ -163,3 +185,74 @@ class ConvCaps(nn.Module):
         pose_out = pose_out.view(b, -1, oh, ow)
 
         return a_out, pose_out
+
+
+def _peak_memory(A, B, P, batch_size, resolution, iters, chunk_size, train, queue):
+    import resource
+    import time
+
+    torch.manual_seed(0)
+    layer = ConvCaps(A, B, K=3, P=P, stride=2, pad=1, iters=iters, final_lambda=1e-2,
+                     chunk_size=chunk_size)
+    a_in = torch.rand(batch_size, A, resolution, resolution, requires_grad=train)
+    pose = torch.randn(batch_size, A * P * P, resolution, resolution, requires_grad=train)
+
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    since = time.time()
+    with torch.set_grad_enabled(train):
+        a_out, pose_out = layer((a_in, pose))
+        if train:
+            (a_out.sum() + pose_out.sum()).backward()
+    elapsed = time.time() - since
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is in KB on Linux
+    queue.put((elapsed, (peak - baseline) / 1024, a_out.detach().numpy(), pose_out.detach().numpy(),
+               pose.grad.numpy() if train else None))
+
+
+def benchmark_em_routing(resolutions=(16, 24, 32), batch_sizes=(1, 2), chunk_size=64,
+                         A=32, B=32, P=4, iters=3, train=True):
+    ''' Peak memory (growth of the max RSS of a fresh process) and latency of
+    ConvCaps with and without chunked routing on CPU, forward + backward when
+    train is set. Run: python -m layers.em_routing '''
+    import multiprocessing
+    import queue as queue_lib
+
+    context = multiprocessing.get_context('spawn')
+    for resolution in resolutions:
+        for batch_size in batch_sizes:
+            results = []
+            for layer_chunk_size in [None, chunk_size]:
+                queue = context.Queue()
+                process = context.Process(target=_peak_memory,
+                                          args=(A, B, P, batch_size, resolution, iters,
+                                                layer_chunk_size, train, queue))
+                process.start()
+                result = None
+                while result is None:
+                    try:
+                        result = queue.get(timeout=1)
+                    except queue_lib.Empty:
+                        if not process.is_alive():
+                            # most likely killed for running out of memory
+                            break
+                process.join()
+                results.append(result)
+
+            if None in results:
+                mode = 'all positions' if results[0] is None else f'chunks of {chunk_size}'
+                print(f'{resolution}x{resolution}, batch {batch_size}: {mode} did not complete')
+                continue
+
+            (time_full, mem_full, *outs_full), (time_chunk, mem_chunk, *outs_chunk) = results
+            max_diff = max(abs(full - chunk).max()
+                           for full, chunk in zip(outs_full, outs_chunk) if full is not None)
+            print(f'{resolution}x{resolution}, batch {batch_size}: '
+                  f'all positions {mem_full:.0f} MB / {time_full:.2f}s, '
+                  f'chunks of {chunk_size} {mem_chunk:.0f} MB / {time_chunk:.2f}s '
+                  f'(max abs diff {max_diff:.1e})')
+
+
+if __name__ == '__main__':
+    benchmark_em_routing()
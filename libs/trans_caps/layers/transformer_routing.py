@@ -2,6 +2,7 @@ import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from utils.other_utils import unfold_capsules, capsule_votes
 
 
 class PrimaryCaps(nn.Module):
@@ -41,23 +42,15 @@ class ConvCaps(nn.Module):
     def forward(self, x):
         b, c, h, w = x.shape
 
-        # [b, A*psize*kk, l]
-        pose = F.unfold(x, self.k, stride=self.stride, padding=self.pad)
-        l = pose.shape[-1]
         # [b, A, psize, kk, l]
-        pose = pose.view(b, self.A, self.psize, self.kk, l)
-        # [b, l, kk, A, psize]
-        pose = pose.permute(0, 4, 3, 1, 2).contiguous()
-        # [b, l, kkA, psize]
-        pose = pose.view(b, l, self.kkA, self.psize)
-        # [b, l, kkA, 1, mat_dim, mat_dim]
-        pose = pose.view(b, l, self.kkA, self.P, self.P).unsqueeze(3)
+        pose = unfold_capsules(x, self.A, self.k, stride=self.stride, padding=self.pad)
+        l = pose.shape[-1]
 
         # [b, l, kkA, B, mat_dim, mat_dim]
-        pose_out = torch.matmul(pose, self.W)
+        pose_out = capsule_votes(pose, self.W)
 
         # [b*l, kkA, B, psize]
-        v = pose_out.view(b * l, self.kkA, self.B, self.psize)
+        v = pose_out.reshape(b * l, self.kkA, self.B, self.psize)
 
         # [b*l, B, psize]
         pose_out = self.router(v)
@@ -5,10 +5,14 @@ import os
 import errno
 import struct
 
+import time
+
 import torch
 import torch.utils.data as data
+import torchvision.transforms.functional as TF
 import numpy as np
 from PIL import Image
+from torch.utils.data.dataloader import default_collate
 from torchvision.datasets.utils import download_url, check_integrity
 
 
@@ -34,6 +38,12 @@ class smallNORB(data.Dataset):
             - stereo: left and right images are included as corresponding pairs.
             - left: only the left images are included.
             - right: only the right images are included.
+        mmap (bool, optional): If True, the processed images are memory-mapped instead of
+            being loaded in memory (needs files saved by torch >= 1.6).
+        tensor_images (bool, optional): If True, the images are returned as uint8 tensors
+            [1, 96, 96] (views of the stored images) instead of PIL images, transform then
+            takes in a tensor. Leave transform to None and pass a ``NORBBatchTransform'' as
+            the collate_fn of the DataLoader to transform whole batches at once.
     """
 
     dataset_root = "https://cs.nyu.edu/~ylclab/data/norb-v1.0-small/"
@@ -85,7 +95,7 @@ class smallNORB(data.Dataset):
     extension = '.pt'
 
     def __init__(self, root, train=True, transform=None, target_transform=None, info_transform=None, download=False,
-                 mode="all"):
+                 mode="all", mmap=False, tensor_images=False):
 
         self.root = os.path.expanduser(root)
         self.transform = transform
@@ -93,6 +103,8 @@ class smallNORB(data.Dataset):
         self.info_transform = info_transform
         self.train = train  # training set or test set
         self.mode = mode
+        self.mmap = mmap
+        self.tensor_images = tensor_images
 
         if download:
             self.download()
@@ -112,25 +124,20 @@ class smallNORB(data.Dataset):
         # load info files
         self.infos = self._load(info_file)
 
-        # load right set
+        # The left and right images are kept in separate tensors, ``all'' and
+        # ``stereo'' index both of them instead of concatenating/stacking them
         if self.mode == "left":
-            self.data = self._load("{}_left".format(image_file))
-
-        # load left set
+            self.images = [self._load("{}_left".format(image_file))]
         elif self.mode == "right":
-            self.data = self._load("{}_right".format(image_file))
-
+            self.images = [self._load("{}_right".format(image_file))]
         elif self.mode == "all" or self.mode == "stereo":
-            left_data = self._load("{}_left".format(image_file))
-            right_data = self._load("{}_right".format(image_file))
+            self.images = [self._load("{}_left".format(image_file)),
+                           self._load("{}_right".format(image_file))]
+        else:
+            raise ValueError('Unknown mode {}'.format(self.mode))
 
-            # load stereo
-            if self.mode == "stereo":
-                self.data = torch.stack((left_data, right_data), dim=1)
-
-            # load all
-            else:
-                self.data = torch.cat((left_data, right_data), dim=0)
+        # rows of the images of the samples
+        self.indices = torch.arange(len(self.labels))
 
     def __getitem__(self, index):
         """
@@ -142,36 +149,46 @@ class smallNORB(data.Dataset):
             mode ``stereo'':
                 tuple: (image left, image right, target, info)
         """
-        target = self.labels[index % 24300] if self.mode is "all" else self.labels[index]
+        # mode ``all'': the left images of all the samples, then the right ones
+        side, index = divmod(index, len(self.indices))
+        row = self.indices[index]
+
+        target = self.labels[index]
         if self.target_transform is not None:
             target = self.target_transform(target)
 
-        info = self.infos[index % 24300] if self.mode is "all" else self.infos[index]
+        info = self.infos[index]
         if self.info_transform is not None:
             info = self.info_transform(info)
 
         if self.mode == "stereo":
-            img_left = self._transform(self.data[index, 0])
-            img_right = self._transform(self.data[index, 1])
+            img_left = self._transform(self.images[0][row])
+            img_right = self._transform(self.images[1][row])
             return img_left, img_right, target, info
 
-        img = self._transform(self.data[index])
+        img = self._transform(self.images[side][row])
         return img, target
 
     def __len__(self):
-        return len(self.data)
+        return len(self.indices) * (2 if self.mode == "all" else 1)
 
     def _transform(self, img):
-        # doing this so that it is consistent with all other data sets
-        # to return a PIL Image
-        img = Image.fromarray(img.numpy(), mode='L')
+        if self.tensor_images:
+            img = img.unsqueeze(0)
+        else:
+            # doing this so that it is consistent with all other data sets
+            # to return a PIL Image
+            img = Image.fromarray(img.numpy(), mode='L')
 
         if self.transform is not None:
             img = self.transform(img)
         return img
 
     def _load(self, file_name):
-        return torch.load(os.path.join(self.root, self.processed_folder, file_name + self.extension))
+        fpath = os.path.join(self.root, self.processed_folder, file_name + self.extension)
+        if self.mmap:
+            return torch.load(fpath, mmap=True)
+        return torch.load(fpath)
 
     def _save(self, file, file_name):
         with open(os.path.join(self.root, self.processed_folder, file_name + self.extension), 'wb') as f:
@@ -271,86 +288,67 @@ class smallNORB(data.Dataset):
 
         print('Done!')
 
+    # element type of the payload, given by the magic number of the header
+    payload_dtypes = {
+        0x1E3D4C55: np.uint8,
+        0x1E3D4C54: np.dtype('<i4'),
+    }
+
     @staticmethod
     def _parse_header(file_pointer):
-        # Read magic number and ignore
-        struct.unpack('<BBBB', file_pointer.read(4))  # '<' is little endian)
+        # Read magic number
+        magic, = struct.unpack('<i', file_pointer.read(4))  # '<' is little endian)
 
-        # Read dimensions
-        dimensions = []
+        # Read dimensions, at least 3 are stored
         num_dims, = struct.unpack('<i', file_pointer.read(4))  # '<' is little endian)
-        for _ in range(num_dims):
-            dimensions.extend(struct.unpack('<i', file_pointer.read(4)))
+        dimensions = list(struct.unpack('<' + max(num_dims, 3) * 'i', file_pointer.read(4 * max(num_dims, 3))))
 
-        return dimensions
+        return magic, dimensions[:num_dims]
 
-    def _read_image_file(self, file_name):
+    def _read_payload(self, file_name, mmap=False):
+        """Read a whole raw file at once (or memory-map it) as an array shaped by its header. """
         fpath = os.path.join(self.root, self.raw_folder, file_name)
         with open(fpath, mode='rb') as f:
-            dimensions = self._parse_header(f)
-            assert dimensions == [24300, 2, 96, 96]
-            num_samples, _, height, width = dimensions
+            magic, dimensions = self._parse_header(f)
+            offset = f.tell()
 
-            left_samples = np.zeros(shape=(num_samples, height, width), dtype=np.uint8)
-            right_samples = np.zeros(shape=(num_samples, height, width), dtype=np.uint8)
+        dtype = self.payload_dtypes[magic]
+        if mmap:
+            return np.memmap(fpath, dtype=dtype, mode='r', offset=offset, shape=tuple(dimensions))
+        return np.fromfile(fpath, dtype=dtype, count=int(np.prod(dimensions)),
+                           offset=offset).reshape(dimensions)
 
-            for i in range(num_samples):
-
-                # left and right images stored in pairs, left first
-                left_samples[i, :, :] = self._read_image(f, height, width)
-                right_samples[i, :, :] = self._read_image(f, height, width)
+    def _read_image_file(self, file_name):
+        samples = self._read_payload(file_name, mmap=True)
+        assert list(samples.shape) == [24300, 2, 96, 96]
 
-        return torch.ByteTensor(left_samples), torch.ByteTensor(right_samples)
+        # left and right images stored in pairs, left first
+        left_samples = np.ascontiguousarray(samples[:, 0])
+        right_samples = np.ascontiguousarray(samples[:, 1])
 
-    @staticmethod
-    def _read_image(file_pointer, height, width):
-        """Read raw image data and restore shape as appropriate. """
-        image = struct.unpack('<' + height * width * 'B', file_pointer.read(height * width))
-        image = np.uint8(np.reshape(image, newshape=(height, width)))
-        return image
+        return torch.from_numpy(left_samples), torch.from_numpy(right_samples)
 
     def _read_label_file(self, file_name):
-        fpath = os.path.join(self.root, self.raw_folder, file_name)
-        with open(fpath, mode='rb') as f:
-            dimensions = self._parse_header(f)
-            assert dimensions == [24300]
-            num_samples = dimensions[0]
-
-            struct.unpack('<BBBB', f.read(4))  # ignore this integer
-            struct.unpack('<BBBB', f.read(4))  # ignore this integer
-
-            labels = np.zeros(shape=num_samples, dtype=np.int32)
-            for i in range(num_samples):
-                category, = struct.unpack('<i', f.read(4))
-                labels[i] = category
-            return torch.LongTensor(labels)
+        labels = self._read_payload(file_name)
+        assert list(labels.shape) == [24300]
+        return torch.from_numpy(labels.astype(np.int64))
 
     def _read_info_file(self, file_name):
-        fpath = os.path.join(self.root, self.raw_folder, file_name)
-        with open(fpath, mode='rb') as f:
-
-            dimensions = self._parse_header(f)
-            assert dimensions == [24300, 4]
-            num_samples, num_info = dimensions
+        infos = self._read_payload(file_name)
+        assert list(infos.shape) == [24300, 4]
+        return torch.from_numpy(infos.astype(np.int64))
 
-            struct.unpack('<BBBB', f.read(4))  # ignore this integer
 
-            infos = np.zeros(shape=(num_samples, num_info), dtype=np.int32)
-
-            for r in range(num_samples):
-                for c in range(num_info):
-                    info, = struct.unpack('<i', f.read(4))
-                    infos[r, c] = info
-
-        return torch.LongTensor(infos)
-
-class smallNORBViewPoint(data.Dataset):
+class smallNORBViewPoint(smallNORB):
     """`MNIST <https://cs.nyu.edu/~ylclab/data/norb-v1.0-small//>`_ Dataset.
     Args:
         root (string): Root directory of dataset where processed folder and
             and  raw folder exist.
+        exp (string, optional): Viewpoint experiment, ``azimuth'' or ``elevation''.
         train (bool, optional): If True, creates dataset from the training files,
             otherwise from the test files.
+        familiar (bool, optional): If True, the test set keeps the viewpoints seen during
+            training, otherwise the novel ones.
         download (bool, optional): If true, downloads the dataset from the internet and
             puts it in root directory. If the dataset is already processed, it is not processed
             and downloaded again. If dataset is only already downloaded, it is not
@@ -366,107 +364,24 @@ class smallNORBViewPoint(data.Dataset):
             - stereo: left and right images are included as corresponding pairs.
             - left: only the left images are included.
             - right: only the right images are included.
+        mmap (bool, optional): If True, the processed images are memory-mapped instead of
+            being loaded in memory (needs files saved by torch >= 1.6).
+        tensor_images (bool, optional): If True, the images are returned as uint8 tensors
+            [1, 96, 96] (views of the stored images) instead of PIL images, transform then
+            takes in a tensor. Leave transform to None and pass a ``NORBBatchTransform'' as
+            the collate_fn of the DataLoader to transform whole batches at once.
     """
 
-    dataset_root = "https://cs.nyu.edu/~ylclab/data/norb-v1.0-small/"
-    data_files = {
-        'train': {
-            'dat': {
-                "name": 'smallnorb-5x46789x9x18x6x2x96x96-training-dat.mat',
-                "md5_gz": "66054832f9accfe74a0f4c36a75bc0a2",
-                "md5": "8138a0902307b32dfa0025a36dfa45ec"
-            },
-            'info': {
-                "name": 'smallnorb-5x46789x9x18x6x2x96x96-training-info.mat',
-                "md5_gz": "51dee1210a742582ff607dfd94e332e3",
-                "md5": "19faee774120001fc7e17980d6960451"
-            },
-            'cat': {
-                "name": 'smallnorb-5x46789x9x18x6x2x96x96-training-cat.mat',
-                "md5_gz": "23c8b86101fbf0904a000b43d3ed2fd9",
-                "md5": "fd5120d3f770ad57ebe620eb61a0b633"
-            },
-        },
-        'test': {
-            'dat': {
-                "name": 'smallnorb-5x01235x9x18x6x2x96x96-testing-dat.mat',
-                "md5_gz": "e4ad715691ed5a3a5f138751a4ceb071",
-                "md5": "e9920b7f7b2869a8f1a12e945b2c166c"
-            },
-            'info': {
-                "name": 'smallnorb-5x01235x9x18x6x2x96x96-testing-info.mat',
-                "md5_gz": "a9454f3864d7fd4bb3ea7fc3eb84924e",
-                "md5": "7c5b871cc69dcadec1bf6a18141f5edc"
-            },
-            'cat': {
-                "name": 'smallnorb-5x01235x9x18x6x2x96x96-testing-cat.mat',
-                "md5_gz": "5aa791cd7e6016cf957ce9bdb93b8603",
-                "md5": "fd5120d3f770ad57ebe620eb61a0b633"
-            },
-        },
-    }
-
-    raw_folder = 'raw'
-    processed_folder = 'processed'
-    train_image_file = 'train_img'
-    train_label_file = 'train_label'
-    train_info_file = 'train_info'
-    test_image_file = 'test_img'
-    test_label_file = 'test_label'
-    test_info_file = 'test_info'
-    extension = '.pt'
-
     def __init__(self, root, exp='azimuth', train=True, familiar=True, transform=None, target_transform=None, info_transform=None, download=False,
-                 mode="all"):
-
-        self.root = os.path.expanduser(root)
-        self.transform = transform
-        self.target_transform = target_transform
-        self.info_transform = info_transform
-        self.train = train  # training set or test set
+                 mode="all", mmap=False, tensor_images=False):
+        super(smallNORBViewPoint, self).__init__(root, train=train, transform=transform,
+                                                 target_transform=target_transform,
+                                                 info_transform=info_transform,
+                                                 download=download, mode=mode, mmap=mmap,
+                                                 tensor_images=tensor_images)
         self.familiar = familiar
-        self.mode = mode
-
-        if download:
-            self.download()
-
-        if not self._check_exists():
-            raise RuntimeError('Dataset not found or corrupted.' +
-                               ' You can use download=True to download it')
-
-        # load test or train set
-        image_file = self.train_image_file if self.train else self.test_image_file
-        label_file = self.train_label_file if self.train else self.test_label_file
-        info_file = self.train_info_file if self.train else self.test_info_file
-
-        # load labels
-        self.labels = self._load(label_file)
-
-        # load info files
-        self.infos = self._load(info_file)
-
-        # load right set
-        if self.mode == "left":
-            self.data = self._load("{}_left".format(image_file))
-
-        # load left set
-        elif self.mode == "right":
-            self.data = self._load("{}_right".format(image_file))
-
-        elif self.mode == "all" or self.mode == "stereo":
-            left_data = self._load("{}_left".format(image_file))
-            right_data = self._load("{}_right".format(image_file))
-
-            # load stereo
-            if self.mode == "stereo":
-                self.data = torch.stack((left_data, right_data), dim=1)
-
-            # load all
-            else:
-                self.data = torch.cat((left_data, right_data), dim=0)
 
         # prepare exp
-        img, tar, inf = [], [], []
         if exp == 'azimuth':
             self.anno_dim = 2
             self.train_anno = [0, 2, 4, 34, 32, 30]
@@ -476,224 +391,119 @@ class smallNORBViewPoint(data.Dataset):
         else:
             raise NotImplementedError
 
-        indices = []
-        for i, info in enumerate(self.infos):
-            info = info[self.anno_dim].data.item()
-            if (info in self.train_anno) == (self.train or self.familiar):
-                indices.append(i)
+        in_train_anno = torch.from_numpy(np.isin(self.infos[:, self.anno_dim].numpy(), self.train_anno))
+        indices = torch.nonzero(in_train_anno == (self.train or self.familiar)).squeeze(1)
 
-        self.data = self.data[indices + [i + 24300 for i in indices]] if self.mode is 'all' else self.data[indices]
+        self.indices = self.indices[indices]
         self.labels = self.labels[indices]
         self.infos = self.infos[indices]
 
-    def __getitem__(self, index):
-        """
-        Args:
-            index (int): Index
-        Returns:
-            mode ``all'', ``left'', ``right'':
-                tuple: (image, target, info)
-            mode ``stereo'':
-                tuple: (image left, image right, target, info)
-        """
-        target = self.labels[index % len(self.infos)] if self.mode is "all" else self.labels[index]
-        if self.target_transform is not None:
-            target = self.target_transform(target)
-
-        info = self.infos[index % len(self.infos)] if self.mode is "all" else self.infos[index]
-        if self.info_transform is not None:
-            info = self.info_transform(info)
-
-        if self.mode == "stereo":
-            img_left = self._transform(self.data[index, 0])
-            img_right = self._transform(self.data[index, 1])
-            return img_left, img_right, target, info
-
-        img = self._transform(self.data[index])
-        return img, target
-
-    def __len__(self):
-        return len(self.data)
-
-    def _transform(self, img):
-        # doing this so that it is consistent with all other data sets
-        # to return a PIL Image
-        img = Image.fromarray(img.numpy(), mode='L')
-
-        if self.transform is not None:
-            img = self.transform(img)
-        return img
-
-    def _load(self, file_name):
-        return torch.load(os.path.join(self.root, self.processed_folder, file_name + self.extension))
-
-    def _save(self, file, file_name):
-        with open(os.path.join(self.root, self.processed_folder, file_name + self.extension), 'wb') as f:
-            torch.save(file, f)
-
-    def _check_exists(self):
-        """ Check if processed files exists."""
-        files = (
-            "{}_left".format(self.train_image_file),
-            "{}_right".format(self.train_image_file),
-            "{}_left".format(self.test_image_file),
-            "{}_right".format(self.test_image_file),
-            self.test_label_file,
-            self.train_label_file
-        )
-        fpaths = [os.path.exists(os.path.join(self.root, self.processed_folder, f + self.extension)) for f in files]
-        return False not in fpaths
-
-    def _flat_data_files(self):
-        return [j for i in self.data_files.values() for j in list(i.values())]
-
-    def _check_integrity(self):
-        """Check if unpacked files have correct md5 sum."""
-        root = self.root
-        for file_dict in self._flat_data_files():
-            filename = file_dict["name"]
-            md5 = file_dict["md5"]
-            fpath = os.path.join(root, self.raw_folder, filename)
-            if not check_integrity(fpath, md5):
-                return False
-        return True
-
-    def download(self):
-        """Download the SmallNORB data if it doesn't exist in processed_folder already."""
-        import gzip
-
-        if self._check_exists():
-            return
-
-        # check if already extracted and verified
-        if self._check_integrity():
-            print('Files already downloaded and verified')
-        else:
-            # download and extract
-            for file_dict in self._flat_data_files():
-                url = self.dataset_root + file_dict["name"] + '.gz'
-                filename = file_dict["name"]
-                gz_filename = filename + '.gz'
-                md5 = file_dict["md5_gz"]
-                fpath = os.path.join(self.root, self.raw_folder, filename)
-                gz_fpath = fpath + '.gz'
-
-                # download if compressed file not exists and verified
-                download_url(url, os.path.join(self.root, self.raw_folder), gz_filename, md5)
-
-                print('# Extracting data {}\n'.format(filename))
-
-                with open(fpath, 'wb') as out_f, \
-                        gzip.GzipFile(gz_fpath) as zip_f:
-                    out_f.write(zip_f.read())
-
-                os.unlink(gz_fpath)
-
-        # process and save as torch files
-        print('Processing...')
-
-        # create processed folder
-        try:
-            os.makedirs(os.path.join(self.root, self.processed_folder))
-        except OSError as e:
-            if e.errno == errno.EEXIST:
-                pass
-            else:
-                raise
-
-        # read train files
-        left_train_img, right_train_img = self._read_image_file(self.data_files["train"]["dat"]["name"])
-        train_info = self._read_info_file(self.data_files["train"]["info"]["name"])
-        train_label = self._read_label_file(self.data_files["train"]["cat"]["name"])
-
-        # read test files
-        left_test_img, right_test_img = self._read_image_file(self.data_files["test"]["dat"]["name"])
-        test_info = self._read_info_file(self.data_files["test"]["info"]["name"])
-        test_label = self._read_label_file(self.data_files["test"]["cat"]["name"])
-
-        # save training files
-        self._save(left_train_img, "{}_left".format(self.train_image_file))
-        self._save(right_train_img, "{}_right".format(self.train_image_file))
-        self._save(train_label, self.train_label_file)
-        self._save(train_info, self.train_info_file)
-
-        # save test files
-        self._save(left_test_img, "{}_left".format(self.test_image_file))
-        self._save(right_test_img, "{}_right".format(self.test_image_file))
-        self._save(test_label, self.test_label_file)
-        self._save(test_info, self.test_info_file)
-
-        print('Done!')
-
-    @staticmethod
-    def _parse_header(file_pointer):
-        # Read magic number and ignore
-        struct.unpack('<BBBB', file_pointer.read(4))  # '<' is little endian)
-
-        # Read dimensions
-        dimensions = []
-        num_dims, = struct.unpack('<i', file_pointer.read(4))  # '<' is little endian)
-        for _ in range(num_dims):
-            dimensions.extend(struct.unpack('<i', file_pointer.read(4)))
-
-        return dimensions
 
-    def _read_image_file(self, file_name):
-        fpath = os.path.join(self.root, self.raw_folder, file_name)
-        with open(fpath, mode='rb') as f:
-            dimensions = self._parse_header(f)
-            assert dimensions == [24300, 2, 96, 96]
-            num_samples, _, height, width = dimensions
-
-            left_samples = np.zeros(shape=(num_samples, height, width), dtype=np.uint8)
-            right_samples = np.zeros(shape=(num_samples, height, width), dtype=np.uint8)
-
-            for i in range(num_samples):
-
-                # left and right images stored in pairs, left first
-                left_samples[i, :, :] = self._read_image(f, height, width)
-                right_samples[i, :, :] = self._read_image(f, height, width)
+class NORBBatchTransform(object):
+    """Collate function of the datasets created with tensor_images=True: the uint8 images
+    of the batch are resized, cropped, jittered and converted to float all at once, as
+    ``transforms.Compose([Resize(resize), RandomCrop(crop) or CenterCrop(crop),
+    ColorJitter(brightness, contrast), ToTensor()])'' would do on every PIL image.
+    The crop offsets and the jitter factors are still drawn per image. The results
+    differ from the PIL ones by the rounding (at most 1/255 after the resize, the
+    jitter is not rounded to uint8).
+    Args:
+        resize (int): Size of the smaller edge after resizing.
+        crop (int): Size of the square crop.
+        random_crop (bool, optional): If True, random crops, otherwise center crops.
+        brightness (float, optional): Brightness factors drawn in [1 - brightness, 1 + brightness].
+        contrast (float, optional): Contrast factors drawn in [1 - contrast, 1 + contrast].
+    """
 
-        return torch.ByteTensor(left_samples), torch.ByteTensor(right_samples)
+    def __init__(self, resize=48, crop=32, random_crop=False, brightness=0., contrast=0.):
+        self.resize = resize
+        self.crop = crop
+        self.random_crop = random_crop
+        self.brightness = brightness
+        self.contrast = contrast
+
+    def __call__(self, samples):
+        batch = default_collate(samples)
+        # (image, target) or, in mode ``stereo'', (image left, image right, target, info)
+        num_images = 2 if len(batch) == 4 else 1
+        return [self.transform(images) for images in batch[:num_images]] + batch[num_images:]
+
+    def transform(self, images):
+        """ uint8 images [B, 1, H, W] -> float images [B, 1, crop, crop] in [0, 1] """
+        images = TF.resize(images, self.resize, antialias=True)
+        images = self._crop(images)
+        images = images.float().div(255)
+        return self._jitter(images)
+
+    def _crop(self, images):
+        if not self.random_crop:
+            return TF.center_crop(images, self.crop)
+
+        batch_size, _, height, width = images.shape
+        top = torch.randint(0, height - self.crop + 1, (batch_size, 1))
+        left = torch.randint(0, width - self.crop + 1, (batch_size, 1))
+        rows = top + torch.arange(self.crop)
+        cols = left + torch.arange(self.crop)
+        # [B, crop, crop, C], the channels go last when indexing around them
+        crops = images[torch.arange(batch_size)[:, None, None], :, rows[:, :, None], cols[:, None, :]]
+        return crops.permute(0, 3, 1, 2)
+
+    def _jitter(self, images):
+        ops = []
+        if self.brightness:
+            brightness = self._factors(images, self.brightness)
+            ops.append(lambda x: (x * brightness).clamp(0, 1))
+        if self.contrast:
+            contrast = self._factors(images, self.contrast)
+            ops.append(lambda x: (contrast * x + (1 - contrast) * x.mean(dim=(1, 2, 3), keepdim=True)).clamp(0, 1))
+
+        if len(ops) < 2:
+            return ops[0](images) if ops else images
+
+        # ColorJitter applies brightness and contrast in a random order
+        brightness_first = torch.rand(images.shape[0], 1, 1, 1) < 0.5
+        return torch.where(brightness_first, ops[1](ops[0](images)), ops[0](ops[1](images)))
 
     @staticmethod
-    def _read_image(file_pointer, height, width):
-        """Read raw image data and restore shape as appropriate. """
-        image = struct.unpack('<' + height * width * 'B', file_pointer.read(height * width))
-        image = np.uint8(np.reshape(image, newshape=(height, width)))
-        return image
-
-    def _read_label_file(self, file_name):
-        fpath = os.path.join(self.root, self.raw_folder, file_name)
-        with open(fpath, mode='rb') as f:
-            dimensions = self._parse_header(f)
-            assert dimensions == [24300]
-            num_samples = dimensions[0]
-
-            struct.unpack('<BBBB', f.read(4))  # ignore this integer
-            struct.unpack('<BBBB', f.read(4))  # ignore this integer
-
-            labels = np.zeros(shape=num_samples, dtype=np.int32)
-            for i in range(num_samples):
-                category, = struct.unpack('<i', f.read(4))
-                labels[i] = category
-            return torch.LongTensor(labels)
-
-    def _read_info_file(self, file_name):
-        fpath = os.path.join(self.root, self.raw_folder, file_name)
-        with open(fpath, mode='rb') as f:
-
-            dimensions = self._parse_header(f)
-            assert dimensions == [24300, 4]
-            num_samples, num_info = dimensions
-
-            struct.unpack('<BBBB', f.read(4))  # ignore this integer
-
-            infos = np.zeros(shape=(num_samples, num_info), dtype=np.int32)
-
-            for r in range(num_samples):
-                for c in range(num_info):
-                    info, = struct.unpack('<i', f.read(4))
-                    infos[r, c] = info
-
-        return torch.LongTensor(infos)
+    def _factors(images, amount):
+        return torch.empty(images.shape[0], 1, 1, 1).uniform_(max(0., 1 - amount), 1 + amount)
+
+
+def benchmark_norb_loader(root, batch_size=128, num_batches=50, num_workers=0):
+    """ Per-sample PIL transforms vs tensor images + NORBBatchTransform, training transforms """
+    from torchvision import transforms
+
+    pil_trans = transforms.Compose([transforms.Resize(48),
+                                    transforms.RandomCrop(32),
+                                    transforms.ColorJitter(brightness=32. / 255, contrast=0.3),
+                                    transforms.ToTensor()])
+    batch_trans = NORBBatchTransform(resize=48, crop=32, random_crop=True,
+                                     brightness=32. / 255, contrast=0.3)
+
+    loaders = {
+        'PIL': data.DataLoader(smallNORB(root, train=True, transform=pil_trans),
+                               batch_size=batch_size, shuffle=True, num_workers=num_workers),
+        'tensor': data.DataLoader(smallNORB(root, train=True, tensor_images=True),
+                                  batch_size=batch_size, shuffle=True, num_workers=num_workers,
+                                  collate_fn=batch_trans),
+    }
+    for name, loader in loaders.items():
+        since = time.time()
+        for batch_idx, (images, targets) in enumerate(loader):
+            assert images.shape[1:] == (1, 32, 32) and images.dtype == torch.float32
+            if batch_idx + 1 == num_batches:
+                break
+        elapsed = time.time() - since
+        print('{}: {:.0f} images/sec'.format(name, (batch_idx + 1) * batch_size / elapsed))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='smallNORB loading benchmark')
+    parser.add_argument('root', help='directory of the processed smallNORB dataset')
+    parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--num_workers', type=int, default=0)
+    args = parser.parse_args()
+
+    benchmark_norb_loader(args.root, batch_size=args.batch_size, num_workers=args.num_workers)
@@ -1,4 +1,5 @@
 import torch
+import torch.nn.functional as F
 
 
 def squash(s, dim=-1):
@@ -8,3 +9,86 @@ def squash(s, dim=-1):
     return v
 
 
+def unfold_capsules(x, num_caps, kernel_size, stride=1, padding=0):
+    ''' Poses of the capsules of every kernel_size x kernel_size window of x.
+    x: [b, A*C, h, w] -> [b, A, C, kk, l], a view of F.unfold (no copy) '''
+    b = x.shape[0]
+    # [b, ACkk, l]
+    x = F.unfold(x, kernel_size, stride=stride, padding=padding)
+    return x.view(b, num_caps, -1, kernel_size * kernel_size, x.shape[-1])
+
+
+def capsule_votes(pose, weight):
+    '''
+    Votes of the unfolded capsules for the capsules of the next layer, as one
+    batched matmul over the kkA input capsules: torch.matmul on the
+    [b, l, kkA, ...] layout would first broadcast the weights to every
+    position, and that layout needs a contiguous copy of the unfolded poses.
+
+    Args:
+    pose - [b, A, C, kk, l] from unfold_capsules
+    weight - [kkA, BD, C]: vote = W @ pose, with the pose as a C vector, or
+             [kkA, B, P, P]: vote = pose @ W, with the pose as a P x P matrix
+
+    Returns:
+    [b, l, kkA, BD] or [b, l, kkA, B, P, P] votes (not necessarily contiguous),
+    kkA being ordered as (kk, A)
+    '''
+    b, A, C, kk, l = pose.shape
+    if weight.dim() == 3:
+        # [kk, A, BD, C]
+        weight = weight.view(kk, A, -1, C)
+        votes = torch.einsum('nackl,kaoc->nlkao', pose, weight)
+        return votes.reshape(b, l, kk * A, -1)
+
+    P = weight.shape[-1]
+    # [b, A, P, P, kk, l]
+    pose = pose.view(b, A, P, P, kk, l)
+    # [kk, A, B, P, P]
+    weight = weight.view(kk, A, -1, P, P)
+    votes = torch.einsum('naipkl,kaopj->nlkaoij', pose, weight)
+    return votes.reshape(b, l, kk * A, -1, P, P)
+
+
+def benchmark_capsule_votes(batch_size=2, A=32, B=16, P=4, K=3, resolution=16, stride=2, repeats=3):
+    ''' Forward + backward of capsule_votes against the permute + broadcast
+    torch.matmul pipeline the routing layers used before, on CPU.
+    Run: python -m utils.other_utils '''
+    import time
+
+    C = P * P
+    kk, kkA = K * K, K * K * A
+    x = torch.randn(batch_size, A * C, resolution, resolution, requires_grad=True)
+
+    def reference(x, weight):
+        pose = F.unfold(x, K, stride=stride, padding=1)
+        l = pose.shape[-1]
+        pose = pose.view(batch_size, A, C, kk, l).permute(0, 4, 3, 1, 2).contiguous()
+        if weight.dim() == 3:
+            return torch.matmul(weight, pose.view(batch_size, l, kkA, C, 1)).squeeze(-1)
+        return torch.matmul(pose.view(batch_size, l, kkA, 1, P, P), weight)
+
+    def votes(x, weight):
+        return capsule_votes(unfold_capsules(x, A, K, stride=stride, padding=1), weight)
+
+    for name, weight in [('W @ pose', torch.randn(kkA, B * C, C, requires_grad=True)),
+                         ('pose @ W', torch.randn(kkA, B, P, P, requires_grad=True))]:
+        times, grads = [], []
+        for fn in [reference, votes]:
+            best = float('inf')
+            for _ in range(repeats):
+                x.grad, weight.grad = None, None
+                since = time.time()
+                out = fn(x, weight)
+                out.backward(torch.ones_like(out))
+                best = min(best, time.time() - since)
+            times.append(best)
+            grads.append((out.detach(), x.grad, weight.grad))
+
+        max_diff = max((ref - new).abs().max().item() for ref, new in zip(*grads))
+        print(f'{name}: matmul {times[0] * 1e3:.0f} ms, capsule_votes {times[1] * 1e3:.0f} ms '
+              f'({times[0] / times[1]:.1f}x, max abs diff {max_diff:.1e})')
+
+
+if __name__ == '__main__':
+    benchmark_capsule_votes()
@@ -69,6 +69,8 @@ parser.add_option("--d_num_iters", dest="d_num_iters",
 parser.add_option("--d_fuse_type", dest="disc_fuse_type",
                   type=str, default='concat',
                   help="Fusion type for Multi-modal discriminator")
+parser.add_option("--benchmark", dest="benchmark", action='store_true',
+                  help="Compare the training step against the previous loop on a small CPU config and exit")
 
 
 options, _ = parser.parse_args()
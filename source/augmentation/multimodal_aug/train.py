@@ -63,16 +63,18 @@ def weights_init(m):
 
 
 def gradient_penalty( critic, real_image, real_vector, fake_image, fake_vector, device="cpu"):
-    batch_size, channel, height, width= real_image.shape
-    batch_size, dim = real_vector.shape
-    #alpha is selected randomly between 0 and 1
-    alpha= torch.rand(batch_size,1,1,1).repeat(1, channel, height, width).to(device)
-    beta = torch.rand(batch_size,1).repeat(1, dim).to(device)
+    batch_size = real_image.shape[0]
+    #alpha is selected randomly between 0 and 1, one per sample and broadcast over the image/vector
+    alpha= torch.rand(batch_size, 1, 1, 1, device=device)
+    beta = torch.rand(batch_size, 1, device=device)
     
     # interpolated image=randomly weighted average between a real and fake image
     #interpolated image ← alpha *real image  + (1 − alpha) fake image
     interpolated_image=(alpha*real_image) + (1-alpha) * fake_image
     interpolated_vector = (beta*real_vector) + (1-beta) * fake_vector
+    # the fakes are detached from the generator, the gradient is taken wrt the interpolations
+    interpolated_image.requires_grad_(True)
+    interpolated_vector.requires_grad_(True)
     
     # calculate the critic score on the interpolated image
     # interpolated_score= critic(interpolatted_image)
@@ -82,7 +84,6 @@ def gradient_penalty( critic, real_image, real_vector, fake_image, fake_vector,
     # take the gradient of the score wrt to the interpolated image
     gradient= torch.autograd.grad(inputs=[interpolated_image, interpolated_vector],
                                   outputs=interpolated_score,
-                                  retain_graph=True,
                                   create_graph=True,
                                   grad_outputs=torch.ones_like(interpolated_score)                          
                                  )[0]
@@ -93,7 +94,216 @@ def gradient_penalty( critic, real_image, real_vector, fake_image, fake_vector,
     return gradient_penalty
 
 
+def get_labels(b_size, real, device):
+    if not options.random_lbl_smooth:
+        return torch.full((b_size,), 1.0 if real else 0.0, dtype=torch.float, device=device)
+    if real:
+        return torch.FloatTensor(b_size, 1).uniform_(options.real_label_min,
+                                                     options.real_label_max).to(device)
+    return torch.FloatTensor(b_size, 1).uniform_(options.fake_label_min,
+                                                 options.fake_label_max).to(device)
+
+
+def discriminator_loss(netD, real_image, real_vector, fake_image, fake_vector, criterion, device):
+    '''
+    Loss of D on a real and a fake batch. With the wasserstein loss, the
+    gradient penalty is part of the loss so that one backward computes all the
+    terms.
+
+    The fakes are expected to be detached from the generator.
+
+    Returns:
+    errD, D(x), D(G(z))
+    '''
+    b_size = real_image.size(0)
+    # Scored in separate passes: the bias gradients of the wasserstein loss are
+    # then exactly 0, which Adam would turn into full steps otherwise.
+    output_real = netD(real_image, real_vector, training=True).view(-1)
+    output_fake = netD(fake_image, fake_vector, training=True).view(-1)
+
+    if options.loss_func == 'minmax':
+        errD = criterion(output_real, get_labels(b_size, True, device)) + \
+            criterion(output_fake, get_labels(b_size, False, device))
+    elif options.loss_func == 'wasserstein':
+        gp = gradient_penalty(netD, real_image, real_vector,
+                              fake_image, fake_vector, device)
+        errD = -torch.mean(output_real) + torch.mean(output_fake) + 10*gp
+
+    return errD, output_real.mean().item(), output_fake.mean().item()
+
+
+def train_step(netD, netG, optimizerD, optimizerG, images, one_hot_labels, criterion, device):
+    '''
+    d_num_iters + 1 updates of D then one update of G, after which D is restored
+    to its state after its second update.
+
+    Returns:
+    errD, errG, D(x), D(G(z)) before and after the updates of D
+    '''
+    b_size = images.size(0)
+    nz = options.latent_size
+    backup = None
+
+    for it in range(options.d_num_iters + 1):
+        ############################
+        # (1) Update D network: maximize log(D(x)) + log(1 - D(G(z)))
+        ###########################
+        # Generate fake image batch with G, only the fakes of the last
+        # iteration are used to update G as well
+        noise = torch.randn(b_size, nz, device=device)
+        with torch.set_grad_enabled(it == options.d_num_iters):
+            fake_img, fake_feat_vec = netG(images, one_hot_labels, noise)
+
+        netD.zero_grad()
+        errD, D_x, D_G_z1 = discriminator_loss(netD, images, one_hot_labels,
+                                               fake_img.detach(), fake_feat_vec.detach(),
+                                               criterion, device)
+        errD.backward()
+        # Update D
+        optimizerD.step()
+
+        if it == 1:
+            backup = copy.deepcopy(netD)
+
+    ############################
+    # (2) Update G network: maximize log(D(G(z)))
+    ###########################
+    netG.zero_grad()
+
+    # Since we just updated D, perform another forward pass of all-fake batch through D
+    output = netD(fake_img, fake_feat_vec, training=True).view(-1)
+
+    # Calculate G's loss based on this output
+    if options.loss_func == 'minmax':
+        # fake labels are real for generator cost
+        errG = criterion(output, get_labels(b_size, True, device))
+    elif options.loss_func == 'wasserstein':
+        errG = -torch.mean(output)
+
+    # Calculate gradients for G
+    errG.backward()
+    D_G_z2 = output.mean().item()
+    # Update G
+    optimizerG.step()
+
+    if backup is not None:
+        netD.load(backup)
+
+    return errD.item(), errG.item(), D_x, D_G_z1, D_G_z2
+
+
+def _reference_train_step(netD, netG, optimizerD, optimizerG, images, one_hot_labels, device):
+    ''' Previous wasserstein loop: separate backward passes with retained graphs
+    and a gradient penalty on repeated interpolation coefficients '''
+    b_size = images.size(0)
+    backup = None
+    for it in range(options.d_num_iters + 1):
+        netD.zero_grad()
+        output = netD(images, one_hot_labels, training=True).view(-1)
+        errD_real = -torch.mean(output)
+        D_x = output.mean().item()
+
+        noise = torch.randn(b_size, options.latent_size, device=device)
+        fake_img, fake_feat_vec = netG(images, one_hot_labels, noise)
+        output = netD(fake_img, fake_feat_vec, training=True).view(-1)
+        errD_fake = torch.mean(output)
+        D_G_z1 = output.mean().item()
+
+        _, channel, height, width = images.shape
+        dim = one_hot_labels.shape[1]
+        alpha = torch.rand(b_size, 1, 1, 1).repeat(1, channel, height, width).to(device)
+        beta = torch.rand(b_size, 1).repeat(1, dim).to(device)
+        interpolated_image = (alpha*images) + (1-alpha) * fake_img
+        interpolated_vector = (beta*one_hot_labels) + (1-beta) * fake_feat_vec
+        interpolated_score = netD(interpolated_image, interpolated_vector, training=True)
+        gradient = torch.autograd.grad(inputs=[interpolated_image, interpolated_vector],
+                                       outputs=interpolated_score,
+                                       retain_graph=True,
+                                       create_graph=True,
+                                       grad_outputs=torch.ones_like(interpolated_score))[0]
+        gradient = gradient.view(gradient.shape[0], -1)
+        gradient_norm = torch.sqrt(torch.sum(gradient ** 2, dim=1) + 1e-12)
+        err_R = 10*torch.mean((gradient_norm-1)**2)
+
+        errD = errD_real + errD_fake + err_R
+        if it == 0:
+            errD.backward()
+        else:
+            errD.backward(create_graph=True)
+        optimizerD.step()
+
+        if it == 1:
+            backup = copy.deepcopy(netD)
+
+    netG.zero_grad()
+    output = netD(fake_img, fake_feat_vec, training=True).view(-1)
+    errG = -torch.mean(output)
+    errG.backward(retain_graph=True)
+    D_G_z2 = output.mean().item()
+    optimizerG.step()
+
+    if backup is not None:
+        netD.load(backup)
+
+    return errD.item(), errG.item(), D_x, D_G_z1, D_G_z2
+
+
+def _benchmark_worker(reference, batch_size, image_size, num_steps, queue):
+    import resource
+    import time
+
+    set_seed()
+    device = torch.device('cpu')
+    netG = Generator(modals_num=2, input_vector_dim=10, use_pretrained=False)
+    netD = Discriminator(input_vector_dim=10, keep_sigmoid=False, fuse_type=options.disc_fuse_type)
+    netG.apply(weights_init)
+    netD.apply(weights_init)
+    optimizerD = optim.Adam(netD.parameters(), lr=options.disc_lr, betas=(options.beta1, 0.999))
+    optimizerG = optim.Adam(netG.parameters(), lr=options.gen_lr, betas=(options.beta1, 0.999))
+
+    images = torch.rand(batch_size, 3, image_size, image_size) * 2 - 1
+    one_hot_labels = -torch.ones(batch_size, 10)
+    one_hot_labels[torch.arange(batch_size), torch.randint(10, (batch_size,))] = 1
+
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    times = []
+    for _ in range(num_steps):
+        since = time.time()
+        if reference:
+            _reference_train_step(netD, netG, optimizerD, optimizerG, images, one_hot_labels, device)
+        else:
+            train_step(netD, netG, optimizerD, optimizerG, images, one_hot_labels, None, device)
+        times.append(time.time() - since)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is in KB on Linux, the first step is a warm-up
+    queue.put((min(times[1:]), (peak - baseline) / 1024))
+
+
+def benchmark_train_step(batch_size=16, image_size=32, num_steps=3):
+    ''' Time per iteration and growth of the peak RSS of the wasserstein step
+    against the previous loop, on CPU with a randomly initialized G, each in a
+    fresh process. Run: python train.py --benchmark --loss_func wasserstein '''
+    import multiprocessing
+
+    context = multiprocessing.get_context('spawn')
+    for name, reference in [('previous loop', True), ('single backward', False)]:
+        queue = context.Queue()
+        process = context.Process(target=_benchmark_worker,
+                                  args=(reference, batch_size, image_size, num_steps, queue))
+        process.start()
+        step_time, peak_mb = queue.get()
+        process.join()
+        print(f'{name}: {batch_size / step_time:.1f} images/sec '
+              f'({step_time:.2f}s per iteration with {options.d_num_iters + 1} D updates), '
+              f'peak memory +{peak_mb:.0f} MB')
+
+
 if __name__ == '__main__':
+    if options.benchmark:
+        benchmark_train_step()
+        exit()
+
     set_seed() 
 
 
@@ -168,11 +378,6 @@ if __name__ == '__main__':
 
     ############################### Fixed data for visualization ##################################
 
-    # Establish convention for real and fake labels during training
-    if not options.random_lbl_smooth:
-        real_label = 1.0
-        fake_label = 0.0
-
     # Setup Adam optimizers for both G and D
     d_lr = options.disc_lr
     g_lr = options.gen_lr
@@ -208,127 +413,12 @@ if __name__ == '__main__':
             one_hot_labels[one_hot_labels == 0] = -1
             one_hot_labels = one_hot_labels.to(device)
 
-            for it in range(options.d_num_iters + 1):
-                netD.zero_grad()
-
-                ############################
-                # (1) Update D network: maximize log(D(x)) + log(1 - D(G(z)))
-                ###########################
-                ## Train with all-real batch
-                # Format batch
-                real_cpu = data[0].to(device)
-                b_size = real_cpu.size(0)
-
-                if not options.random_lbl_smooth:
-                    label = torch.full((b_size,), real_label, dtype=torch.float, device=device)
-                else:
-                    label = torch.FloatTensor(b_size, 1).uniform_(options.real_label_min,
-                                                                options.real_label_max).to(device)
-
-                # Forward pass real batch through D
-                output = netD(real_cpu, one_hot_labels, training=True).view(-1)
-
-                # Calculate loss on all-real batch
-                if options.loss_func == 'minmax':
-                    errD_real = criterion(output, label)
-                elif options.loss_func == 'wasserstein':
-                    errD_real = -torch.mean(output)
-
-                if options.loss_func == 'minmax':
-                    # Calculate gradients for D in backward pass
-                    errD_real.backward(retain_graph=True)
-
-                D_x = output.mean().item()
-
-                ## Train with all-fake batch
-                # Generate batch of latent vectors
-                # noise = torch.randn(b_size, nz, 1, 1, device=device)
-                noise = torch.randn(b_size, nz, device=device)
-                # Generate fake image batch with G
-                fake_img, fake_feat_vec = netG(real_cpu, one_hot_labels, noise)
-
-                # label.fill_(fake_label)
-
-                if not options.random_lbl_smooth:
-                    label = torch.full((b_size,), fake_label, dtype=torch.float, device=device)
-                else:
-                    label = torch.FloatTensor(b_size, 1).uniform_(options.fake_label_min,
-                                                                options.fake_label_max).to(device)
-
-                # Classify all fake batch with D
-                output = netD(fake_img, fake_feat_vec, training=True).view(-1)
-
-                # Calculate D's loss on the all-fake batch
-                if options.loss_func == 'minmax':
-                    errD_fake = criterion(output, label)
-                elif options.loss_func == 'wasserstein':
-                    errD_fake = torch.mean(output)
-
-                if options.loss_func == 'minmax':
-                    # Calculate the gradients for this batch, accumulated (summed) with previous gradients
-                    errD_fake.backward(retain_graph=True)
-
-                D_G_z1 = output.mean().item()
-
-
-                if options.loss_func == 'wasserstein':
-                    gp = gradient_penalty(netD, real_cpu, one_hot_labels,
-                                        fake_img, fake_feat_vec, device)
-                    err_R = 10*gp
-
-
-                # Compute error of D as sum over the fake and the real batches
-                errD = errD_real + errD_fake + err_R
-                # errD = errD_real + errD_fake
-
-                if it == 0:
-                    errD.backward()
-                else:
-                    errD.backward(create_graph=True)
-
-                # Update D
-                optimizerD.step()
-
-                # Clamp data for Wasserstein Loss
-                # for p in netD.parameters():
-                #     p.data.clamp_(-0.01, 0.01)
-
-                if it == 1:
-                    backup = copy.deepcopy(netD)
-
-
-            ############################
-            # (2) Update G network: maximize log(D(G(z)))
-            ###########################
-            netG.zero_grad()
-
-            # label.fill_(real_label)  # fake labels are real for generator cost
-            if not options.random_lbl_smooth:
-                label = torch.full((b_size,), real_label, dtype=torch.float, device=device)
-            else:
-                label = torch.FloatTensor(b_size, 1).uniform_(options.real_label_min,
-                                                              options.real_label_max).to(device)
-
-            # Since we just updated D, perform another forward pass of all-fake batch through D
-            output = netD(fake_img, fake_feat_vec, training=True).view(-1)
-
-            # Calculate G's loss based on this output
-            if options.loss_func == 'minmax':
-                errG = criterion(output, label)
-            elif options.loss_func == 'wasserstein':
-                errG = -torch.mean(output)
-
-            # Calculate gradients for G
-            errG.backward(retain_graph=True)
-            D_G_z2 = output.mean().item()
-            # Update G
-            optimizerG.step()
-
-            netD.load(backup)    
-            del backup
+            errD, errG, D_x, D_G_z1, D_G_z2 = train_step(netD, netG, optimizerD, optimizerG,
+                                                          images.to(device), one_hot_labels,
+                                                          criterion, device)
 
-            writer.add_scalar('Loss_D', errD.item(), iters)
-            writer.add_scalar('Loss_G', errG.item(), iters)
+            writer.add_scalar('Loss_D', errD, iters)
+            writer.add_scalar('Loss_G', errG, iters)
             writer.add_scalar('D(x)', D_x, iters)
             writer.add_scalar('D(G(z))', D_G_z1, iters)
             writer.add_scalar('D(G(z))', D_G_z2, iters)
@@ -338,14 +428,14 @@ if __name__ == '__main__':
             if i % 50 == 0:
                 print('[%d/%d][%d/%d]\tLoss_D: %.4f\tLoss_G: %.4f\tD(x): %.4f\tD(G(z)): %.4f / %.4f'
                     % (epoch, num_epochs, i, len(trainloader),
-                        errD.item(), errG.item(), D_x, D_G_z1, D_G_z2))
+                        errD, errG, D_x, D_G_z1, D_G_z2))
                 logging.info('[%d/%d][%d/%d]\tLoss_D: %.4f\tLoss_G: %.4f\tD(x): %.4f\tD(G(z)): %.4f / %.4f'
                     % (epoch, num_epochs, i, len(trainloader),
-                        errD.item(), errG.item(), D_x, D_G_z1, D_G_z2))
+                        errD, errG, D_x, D_G_z1, D_G_z2))
 
             # Save Losses for plotting later
-            G_losses.append(errG.item())
-            D_losses.append(errD.item())
+            G_losses.append(errG)
+            D_losses.append(errD)
 
             # # Check how the generator is doing by saving G's output on fixed_noise
             if (iters % 500 == 0) or ((epoch == num_epochs-1) and (i == len(trainloader)-1)):
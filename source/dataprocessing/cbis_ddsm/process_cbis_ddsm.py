@@ -8,13 +8,18 @@ import pandas as pd
 import warnings
 import math
 import shutil
+import time
+import json
+import functools
+import multiprocessing
 
 from config.cfg_loader import proj_paths_json
 from pycocotools import mask as coco_api_mask
 from sklearn.model_selection import StratifiedShuffleSplit
 from utilities.detectutil import bbox_util
+from utilities.datautil.lesion_index import LesionIndex
+from dataprocessing.convert_dicom2png import window_image
 from PIL import Image
-from scipy import stats
 from natsort import natsorted
 
 
@@ -48,12 +53,9 @@ def convert_npz_to_png(data_path, preprocessing=None):
                 mamm_img = np.load(os.path.join(dir, "image.npz"),
                                 allow_pickle=True)["image"]
                 if preprocessing == 'mode_norm':
-                    flat_img = mamm_img.flatten() 
-                    flat_img = flat_img[flat_img != 0]
-                    mode = stats.mode(flat_img).mode# ignore background value 0
-                    # mamm_img = np.clip(mamm_img, mode-500, mode+800) # for INbreast from the paper
-                    mamm_img = np.clip(mamm_img, mode-8000, mode+12800) # INbreast pixels value are from 0 to 4095
-                                                                          # CBIS_DDSM pixels value are from 0 to 65535
+                    # mode_window=(500, 800) for INbreast from the paper
+                    mamm_img = window_image(mamm_img, mode_window=(8000, 12800)) # INbreast pixels value are from 0 to 4095
+                                                                                  # CBIS_DDSM pixels value are from 0 to 65535
 
                 cv2.imwrite(save_path, mamm_img)
 
@@ -83,17 +85,6 @@ def area(_mask):
     return area
 
 
-def get_info_lesion(df, ROI_ID):
-    _, _, patient_id, left_or_right, image_view, abnormality_id = ROI_ID.split(
-        '_')
-    rslt_df = df[(df['patient_id'] == ('P_' + patient_id)) &
-                 (df['left or right breast'] == left_or_right) &
-                 (df['image view'] == image_view) &
-                 (df['abnormality id'] == int(abnormality_id))]
-
-    return rslt_df
-
-
 def convert_ddsm_to_coco(categories, out_file, data_root, annotation_filepath, extend_bb_ratio=None, keep_org_boxes=False, rgb_img=False, return_size_rate=1.0):
     '''
     Args:
@@ -112,6 +103,7 @@ def convert_ddsm_to_coco(categories, out_file, data_root, annotation_filepath, e
     obj_count = 0
 
     df = pandas.read_csv(annotation_filepath)
+    lesion_index = LesionIndex(df)
 
     total_imgs = len(glob.glob(os.path.join(data_root, '*')))
 
@@ -153,13 +145,13 @@ def convert_ddsm_to_coco(categories, out_file, data_root, annotation_filepath, e
         for mask_path in glob.glob(dir_path + '_*'):
             roi_idx = mask_path.split('_')[-1]
 
-            rslt_df = get_info_lesion(df, f'{filename}_{roi_idx}')
+            roi_id = f'{filename}_{roi_idx}'
 
-            if len(rslt_df) == 0:
-                print(f'No ROI was found for ROI_ID: {filename}_{roi_idx}')
+            if roi_id not in lesion_index:
+                print(f'No ROI was found for ROI_ID: {roi_id}')
                 continue
 
-            label = rslt_df['pathology'].to_numpy()[0]
+            label = lesion_index.get(roi_id, 'pathology')
             if label == 'MALIGNANT':
                 cat_id = 0
             elif label in ['BENIGN', 'BENIGN_WITHOUT_CALLBACK']:
@@ -250,196 +242,313 @@ def convert_ddsm_to_coco(categories, out_file, data_root, annotation_filepath, e
     mmcv.dump(coco_format_json, os.path.join(data_root, out_file))
 
 
+PATCH_STAGES = ['decode', 'contour', 'crop', 'encode']
+
+
+def read_roi_mask(mask_path):
+    '''
+    A CBIS-DDSM mask directory holds the binary ROI mask and the cropped lesion
+    as 000000.png/000001.png in no fixed order. The candidates are listed with a
+    single glob and decoded at most once each, in the order 000001.png,
+    000000.png, second 000000.png, until a binary one is found.
+    '''
+    png_paths = glob.glob(os.path.join(mask_path, '**', '**', '*.png'))
+    candidates = [path for path in png_paths if os.path.basename(path) == '000001.png'][:1] + \
+                 [path for path in png_paths if os.path.basename(path) == '000000.png'][:2]
+
+    mask_arr = None
+    for candidate in candidates:
+        mask_arr = cv2.imread(candidate, cv2.IMREAD_GRAYSCALE)
+        # same as len(np.unique(mask_arr)) == 2 for uint8 images, without sorting
+        if np.count_nonzero(np.bincount(mask_arr.ravel(), minlength=256)) == 2:
+            break
+
+    return mask_arr
+
+
+def lesion_bbox(mask_arr):
+    seg_poly = mask2polygon(mask_arr)
+
+    flat_seg_poly = [el for sublist in seg_poly for el in sublist]
+    px = flat_seg_poly[::2]
+    py = flat_seg_poly[1::2]
+    return (min(px), min(py), max(px), max(py))
+
+
+def crop_lesion_patch(img, bbox, patch_ext):
+    height, width = img.shape[:2]
+    x_min, y_min, x_max, y_max = bbox
+
+    if patch_ext == 'center':
+        patch_width = x_max - x_min + 1
+        patch_height = y_max - y_min + 1
+
+        center_x = (x_min + x_max)/2.0
+        center_y = (y_min + y_max)/2.0
+
+        patch_size = max(patch_width, patch_height)
+
+        new_x_min = max(0, int(center_x - patch_size/2))
+        new_y_min = max(0, int(center_y - patch_size/2))
+        new_x_max = min(int(width), int(center_x + patch_size/2))
+        new_y_max = min(int(height), int(center_y + patch_size/2))
+
+    if patch_ext == 'exact':
+        lesion_patch = img[y_min:(y_max+1), x_min:(x_max+1)]
+    elif patch_ext == 'center':
+        lesion_patch = img[new_y_min:(new_y_max+1), new_x_min:(new_x_max+1)]
+        pad_width_size = patch_size - (new_x_max - new_x_min)
+        pad_height_size = patch_size - (new_y_max - new_y_min)
+
+        lesion_patch = np.pad(lesion_patch,
+                            [(pad_height_size//2, pad_height_size - pad_height_size//2),
+                             (pad_width_size//2, pad_width_size - pad_width_size//2),
+                             (0, 0)], 'constant')
+
+    return lesion_patch
+
+
+def _write_patch(save_dir, save_name, patch, timings, patch_paths, overwrite=True):
+    save_path = os.path.join(save_dir, save_name)
+    if overwrite or not os.path.exists(save_path):
+        os.makedirs(save_dir, exist_ok=True)
+        since = time.time()
+        cv2.imwrite(save_path, patch)
+        timings['encode'] += time.time() - since
+    if save_path not in patch_paths:
+        patch_paths.append(save_path)
+
+
+# Lesion index of the annotation csv, built once per worker process
+_worker_lesion_index = None
+
+
+def _init_patch_worker(annotation_filepath):
+    global _worker_lesion_index
+    _worker_lesion_index = LesionIndex.from_csv(annotation_filepath)
+
+
+def _manifest_settings(worker, dir_paths, annotation_filepath, kwargs, extra_settings=None):
+    ''' Everything the written patches depend on, as stored in the manifest header '''
+    settings = {'worker': worker.__name__,
+                'data_roots': sorted({os.path.dirname(os.path.abspath(dir_path))
+                                      for dir_path in dir_paths}),
+                'annotation_filepath': os.path.abspath(annotation_filepath),
+                'annotation_mtime_ns': os.stat(annotation_filepath).st_mtime_ns,
+                'options': kwargs,
+                'extra': extra_settings}
+    # same types as once read back from the manifest
+    return json.loads(json.dumps(settings))
+
+
+def _read_manifest(manifest_path, settings):
+    ''' Mammograms already done by a run with the same settings '''
+    done = set()
+    if not os.path.exists(manifest_path):
+        return done
+
+    with open(manifest_path) as f:
+        header_line = f.readline()
+        if not header_line:
+            return done
+        try:
+            header = json.loads(header_line)
+        except ValueError:
+            header = {}
+        previous = header.get('settings')
+        if previous != settings:
+            if previous is None:
+                changed = 'unknown settings'
+            else:
+                changed = ', '.join(f'{key}: {previous.get(key)} -> {value}'
+                                    for key, value in settings.items()
+                                    if previous.get(key) != value)
+            raise ValueError(f'{manifest_path} was written by a run with other settings '
+                             f'({changed}), resuming would mix their patches: delete the '
+                             f'manifest and the patches to rebuild, or use another root')
+
+        for line in f:
+            try:
+                done.add(json.loads(line)['mammogram'])
+            except ValueError:
+                pass # last line of an interrupted run
+    return done
+
+
+def run_patch_extraction(worker, dir_paths, annotation_filepath, manifest_path,
+                         num_workers=1, manifest_settings=None, **kwargs):
+    '''
+    Run worker(dir_path, **kwargs) for every mammogram directory, sharded over
+    a pool of num_workers processes.
+
+    Every finished mammogram is appended to the manifest (one json line with
+    the written patches), mammograms already in it are skipped, so an
+    interrupted run resumes where it stopped. The first line of the manifest
+    holds the settings of the run (worker, data root, annotation file and
+    kwargs, plus manifest_settings for what the worker does not receive):
+    resuming with other settings raises a ValueError instead of mixing
+    patches. Delete the manifest to rebuild.
+
+    Returns:
+    seconds spent in each of PATCH_STAGES, summed over the workers
+    '''
+    settings = _manifest_settings(worker, dir_paths, annotation_filepath, kwargs,
+                                  manifest_settings)
+    done = _read_manifest(manifest_path, settings)
+
+    dir_paths = [dir_path for dir_path in dir_paths
+                 if os.path.basename(dir_path) not in done]
+
+    timings = dict.fromkeys(PATCH_STAGES, 0.0)
+    num_patches = 0
+    since = time.time()
+
+    job = functools.partial(worker, **kwargs)
+    if num_workers > 1:
+        pool = multiprocessing.Pool(num_workers, initializer=_init_patch_worker,
+                                    initargs=(annotation_filepath,))
+        results = pool.imap_unordered(job, dir_paths)
+    else:
+        pool = None
+        _init_patch_worker(annotation_filepath)
+        results = map(job, dir_paths)
+
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_path)), exist_ok=True)
+    if not os.path.exists(manifest_path) or os.path.getsize(manifest_path) == 0:
+        with open(manifest_path, 'w') as manifest:
+            manifest.write(json.dumps({'settings': settings}) + '\n')
+    try:
+        with open(manifest_path, 'a') as manifest:
+            for filename, patch_paths, mamm_timings in \
+                    mmcv.track_iter_progress((results, len(dir_paths))):
+                for stage in PATCH_STAGES:
+                    timings[stage] += mamm_timings[stage]
+                num_patches += len(patch_paths)
+
+                manifest.write(json.dumps({'mammogram': filename,
+                                           'patches': patch_paths}) + '\n')
+                manifest.flush()
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    elapsed = time.time() - since
+    print(f'{len(dir_paths)} mammograms ({len(done)} skipped from {manifest_path}), '
+          f'{num_patches} patches in {elapsed:.1f}s with {num_workers} worker(s)')
+    for stage in PATCH_STAGES:
+        print(f'{stage:>8}: {timings[stage]:.1f}s '
+              f'({timings[stage] / max(len(dir_paths), 1) * 1e3:.1f} ms/mammogram)')
+
+    return timings
+
+
+def _mammogram_dirs(data_root):
+    return [dir_path for dir_path in glob.glob(os.path.join(data_root, '*'))
+            # skip mask directories
+            if os.path.basename(dir_path).split('_')[-1] in ['CC', 'MLO']]
+
+
+# annotation columns of the two lesion features and the breast density, per lesion type
+LESION_FEATURE_COLUMNS = {
+    'mass': ('mass shape', 'mass margins', 'breast_density'),
+    'calc': ('calc type', 'calc distribution', 'breast density'),
+}
+
+
 def get_lesions_feature(feat1_root, feat2_root, feat3_root, data_root,
                         annotation_filepath, lesion_type, segmented=False,
-                        add_mask_channel=False, patch_ext='center'):
+                        add_mask_channel=False, patch_ext='center',
+                        num_workers=1, manifest_path=None):
     '''
     1) If lesion type is 'mass', we have 4 features: Mass Shape, Mass Margins, Breast Density Lesion-Level, Breast Density Image-Level
     2) Else if lesion type is 'calcification', we have 4 features: Calc Type, Calc Distribution, Breast Density Lesion-Level, Breast Density Image-Level
     '''
+    if lesion_type not in LESION_FEATURE_COLUMNS:
+        raise ValueError(f'Lesion type: {lesion_type} is unrecognized, '
+                         f'expected one of {list(LESION_FEATURE_COLUMNS)}')
 
-    df = pandas.read_csv(annotation_filepath)
+    if manifest_path is None:
+        manifest_path = os.path.join(feat1_root, '.manifest.jsonl')
 
-    for idx, dir_path in enumerate(mmcv.track_iter_progress(glob.glob(os.path.join(data_root, '*')))):
-        filename = os.path.basename(dir_path)
-        if filename.split('_')[-1] not in ['CC', 'MLO']: # skip mask directories
-            continue
+    return run_patch_extraction(_extract_feature_patches, _mammogram_dirs(data_root),
+                                annotation_filepath, manifest_path, num_workers,
+                                feat1_root=feat1_root, feat2_root=feat2_root,
+                                feat3_root=feat3_root, lesion_type=lesion_type,
+                                segmented=segmented, add_mask_channel=add_mask_channel,
+                                patch_ext=patch_ext)
 
-        img_path = glob.glob(os.path.join(dir_path, '**', '**', '000000.png'))[0]
-        if not os.path.exists(img_path):
-            continue
 
-        img = mmcv.imread(img_path)
-        height, width = img.shape[:2]
+def _extract_feature_patches(dir_path, feat1_root, feat2_root, feat3_root, lesion_type,
+                             segmented, add_mask_channel, patch_ext):
+    lesion_index = _worker_lesion_index
+    timings = dict.fromkeys(PATCH_STAGES, 0.0)
+    patch_paths = []
 
-        # for roi_idx, mask_path in enumerate(glob.glob(os.path.join(dir_path, 'mask*.npz'))):
-        for mask_path in glob.glob(dir_path + '_*'):
-            roi_idx = mask_path.split('_')[-1]
+    filename = os.path.basename(dir_path)
 
-            rslt_df = get_info_lesion(df, f'{filename}_{roi_idx}')
+    since = time.time()
+    img_path = glob.glob(os.path.join(dir_path, '**', '**', '000000.png'))[0]
+    img = mmcv.imread(img_path)
+    timings['decode'] += time.time() - since
 
-            if len(rslt_df) == 0:
-                print(f'No ROI was found for ROI_ID: {filename}_{roi_idx}')
-                continue
+    # for roi_idx, mask_path in enumerate(glob.glob(os.path.join(dir_path, 'mask*.npz'))):
+    for mask_path in glob.glob(dir_path + '_*'):
+        roi_idx = mask_path.split('_')[-1]
 
-            label = rslt_df['pathology'].to_numpy()[0]
-            if label == 'MALIGNANT':
-                cat_id = 0
-            elif label in ['BENIGN', 'BENIGN_WITHOUT_CALLBACK']:
-                cat_id = 1
-            # else:
-            #     raise ValueError(
-            #         f'Label: {label} is unrecognized for ROI_ID: {filename}_{roi_idx}')
+        roi_id = f'{filename}_{roi_idx}'
 
+        if roi_id not in lesion_index:
+            print(f'No ROI was found for ROI_ID: {roi_id}')
+            continue
 
-            # if roi_idx == 100:
-            #     print(f'ROI features contain NA or combined type: {filename}')
-            #     break
+        since = time.time()
+        mask_arr = read_roi_mask(mask_path)
+        timings['decode'] += time.time() - since
 
-            # mask_arr = np.load(mask_path, allow_pickle=True)["mask"]
-            mask_paths = glob.glob((os.path.join(mask_path, '**', '**', '000001.png')))
-            if len(mask_paths) != 0:
-                mask_arr = cv2.imread(mask_paths[0], cv2.IMREAD_GRAYSCALE)
+        if img.shape[:2] != mask_arr.shape[:2]:
+            print('[+] Image and mask resolutions do not match')
+            continue
 
-            if len(np.unique(mask_arr)) != 2:
-                mask_paths = glob.glob((os.path.join(mask_path, '**', '**', '000000.png')))
-                mask_arr = cv2.imread(mask_paths[0], cv2.IMREAD_GRAYSCALE)
+        since = time.time()
+        x_min, y_min, x_max, y_max = bbox = lesion_bbox(mask_arr)
+        timings['contour'] += time.time() - since
 
-            if len(np.unique(mask_arr)) != 2:
-                mask_arr = cv2.imread(mask_paths[1], cv2.IMREAD_GRAYSCALE)
+        since = time.time()
+        if segmented:
+            img = cv2.bitwise_and(img, img, mask=mask_arr)
 
-            if img.shape[:2] != mask_arr.shape[:2]:
-                print('[+] Image and mask resolutions do not match')
-                continue
+        lesion_patch = crop_lesion_patch(img, bbox, patch_ext)
 
-            seg_poly = mask2polygon(mask_arr)
-            seg_area = area(mask_arr)
+        if add_mask_channel:
+            mask_patch = mask_arr[y_min:(y_max+1), x_min:(x_max+1)]
+            lesion_patch[:,:,2] = mask_patch
+        timings['crop'] += time.time() - since
 
-            flat_seg_poly = [el for sublist in seg_poly for el in sublist]
-            px = flat_seg_poly[::2]
-            py = flat_seg_poly[1::2]
-            x_min, y_min, x_max, y_max = (min(px), min(py), max(px), max(py))
+        feat1, feat2, density = LESION_FEATURE_COLUMNS[lesion_type]
+
+        # remove NAN
+        feat1_value = lesion_index.get(roi_id, feat1)
+        if isinstance(feat1_value, str):
+            _write_patch(os.path.join(feat1_root, feat1_value), f'{filename}_{roi_idx}.png',
+                         lesion_patch, timings, patch_paths, overwrite=False)
 
-            if patch_ext == 'center':
-                patch_width = x_max - x_min + 1
-                patch_height = y_max - y_min + 1
-
-                center_x = (x_min + x_max)/2.0
-                center_y = (y_min + y_max)/2.0
-
-                patch_size = max(patch_width, patch_height)
-
-                new_x_min = max(0, int(center_x - patch_size/2))
-                new_y_min = max(0, int(center_y - patch_size/2))
-                new_x_max = min(int(width), int(center_x + patch_size/2))
-                new_y_max = min(int(height), int(center_y + patch_size/2))
-
-
-            if segmented:
-                img = cv2.bitwise_and(img, img, mask=mask_arr)
-
-            if patch_ext == 'exact':
-                lesion_patch = img[y_min:(y_max+1), x_min:(x_max+1)]
-            elif patch_ext == 'center':
-                lesion_patch = img[new_y_min:(new_y_max+1), new_x_min:(new_x_max+1)]
-                pad_width_size = patch_size - (new_x_max - new_x_min)
-                pad_height_size = patch_size - (new_y_max - new_y_min)
-
-                lesion_patch = np.pad(lesion_patch,
-                                    [(pad_height_size//2, pad_height_size - pad_height_size//2),
-                                     (pad_width_size//2, pad_width_size - pad_width_size//2),
-                                     (0, 0)], 'constant')
-
-
-
-            if add_mask_channel:
-                mask_patch = mask_arr[y_min:(y_max+1), x_min:(x_max+1)]
-                lesion_patch[:,:,2] = mask_patch
-
-            if lesion_type == 'mass':
-                mass_shape = rslt_df['mass shape'].to_numpy()[0]
-                # remove NAN
-                if isinstance(mass_shape, str):
-                    mass_shape_save_path = os.path.join(
-                        feat1_root, mass_shape)
-                    save_mass_shape_lesion_path = os.path.join(
-                        mass_shape_save_path,  f'{filename}_{roi_idx}.png')
-                    if not os.path.exists(save_mass_shape_lesion_path):
-                        os.makedirs(mass_shape_save_path, exist_ok=True)
-                        cv2.imwrite(save_mass_shape_lesion_path, lesion_patch)
-
-                mass_margins = rslt_df['mass margins'].to_numpy()[0]
-                # remove NAN
-                if isinstance(mass_margins, str):
-                    mass_margins_save_path = os.path.join(
-                        feat2_root, mass_margins)
-
-                    save_mass_margins_lesion_path = os.path.join(
-                        mass_margins_save_path,  f'{filename}_{roi_idx}.png')
-                    if not os.path.exists(save_mass_margins_lesion_path):
-                        os.makedirs(mass_margins_save_path, exist_ok=True)
-                        cv2.imwrite(save_mass_margins_lesion_path, lesion_patch)
-
-                mass_density = rslt_df['breast_density'].to_numpy()[0]
-                # remove NAN
-                if isinstance(mass_density, np.int64):
-                    # mass_density_save_path = os.path.join(feat3_root, str(mass_density))
-                    # save_mass_density_lesion_path = os.path.join(mass_density_save_path, f'{filename}_{roi_idx}.png')
-                    # if not os.path.exists(save_mass_density_lesion_path):
-                    #     os.makedirs(mass_density_save_path, exist_ok=True)
-                    #     cv2.imwrite(save_mass_density_lesion_path, lesion_patch)
-
-                    # if feat4_root is not None:
-                    mass_density_img_save_path = os.path.join(feat3_root, str(mass_density))
-                    save_mass_density_img_path = os.path.join(mass_density_img_save_path, f'{filename}.png')
-                    if not os.path.exists(save_mass_density_img_path):
-                        os.makedirs(mass_density_img_save_path, exist_ok=True)
-                        cv2.imwrite(save_mass_density_img_path, img)
-
-            elif lesion_type == 'calc':
-                calc_type = rslt_df['calc type'].to_numpy()[0]
-                # remove NAN
-                if isinstance(calc_type, str):
-                    calc_type_save_path = os.path.join(
-                        feat1_root, calc_type)
-                    save_calc_type_lesion_path = os.path.join(
-                        calc_type_save_path,  f'{filename}_{roi_idx}.png')
-                    if not os.path.exists(save_calc_type_lesion_path):
-                        os.makedirs(calc_type_save_path, exist_ok=True)
-                        cv2.imwrite(save_calc_type_lesion_path, lesion_patch)
-
-                calc_dist = rslt_df['calc distribution'].to_numpy()[0]
-                # remove NAN
-                if isinstance(calc_dist, str):
-                    calc_dist_save_path = os.path.join(
-                        feat2_root, calc_dist)
-
-                    save_calc_dist_lesion_path = os.path.join(
-                        calc_dist_save_path,  f'{filename}_{roi_idx}.png')
-                    if not os.path.exists(save_calc_dist_lesion_path):
-                        os.makedirs(calc_dist_save_path, exist_ok=True)
-                        cv2.imwrite(save_calc_dist_lesion_path, lesion_patch)
-
-                calc_density = rslt_df['breast density'].to_numpy()[0]
-                # remove NAN
-                if isinstance(calc_density, np.int64):
-                    # calc_density_save_path = os.path.join(feat3_root, str(calc_density))
-
-                    # save_calc_density_lesion_path = os.path.join(calc_density_save_path, f'{filename}_{roi_idx}.png')
-                    # if not os.path.exists(save_calc_density_lesion_path):
-                    #     os.makedirs(calc_density_save_path, exist_ok=True)
-                    #     cv2.imwrite(save_calc_density_lesion_path, lesion_patch)
-
-                    # if feat4_root is not None:
-                    calc_density_img_save_path = os.path.join(feat3_root, str(calc_density))
-                    save_calc_density_img_path = os.path.join(calc_density_img_save_path, f'{filename}.png')
-                    if not os.path.exists(save_calc_density_img_path):
-                        os.makedirs(calc_density_img_save_path, exist_ok=True)
-                        cv2.imwrite(save_calc_density_img_path, img)
+        feat2_value = lesion_index.get(roi_id, feat2)
+        if isinstance(feat2_value, str):
+            _write_patch(os.path.join(feat2_root, feat2_value), f'{filename}_{roi_idx}.png',
+                         lesion_patch, timings, patch_paths, overwrite=False)
+
+        density_value = lesion_index.get(roi_id, density)
+        if isinstance(density_value, np.int64):
+            # image-level breast density, the lesion-level one is not extracted anymore
+            _write_patch(os.path.join(feat3_root, str(density_value)), f'{filename}.png',
+                         img, timings, patch_paths, overwrite=False)
+
+    return filename, patch_paths, timings
 
 
 def stoa_get_lesions_pathology(save_root, data_root, annotation_filename, lesion_type, new_size=(896, 1152), patch_size=224):
     df = pandas.read_csv(os.path.join(data_root, annotation_filename))
+    lesion_index = LesionIndex(df)
 
     for idx, dir_path in enumerate(mmcv.track_iter_progress(glob.glob(os.path.join(data_root, '*')))):
         filename = os.path.basename(dir_path)
@@ -459,13 +568,13 @@ def stoa_get_lesions_pathology(save_root, data_root, annotation_filename, lesion
                     break
                 roi_idx += 1
 
-                rslt_df = get_info_lesion(df, f'{filename}_{roi_idx}')
+                roi_id = f'{filename}_{roi_idx}'
 
-                if len(rslt_df) == 0:
-                    print(f'No ROI was found for ROI_ID: {filename}_{roi_idx}')
+                if roi_id not in lesion_index:
+                    print(f'No ROI was found for ROI_ID: {roi_id}')
                     continue
 
-                label = rslt_df['pathology'].to_numpy()[0]
+                label = lesion_index.get(roi_id, 'pathology')
                 if label == 'MALIGNANT':
                     cat_id = 0
                 elif label in ['BENIGN', 'BENIGN_WITHOUT_CALLBACK']:
@@ -525,116 +634,88 @@ def stoa_get_lesions_pathology(save_root, data_root, annotation_filename, lesion
 
 def get_lesions_pathology(save_root, data_root, annotation_filepath, lesion_type,
                           histeq=False, equalization_type='he', patch_ext='center',
-                          birads34_only=False):
-    df = pandas.read_csv(annotation_filepath)
-
-    for idx, dir_path in enumerate(mmcv.track_iter_progress(glob.glob(os.path.join(data_root, '*')))):
-        filename = os.path.basename(dir_path)
-        if filename.split('_')[-1] not in ['CC', 'MLO']: # skip mask directories
-            continue
-        img_path = glob.glob(os.path.join(dir_path, '**', '**', '000000.png'))[0]
-        if not os.path.exists(img_path):
+                          birads34_only=False, num_workers=1, manifest_path=None):
+    if manifest_path is None:
+        manifest_path = os.path.join(save_root, '.manifest.jsonl')
+
+    return run_patch_extraction(_extract_pathology_patches, _mammogram_dirs(data_root),
+                                annotation_filepath, manifest_path, num_workers,
+                                manifest_settings={'lesion_type': lesion_type},
+                                save_root=save_root, histeq=histeq,
+                                equalization_type=equalization_type,
+                                patch_ext=patch_ext, birads34_only=birads34_only)
+
+
+def _extract_pathology_patches(dir_path, save_root, histeq, equalization_type, patch_ext,
+                               birads34_only):
+    lesion_index = _worker_lesion_index
+    timings = dict.fromkeys(PATCH_STAGES, 0.0)
+    patch_paths = []
+
+    filename = os.path.basename(dir_path)
+
+    since = time.time()
+    img_path = glob.glob(os.path.join(dir_path, '**', '**', '000000.png'))[0]
+    img = mmcv.imread(img_path)
+
+    if histeq:
+        if equalization_type == 'he':
+            img = mmcv.image.photometric.imequalize(img)
+        elif equalization_type == 'clahe':
+            # Currently getting error due to
+            # "assert img.ndim == 2"
+            img = mmcv.image.photometric.clahe(img)
+    timings['decode'] += time.time() - since
+
+    # for roi_idx, mask_path in enumerate(glob.glob(os.path.join(dir_path, 'mask*.npz'))):
+    for mask_path in glob.glob(dir_path + '_*'):
+        roi_idx = mask_path.split('_')[-1]
+
+        roi_id = f'{filename}_{roi_idx}'
+
+        if roi_id not in lesion_index:
+            print(f'No ROI was found for ROI_ID: {roi_id}')
             continue
 
-        img = mmcv.imread(img_path)
-        height, width = img.shape[:2]
+        label = lesion_index.get(roi_id, 'pathology')
+        if label == 'MALIGNANT':
+            cat_id = 0
+        elif label in ['BENIGN', 'BENIGN_WITHOUT_CALLBACK']:
+            cat_id = 1
 
-        if histeq:
-            if equalization_type == 'he':
-                img = mmcv.image.photometric.imequalize(img)
-            elif equalization_type == 'clahe':
-                # Currently getting error due to
-                # "assert img.ndim == 2"
-                img = mmcv.image.photometric.clahe(img)
+        if birads34_only:
+            birad = lesion_index.get(roi_id, 'assessment')
 
-        # for roi_idx, mask_path in enumerate(glob.glob(os.path.join(dir_path, 'mask*.npz'))):
-        for mask_path in glob.glob(dir_path + '_*'):
-            roi_idx = mask_path.split('_')[-1]
-
-            rslt_df = get_info_lesion(df, f'{filename}_{roi_idx}')
-
-            if len(rslt_df) == 0:
-                print(f'No ROI was found for ROI_ID: {filename}_{roi_idx}')
+            if birad not in [3, 4]:
                 continue
+        # else:
+        #     raise ValueError(
+        #         f'Label: {label} is unrecognized for ROI_ID: {filename}_{roi_idx}')
 
-            label = rslt_df['pathology'].to_numpy()[0]
-            if label == 'MALIGNANT':
-                cat_id = 0
-            elif label in ['BENIGN', 'BENIGN_WITHOUT_CALLBACK']:
-                cat_id = 1
-
-            if birads34_only:
-                birad = rslt_df['assessment'].to_numpy()[0]
-
-                if birad not in [3, 4]:
-                    continue
-            # else:
-            #     raise ValueError(
-            #         f'Label: {label} is unrecognized for ROI_ID: {filename}_{roi_idx}')
+        since = time.time()
+        mask_arr = read_roi_mask(mask_path)
+        timings['decode'] += time.time() - since
 
-            # if roi_idx == 100:
-            #     print(f'ROI features contain NA or combined type: {filename}')
-            #     break
-
-            # mask_arr = np.load(mask_path, allow_pickle=True)["mask"]
-
-            mask_paths = glob.glob((os.path.join(mask_path, '**', '**', '000001.png')))
-            if len(mask_paths) != 0:
-                mask_arr = cv2.imread(mask_paths[0], cv2.IMREAD_GRAYSCALE)
-
-            if len(np.unique(mask_arr)) != 2:
-                mask_paths = glob.glob((os.path.join(mask_path, '**', '**', '000000.png')))
-                mask_arr = cv2.imread(mask_paths[0], cv2.IMREAD_GRAYSCALE)
-
-            if len(np.unique(mask_arr)) != 2:
-                mask_arr = cv2.imread(mask_paths[1], cv2.IMREAD_GRAYSCALE)
-
-            if img.shape[:2] != mask_arr.shape[:2]:
-                print('[+] Image and mask resolutions do not match')
-                continue
-
-            seg_poly = mask2polygon(mask_arr)
-            seg_area = area(mask_arr)
-
-            flat_seg_poly = [el for sublist in seg_poly for el in sublist]
-            px = flat_seg_poly[::2]
-            py = flat_seg_poly[1::2]
-            x_min, y_min, x_max, y_max = (min(px), min(py), max(px), max(py))
-
-            if patch_ext == 'center':
-                patch_width = x_max - x_min + 1
-                patch_height = y_max - y_min + 1
-
-                center_x = (x_min + x_max)/2.0
-                center_y = (y_min + y_max)/2.0
-
-                patch_size = max(patch_width, patch_height)
+        if img.shape[:2] != mask_arr.shape[:2]:
+            print('[+] Image and mask resolutions do not match')
+            continue
 
-                new_x_min = max(0, int(center_x - patch_size/2))
-                new_y_min = max(0, int(center_y - patch_size/2))
-                new_x_max = min(int(width), int(center_x + patch_size/2))
-                new_y_max = min(int(height), int(center_y + patch_size/2))
+        since = time.time()
+        bbox = lesion_bbox(mask_arr)
+        timings['contour'] += time.time() - since
 
+        since = time.time()
+        lesion_patch = crop_lesion_patch(img, bbox, patch_ext)
+        timings['crop'] += time.time() - since
 
-            if patch_ext == 'exact':
-                lesion_patch = img[y_min:(y_max+1), x_min:(x_max+1)]
-            elif patch_ext == 'center':
-                lesion_patch = img[new_y_min:(new_y_max+1), new_x_min:(new_x_max+1)]
-                pad_width_size = patch_size - (new_x_max - new_x_min)
-                pad_height_size = patch_size - (new_y_max - new_y_min)
+        if cat_id == 0:
+            save_path = os.path.join(save_root, 'MALIGNANT')
+        elif cat_id == 1:
+            save_path = os.path.join(save_root, 'BENIGN')
 
-                lesion_patch = np.pad(lesion_patch,
-                                    [(pad_height_size//2, pad_height_size - pad_height_size//2),
-                                     (pad_width_size//2, pad_width_size - pad_width_size//2),
-                                     (0, 0)], 'constant')
+        _write_patch(save_path, f'{filename}_{roi_idx}.png', lesion_patch, timings, patch_paths)
 
-            if cat_id == 0:
-                save_path = os.path.join(save_root, 'MALIGNANT')
-            elif cat_id == 1:
-                save_path = os.path.join(save_root, 'BENIGN')
-
-            os.makedirs(save_path, exist_ok=True)
-            cv2.imwrite(os.path.join(save_path, f'{filename}_{roi_idx}.png'), lesion_patch)
+    return filename, patch_paths, timings
 
 
 def read_annotation_json(json_file):
@@ -726,6 +807,7 @@ def cbis_ddsm_statistic(mass_root, calc_root):
 
 def split_train_val(train_save_root, val_save_root, categories, data_root, annotation_filepath, val_ratio):
     df = pd.read_csv(annotation_filepath)
+    lesion_index = LesionIndex(df)
 
     split_info = dict()
     split_info['img_name'] = []
@@ -747,13 +829,13 @@ def split_train_val(train_save_root, val_save_root, categories, data_root, annot
         for mask_path in glob.glob(dir_path + '_*'):
             roi_idx = mask_path.split('_')[-1]
 
-            rslt_df = get_info_lesion(df, f'{filename}_{roi_idx}')
+            roi_id = f'{filename}_{roi_idx}'
 
-            if len(rslt_df) == 0:
-                print(f'No ROI was found for ROI_ID: {filename}_{roi_idx}')
+            if roi_id not in lesion_index:
+                print(f'No ROI was found for ROI_ID: {roi_id}')
                 continue
 
-            label = rslt_df['pathology'].to_numpy()[0]
+            label = lesion_index.get(roi_id, 'pathology')
             if label == 'MALIGNANT':
                 cat_id = 0
             elif label in ['BENIGN', 'BENIGN_WITHOUT_CALLBACK']:
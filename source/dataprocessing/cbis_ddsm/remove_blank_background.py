@@ -3,42 +3,170 @@ import mmcv
 import numpy as np
 import os
 import glob
+import json
+import time
+import argparse
+import multiprocessing
 
 from config.cfg_loader import proj_paths_json
 
 
-def is_background(img):
+VERDICTS_CACHE = '.background_verdicts.json'
+
+READ_FLAGS = {1: cv2.IMREAD_GRAYSCALE,
+              2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+              4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+              8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+
+
+def is_background(img, thres=0.9, block_rows=64):
+    '''
+    True if the zero values of img (counted over all its channels) make up more
+    than thres of its pixels. The rows are counted block by block and the
+    counting stops as soon as the verdict cannot change anymore.
+    '''
     height, width = img.shape[:2]
     total_px = height * width
+    row_size = img[0].size if height else 0
 
-    total_zero_px = np.count_nonzero(img == 0)
+    total_zero_px = 0
+    for start in range(0, height, block_rows):
+        total_zero_px += np.count_nonzero(img[start:start + block_rows] == 0)
+        remaining_px = max(height - start - block_rows, 0) * row_size
 
-    if total_zero_px * 1.0 / total_px > 0.9:
-        return True
+        if total_zero_px * 1.0 / total_px > thres:
+            return True
+        if (total_zero_px + remaining_px) * 1.0 / total_px <= thres:
+            return False
     return False
 
 
-def remove_background_images(data_dir):
-    for img_path in mmcv.track_iter_progress(glob.glob(os.path.join(data_dir, '*.png'))):
-        img = mmcv.imread(img_path)
+def _scan_image(job):
+    img_path, reduce = job
+    img = cv2.imread(img_path, READ_FLAGS[reduce])
+    if img is None:
+        raise IOError(f'Cannot read {img_path}')
 
-        if is_background(img):
-            os.remove(img_path)
+    # The patches used to be read with mmcv.imread, i.e. as 3 identical channels,
+    # so every zero pixel was counted 3 times: same verdicts on the grayscale decode
+    # with a third of the threshold.
+    return img_path, is_background(img, thres=0.9 / 3)
 
 
-if __name__ == '__main__':
-    
+def _load_verdicts(cache_path, settings):
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+    if cache.get('settings') != settings:
+        return {}
+    return cache['verdicts']
+
+
+def _save_verdicts(cache_path, settings, verdicts):
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'settings': settings, 'verdicts': verdicts}, f)
+    os.replace(tmp_path, cache_path)
+
+
+def remove_background_images(data_dir, num_workers=1, dry_run=False, reduce=1,
+                             use_cache=True, chunksize=16):
+    '''
+    Remove the patches of data_dir which are mostly blank (see is_background).
+
+    Args:
+    num_workers - number of processes decoding the patches
+    dry_run - only return the patches which would be removed
+    reduce - decode the patches at 1/reduce of their resolution (1, 2, 4 or 8),
+             faster but the verdicts of the patches close to the threshold
+             may change
+    use_cache - keep the verdicts in data_dir/.background_verdicts.json, keyed by
+                file name and modification time, so that only the new or
+                modified patches are decoded on the next run
+
+    Returns:
+    list of the removed (or, with dry_run, to be removed) patches
+    '''
+    if not os.path.isdir(data_dir):
+        return []
 
+    img_paths = sorted(glob.glob(os.path.join(data_dir, '*.png')))
+    mtimes = {os.path.basename(img_path): os.stat(img_path).st_mtime_ns for img_path in img_paths}
+
+    cache_path = os.path.join(data_dir, VERDICTS_CACHE)
+    settings = {'reduce': reduce}
+    verdicts = _load_verdicts(cache_path, settings) if use_cache else {}
+    # drop the verdicts of the removed or modified patches
+    verdicts = {name: verdict for name, verdict in verdicts.items()
+                if mtimes.get(name) == verdict[0]}
+
+    todo = [(img_path, reduce) for img_path in img_paths
+            if os.path.basename(img_path) not in verdicts]
+
+    since = time.time()
+    if num_workers > 1:
+        pool = multiprocessing.Pool(num_workers)
+        results = pool.imap_unordered(_scan_image, todo, chunksize=chunksize)
+    else:
+        pool = None
+        results = map(_scan_image, todo)
+
+    try:
+        for img_path, background in mmcv.track_iter_progress((results, len(todo))):
+            name = os.path.basename(img_path)
+            verdicts[name] = [mtimes[name], background]
+
+        to_remove = [img_path for img_path in img_paths
+                     if verdicts[os.path.basename(img_path)][1]]
+        if not dry_run:
+            for img_path in to_remove:
+                os.remove(img_path)
+                del verdicts[os.path.basename(img_path)]
+    finally:
+        if pool is not None:
+            pool.terminate()
+        # also keeps the verdicts of an interrupted scan
+        if use_cache:
+            _save_verdicts(cache_path, settings, verdicts)
+
+    elapsed = max(time.time() - since, 1e-6)
+    print(f'{data_dir}: {len(todo)} patches scanned ({len(img_paths) - len(todo)} cached) '
+          f'in {elapsed:.1f}s ({len(todo) / elapsed:.1f} patches/sec), '
+          f'{len(to_remove)} background patches {"to remove" if dry_run else "removed"}')
+
+    return to_remove
+
+
+if __name__ == '__main__':
     data_root = proj_paths_json['DATA']['root']
     tfds_cbis_ddsm = proj_paths_json['DATA']['CBIS_DDSM_tfds']
     tfds_cbis_ddsm_root = os.path.join(
         data_root, tfds_cbis_ddsm['root'])
 
-    train_background_root = os.path.join(tfds_cbis_ddsm_root, 'train', 'BACKGROUND')
-    remove_background_images(train_background_root)
+    parser = argparse.ArgumentParser(description='Remove the mostly blank background patches')
+    parser.add_argument('--data_dirs', nargs='+',
+                        default=[os.path.join(tfds_cbis_ddsm_root, split, 'BACKGROUND')
+                                 for split in ['train', 'val', 'test']])
+    parser.add_argument('--njobs', dest='num_workers', type=int, default=os.cpu_count())
+    parser.add_argument('--reduce', type=int, default=1, choices=sorted(READ_FLAGS))
+    parser.add_argument('--dry_run', action='store_true',
+                        help='only list the patches which would be removed')
+    parser.add_argument('--deletion_list', default=None,
+                        help='file to write the list of the removed patches to (stdout with --dry_run otherwise)')
+    parser.add_argument('--no_cache', dest='use_cache', action='store_false')
+    args = parser.parse_args()
 
-    val_background_root = os.path.join(tfds_cbis_ddsm_root, 'val', 'BACKGROUND')
-    remove_background_images(val_background_root)
+    removed = []
+    for data_dir in args.data_dirs:
+        removed += remove_background_images(data_dir, num_workers=args.num_workers,
+                                            dry_run=args.dry_run, reduce=args.reduce,
+                                            use_cache=args.use_cache)
 
-    test_background_root = os.path.join(tfds_cbis_ddsm_root, 'test', 'BACKGROUND')
-    remove_background_images(test_background_root)
+    if args.deletion_list is not None:
+        with open(args.deletion_list, 'w') as f:
+            f.writelines(img_path + '\n' for img_path in removed)
+    elif args.dry_run:
+        print('\n'.join(removed))
@@ -1,9 +1,7 @@
 import os
 import glob
-import pydicom
 import mmcv
 import cv2
-import numpy as np
 import xml.etree.ElementTree as ET
 import pandas as pd
 
@@ -14,28 +12,23 @@ from pycocotools import mask as coco_api_mask
 from dataprocessing.random_patches_sampling import _sample_positive_patches
 from dataprocessing.random_patches_sampling import _sample_negative_patches
 from dataprocessing.cbis_ddsm.remove_blank_background import remove_background_images
+from dataprocessing.convert_dicom2png import convert_dicoms
 
 
-def convert_dicom_to_png(data_root):
-    os.makedirs(os.path.join(data_root, 'AllPNGs'), exist_ok=True)
-
-    for img_idx, dcm_path in enumerate(mmcv.track_iter_progress(natsorted(glob.glob(os.path.join(data_root, '**', '**', '**', '*.dcm'))))):
+def convert_dicom_to_png(data_root, num_workers=1):
+    jobs = []
+    for dcm_path in natsorted(glob.glob(os.path.join(data_root, '**', '**', '**', '*.dcm'))):
         dcm_filename, _ = os.path.splitext(os.path.basename(dcm_path))
 
         dirname_1 = os.path.basename(os.path.dirname(dcm_path))
         dirname_2 = os.path.basename(os.path.dirname(os.path.dirname(dcm_path)))
         dirname_3 = os.path.basename(os.path.dirname(os.path.dirname(os.path.dirname(dcm_path))))
 
-        mamm_img = pydicom.dcmread(dcm_path).pixel_array
-
         save_path = os.path.join(data_root, 'AllPNGs', dirname_3,
                                     dirname_2, dirname_1, dcm_filename+'.png')
-        os.makedirs(os.path.dirname(save_path), exist_ok=True)
-        if not os.path.exists(save_path):
-            out = np.zeros(mamm_img.shape, np.double)
-            normalized = cv2.normalize(mamm_img, out, 1.0, 0.0, cv2.NORM_MINMAX, dtype=cv2.CV_64F) * 255
-            normalized = normalized.astype(np.uint8)
-            cv2.imwrite(save_path, normalized)
+        jobs.append((dcm_path, [(save_path, {'normalize': True})]))
+
+    convert_dicoms(jobs, num_workers=num_workers)
 
 
 def get_cmmd_background_crops(data_root, save_root):
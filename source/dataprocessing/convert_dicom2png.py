@@ -2,22 +2,139 @@ import pydicom
 import cv2
 import glob
 import os
+import time
+import argparse
+import multiprocessing
+import numpy as np
+import mmcv
 
-if __name__ == '__main__':
-    data_root = '/data/hqvo2/reorganize_CBIS-DDSM'
 
-    # mamm_img = pydicom.dcmread(dicom_path).pixel_array
-    # cv2.imwrite(save_path, mamm_img)
+def image_mode(img):
+    ''' Most frequent non-zero (i.e. non-background) pixel value, the smallest
+    one on ties, same as stats.mode(img[img != 0]).mode '''
+    flat_img = img.ravel()
+    if flat_img.dtype.kind == 'u':
+        counts = np.bincount(flat_img)
+        counts[0] = 0
+        return int(np.argmax(counts))
 
-    for idx, dcm_path in enumerate(glob.glob(os.path.join(data_root, '**/**/**', '*.dcm'))):
-        print(idx)
-        dcm_img = pydicom.dcmread(dcm_path).pixel_array
-        file_path, ext = os.path.splitext(dcm_path)
-        png_path = file_path + '.png'
+    values, counts = np.unique(flat_img[flat_img != 0], return_counts=True)
+    return values[np.argmax(counts)].item()
+
+
+def window_image(img, mode_window=None, normalize=False):
+    '''
+    Args:
+    mode_window - (below, above): clip the pixel values to
+                  [mode - below, mode + above], mode being the most frequent
+                  non-zero value, e.g. (500, 800) for INbreast (from the FRCNN
+                  paper) or (8000, 12800) for the 'mode_norm' of CBIS-DDSM
+    normalize - min-max normalize to an 8-bit image, otherwise the image keeps
+                its dtype (16-bit PNG)
+    '''
+    if mode_window is not None:
+        mode = image_mode(img)
+        below, above = mode_window
+        if img.dtype.kind in 'ui':
+            # bounds inside the dtype range so that the clipped image keeps its dtype
+            info = np.iinfo(img.dtype)
+            lower, upper = max(mode - below, int(info.min)), min(mode + above, int(info.max))
+        else:
+            lower, upper = mode - below, mode + above
+        img = np.clip(img, lower, upper)
+
+    if normalize:
+        normalized = cv2.normalize(img, None, 1.0, 0.0, cv2.NORM_MINMAX, dtype=cv2.CV_64F) * 255
+        img = normalized.astype(np.uint8)
+
+    return img
+
+
+def is_up_to_date(png_path, dcm_path):
+    return os.path.exists(png_path) and \
+        os.path.getmtime(png_path) >= os.path.getmtime(dcm_path)
+
+
+def _convert_dicom(job):
+    ''' Read one DICOM and write every requested windowing of it '''
+    dcm_path, outputs = job
+    since = time.time()
+
+    mamm_img = pydicom.dcmread(dcm_path).pixel_array
+    for png_path, window in outputs:
+        os.makedirs(os.path.dirname(png_path), exist_ok=True)
+
+        # an interrupted write must not leave a png newer than its source
+        root, ext = os.path.splitext(png_path)
+        tmp_path = root + '.tmp' + ext
+        if not cv2.imwrite(tmp_path, window_image(mamm_img, **window)):
+            raise IOError(f'Cannot write {png_path}')
+        os.replace(tmp_path, png_path)
 
-        cv2.imwrite(png_path, dcm_img)
-        
+    return os.path.getsize(dcm_path), len(outputs), time.time() - since
 
 
+def convert_dicoms(jobs, num_workers=1, chunksize=4):
+    '''
+    Convert DICOMs to PNGs over a pool of num_workers processes.
 
+    Args:
+    jobs - list of (dcm_path, [(png_path, window), ...]), window being the
+           keyword arguments of window_image, e.g. {} to write the raw pixels or
+           {'mode_window': (500, 800), 'normalize': True}. Every DICOM is read
+           once for all its outputs.
+
+    Outputs which already exist and are newer than their DICOM are skipped.
+
+    Returns:
+    number of written PNGs
+    '''
+    todo = []
+    for dcm_path, outputs in jobs:
+        outputs = [(png_path, window) for png_path, window in outputs
+                   if not is_up_to_date(png_path, dcm_path)]
+        if outputs:
+            todo.append((dcm_path, outputs))
+
+    num_pngs = 0
+    num_bytes = 0
+    worker_time = 0.0
+    since = time.time()
+
+    if num_workers > 1:
+        pool = multiprocessing.Pool(num_workers)
+        results = pool.imap_unordered(_convert_dicom, todo, chunksize=chunksize)
+    else:
+        pool = None
+        results = map(_convert_dicom, todo)
+
+    try:
+        for dcm_bytes, dcm_pngs, seconds in mmcv.track_iter_progress((results, len(todo))):
+            num_bytes += dcm_bytes
+            num_pngs += dcm_pngs
+            worker_time += seconds
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    elapsed = max(time.time() - since, 1e-6)
+    print(f'{len(todo)} DICOMs ({len(jobs) - len(todo)} up to date), {num_pngs} PNGs '
+          f'in {elapsed:.1f}s with {num_workers} worker(s): '
+          f'{len(todo) / elapsed:.2f} images/sec, {num_bytes / 1024 ** 2 / elapsed:.1f} MB/sec '
+          f'({worker_time / max(len(todo), 1) * 1e3:.0f} ms/image per worker)')
+
+    return num_pngs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a png next to every dcm of the tree')
+    parser.add_argument('--data_root', default='/data/hqvo2/reorganize_CBIS-DDSM')
+    parser.add_argument('--njobs', dest='num_workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    jobs = []
+    for dcm_path in glob.glob(os.path.join(args.data_root, '**/**/**', '*.dcm')):
+        file_path, ext = os.path.splitext(dcm_path)
+        jobs.append((dcm_path, [(file_path + '.png', {})]))
 
+    convert_dicoms(jobs, num_workers=args.num_workers)
@@ -1,6 +1,5 @@
 import os
 import glob
-import pydicom
 import mmcv
 import cv2
 import numpy as np
@@ -14,6 +13,7 @@ from pycocotools import mask as coco_api_mask
 from dataprocessing.random_patches_sampling import _sample_positive_patches
 from dataprocessing.random_patches_sampling import _sample_negative_patches
 from dataprocessing.cbis_ddsm.remove_blank_background import remove_background_images
+from dataprocessing.convert_dicom2png import convert_dicoms
 
 
 def area(_mask):
@@ -63,31 +63,18 @@ def increase_constrast_by_clip(mamm_img, lowerbound_clip_rate, upperbound_clip_r
     return normalized
 
 
-def convert_dicom_to_png(data_root):
-    os.makedirs(os.path.join(data_root, 'AllPNGs'), exist_ok=True)
-    os.makedirs(os.path.join(data_root, 'AllNormPNGs'), exist_ok=True)
-
-    for img_idx, dcm_path in enumerate(mmcv.track_iter_progress(natsorted(glob.glob(os.path.join(data_root, 'AllDICOMs', '*.dcm'))))):
+def convert_dicom_to_png(data_root, num_workers=1):
+    jobs = []
+    for dcm_path in natsorted(glob.glob(os.path.join(data_root, 'AllDICOMs', '*.dcm'))):
         dcm_filename, _ = os.path.splitext(os.path.basename(dcm_path))
-        mamm_img = pydicom.dcmread(dcm_path).pixel_array
-
-        if not os.path.exists(os.path.join(data_root, 'AllPNGs', dcm_filename+'.png')):
-            out = np.zeros(mamm_img.shape, np.double)
-            normalized = cv2.normalize(mamm_img, out, 1.0, 0.0, cv2.NORM_MINMAX, dtype=cv2.CV_64F) * 255
-            normalized = normalized.astype(np.uint8)
-            cv2.imwrite(os.path.join(data_root, 'AllPNGs', dcm_filename+'.png'), normalized)
-
-        # For increasing contrast of mammograms (Follow the FRCNN paper)
-        if not os.path.exists(os.path.join(data_root, 'AllNormPNGs', dcm_filename+'.png')):
-            flat_img = mamm_img.flatten()
-            flat_img = flat_img[flat_img != 0]
-            mode = stats.mode(flat_img).mode # ignore background value 0
-            mamm_img = np.clip(mamm_img, mode-500, mode+800)
-
-            out = np.zeros(mamm_img.shape, np.double)
-            normalized = cv2.normalize(mamm_img, out, 1.0, 0.0, cv2.NORM_MINMAX, dtype=cv2.CV_64F) * 255
-            normalized = normalized.astype(np.uint8)
-            cv2.imwrite(os.path.join(data_root, 'AllNormPNGs', dcm_filename+'.png'), normalized)
+        jobs.append((dcm_path, [
+            (os.path.join(data_root, 'AllPNGs', dcm_filename+'.png'),
+             {'normalize': True}),
+            # For increasing contrast of mammograms (Follow the FRCNN paper)
+            (os.path.join(data_root, 'AllNormPNGs', dcm_filename+'.png'),
+             {'mode_window': (500, 800), 'normalize': True})]))
+
+    convert_dicoms(jobs, num_workers=num_workers)
 
 
 def get_inbreast_lesion_pathology(data_root, mass_save_root,
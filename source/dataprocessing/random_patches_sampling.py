@@ -45,6 +45,67 @@ def _patch_overlaps_any_abnormality_above_threshold(y, x, patch_size,
   return False
 
 
+def _summed_area_table(mask):
+  """Integral image of `mask > 0`, with a leading row and column of zeros.
+  The number of mask pixels in any patch is then read with 4 lookups.
+  """
+  return cv2.integral((mask > 0).astype(np.uint8), sdepth=cv2.CV_32S)
+
+
+def _count_in_patches(table, ys, xs, patch_size):
+  """Vectorized `np.sum(mask[y:(y + h), x:(x + w)] > 0)` for arrays of patches."""
+  y_end = np.minimum(ys + patch_size[0], table.shape[0] - 1)
+  x_end = np.minimum(xs + patch_size[1], table.shape[1] - 1)
+  return (table[y_end, x_end] - table[ys, x_end] -
+          table[y_end, xs] + table[ys, xs])
+
+
+def _patches_overlap_any_abnormality_above_threshold(ys, xs, patch_size,
+                                                     abnormalities_tables,
+                                                     abnormalities_areas,
+                                                     min_overlap_threshold):
+  """Vectorized `_patch_overlaps_any_abnormality_above_threshold`.
+  Args:
+    ys: Array of top-most coordinates of the patches.
+    xs: Array of left-most coordinates of the patches.
+    patch_size: Tuple with (height, width) of the patches.
+    abnormalities_tables: List with the `_summed_area_table` of each abnormality.
+    abnormalities_areas: List with the total area of each abnormality.
+    min_overlap_threshold:
+  Returns:
+    Boolean array, True for the patches that meet the condition for any of the
+    given abnormalities.
+  """
+  patch_area = patch_size[0] * patch_size[1]
+  overlaps = np.zeros(len(ys), dtype=bool)
+  for abnorm_table, abnorm_area in zip(abnormalities_tables, abnormalities_areas):
+    abnorm_in_patch_area = _count_in_patches(abnorm_table, ys, xs, patch_size)
+    abnorm_in_patch_wrt_patch = abnorm_in_patch_area / patch_area
+    abnorm_in_patch_wrt_abnorm = abnorm_in_patch_area / abnorm_area
+    overlaps |= ((abnorm_in_patch_wrt_patch > min_overlap_threshold) |
+                 (abnorm_in_patch_wrt_abnorm > min_overlap_threshold))
+  return overlaps
+
+
+def _sample_candidates(min_y, max_y, min_x, max_x, number_of_candidates):
+  """Draw the (y, x) candidates of a whole trial round at once.
+  The draws are interleaved exactly as `number_of_candidates` pairs of
+  `np.random.randint(min_y, max_y + 1)`, `np.random.randint(min_x, max_x + 1)`
+  calls would be, so the same seed gives the same candidates.
+  """
+  lows = np.tile([min_y, min_x], number_of_candidates)
+  highs = np.tile([max_y + 1, max_x + 1], number_of_candidates)
+  candidates = np.random.randint(lows, highs).reshape(number_of_candidates, 2)
+  return candidates[:, 0], candidates[:, 1]
+
+
+def _rewind_candidates(rng_state, min_y, max_y, min_x, max_x,
+                       number_of_candidates):
+  """Leave the global RNG as if only `number_of_candidates` had been drawn."""
+  np.random.set_state(rng_state)
+  _sample_candidates(min_y, max_y, min_x, max_x, number_of_candidates)
+
+
 def _find_contours(*args, **kwargs):
   tuple_ = cv2.findContours(*args, **kwargs)
   if len(tuple_) == 2:  # Recent opencv returns: (contours, hierachy)
@@ -109,6 +170,7 @@ def _sample_positive_patches(image,
 
     abnormality_roi = _get_roi_from_mask(abnormality_mask)
     abnorm_x, abnorm_y, abnorm_w, abnorm_h = cv2.boundingRect(abnormality_roi)
+    abnormality_table = _summed_area_table(abnormality_mask)
 
     number_of_yielded_patches = 0
     while min_overlap_threshold > 0.1:
@@ -135,18 +197,25 @@ def _sample_positive_patches(image,
                 patch_size, min_overlap_threshold, max_number_of_trials_per_threshold)
             effective_range_size = (max_y - min_y + 1) * (max_x - min_x + 1)
 
-        for _ in range(effective_range_size):
-            patch_y = np.random.randint(min_y, max_y + 1)
-            patch_x = np.random.randint(min_x, max_x + 1)
-            if _patch_overlaps_any_abnormality_above_threshold(
-                patch_y, patch_x, patch_size, [abnormality_mask], [abnormality_area],
-                min_overlap_threshold):
-                number_of_yielded_patches += 1
-                yield image[patch_y:(patch_y + patch_size[0]),
-                            patch_x:(patch_x + patch_size[1])]
+        # Test all the candidates of this round at once.
+        rng_state = np.random.get_state()
+        patch_ys, patch_xs = _sample_candidates(min_y, max_y, min_x, max_x,
+                                                effective_range_size)
+        accepted = np.flatnonzero(_patches_overlap_any_abnormality_above_threshold(
+            patch_ys, patch_xs, patch_size, [abnormality_table], [abnormality_area],
+            min_overlap_threshold))
+
+        for idx in accepted:
+            patch_y, patch_x = patch_ys[idx], patch_xs[idx]
+            number_of_yielded_patches += 1
             # If we have yielded all requested patches return.
             if number_of_yielded_patches >= number_of_patches:
+                _rewind_candidates(rng_state, min_y, max_y, min_x, max_x, idx + 1)
+                yield image[patch_y:(patch_y + patch_size[0]),
+                            patch_x:(patch_x + patch_size[1])]
                 return
+            yield image[patch_y:(patch_y + patch_size[0]),
+                        patch_x:(patch_x + patch_size[1])]
 
         # We failed to produce patches with the minimum overlapping requirements.
         # Reduce those requirements and try again.
@@ -218,11 +287,14 @@ def _sample_negative_patches(image,
 
 
     breast_mask = _get_breast_mask(image)
-
-    def patch_overlapping_breast_is_feasible(y, x):
-        """Return True if the patch contains enough breast pixels."""
-        breast_in_patch = breast_mask[y:(y + patch_size[0]), x:(x + patch_size[1])]
-        return (np.sum(breast_in_patch > 0) /
+    breast_table = _summed_area_table(breast_mask)
+    abnormalities_tables = [_summed_area_table(abnorm_mask)
+                            for abnorm_mask in abnormalities_masks]
+
+    def patches_overlapping_breast_are_feasible(ys, xs):
+        """Return True for the patches that contain enough breast pixels."""
+        breast_in_patches = _count_in_patches(breast_table, ys, xs, patch_size)
+        return (breast_in_patches /
                 (patch_size[0] * patch_size[1]) > min_breast_overlap_threshold)
 
     breast_roi = _get_roi_from_mask(breast_mask)
@@ -252,20 +324,27 @@ def _sample_negative_patches(image,
                 patch_size, min_breast_overlap_threshold,
                 max_number_of_trials_per_threshold)
             effective_range_size = (max_y - min_y + 1) * (max_x - min_x + 1)
-        for _ in range(effective_range_size):
-            patch_y = np.random.randint(min_y, max_y + 1)
-            patch_x = np.random.randint(min_x, max_x + 1)
-            if (patch_overlapping_breast_is_feasible(patch_y, patch_x) and
-                not _patch_overlaps_any_abnormality_above_threshold(
-                    patch_y, patch_x, patch_size, abnormalities_masks,
-                    abnormalities_areas, max_abnorm_overlap_threshold)):
-                number_of_yielded_patches += 1
-                yield image[patch_y:(patch_y + patch_size[0]),
-                            patch_x:(patch_x + patch_size[1])]
-
+        # Test all the candidates of this round at once.
+        rng_state = np.random.get_state()
+        patch_ys, patch_xs = _sample_candidates(min_y, max_y, min_x, max_x,
+                                                effective_range_size)
+        accepted = np.flatnonzero(
+            patches_overlapping_breast_are_feasible(patch_ys, patch_xs) &
+            ~_patches_overlap_any_abnormality_above_threshold(
+                patch_ys, patch_xs, patch_size, abnormalities_tables,
+                abnormalities_areas, max_abnorm_overlap_threshold))
+
+        for idx in accepted:
+            patch_y, patch_x = patch_ys[idx], patch_xs[idx]
+            number_of_yielded_patches += 1
             # If we have yielded all requested patches return.
             if number_of_yielded_patches >= number_of_patches:
+                _rewind_candidates(rng_state, min_y, max_y, min_x, max_x, idx + 1)
+                yield image[patch_y:(patch_y + patch_size[0]),
+                            patch_x:(patch_x + patch_size[1])]
                 return
+            yield image[patch_y:(patch_y + patch_size[0]),
+                        patch_x:(patch_x + patch_size[1])]
         # We failed to produce patches with the given overlapping requirements.
         # Relaxate the requirements and try again.
         min_breast_overlap_threshold = min_breast_overlap_threshold * 0.95
@@ -48,198 +48,255 @@ def isCenterInGTbbox(pred_bbox, gt_bbox):
     return False
 
 
-def all_classes_detection_prec_rec(gt_categories, _gt_bboxes_json, _pred_bboxes_json, _bbox_select, _iou_thres, bbox_thres=None):
-    def detection_prec_rec(gt_bboxes_list, pred_bboxes_list, iou_thres):
-        ''' Get precision and recall values
-        pred_bboxes_list - list of sublists of predicted bounding boxes.
-                        Each sublist represents all detected bounding
-                        boxes of one specific image (bbox_format: 
-                        (left, top, right, bottom, score))
-        gt_bboxes_list - list of sublists of ground-truth bounding boxes.
-                        Each sublist represents all ground-truth bounding
-                        boxes of one specific image (bbox_format: 
-                        (left, top, right, bottom))
-        '''
+def _detection_prec_rec_loop(gt_bboxes_list, pred_bboxes_list, iou_thres=None):
+    ''' Reference (one prediction at a time) version of detection_prec_rec,
+    kept for benchmark_detection_matcher. iou_thres=None uses the center metric.
+
+    pred_bboxes_list - list of sublists of predicted bounding boxes.
+                    Each sublist represents all detected bounding
+                    boxes of one specific image (bbox_format: 
+                    (left, top, right, bottom, score))
+    gt_bboxes_list - list of sublists of ground-truth bounding boxes.
+                    Each sublist represents all ground-truth bounding
+                    boxes of one specific image (bbox_format: 
+                    (left, top, right, bottom))
+    '''
 
-        precision_values = []
-        recall_values = []
-        false_pos_per_img_values = []
-        images_set = set()
-        img_filenames = []
+    precision_values = []
+    recall_values = []
+    false_pos_per_img_values = []
+    images_set = set()
+    img_filenames = []
 
-        true_pos = 0
-        false_pos = 0
+    true_pos = 0
+    false_pos = 0
 
-        pred_bboxes = [(img_id, pred_bbox) for img_id, img_pred_bboxes in enumerate(
-            pred_bboxes_list) for pred_bbox in img_pred_bboxes]
-        pred_bboxes = sorted(
-            pred_bboxes, key=lambda x: x[1][4], reverse=True)
-        # print('#Pred boxes:', len(pred_bboxes))
+    pred_bboxes = [(img_id, pred_bbox) for img_id, img_pred_bboxes in enumerate(
+        pred_bboxes_list) for pred_bbox in img_pred_bboxes]
+    pred_bboxes = sorted(
+        pred_bboxes, key=lambda x: x[1][4], reverse=True)
 
-        matched = [[False for gt_bbox in gt_bboxes]
-                   for gt_bboxes in gt_bboxes_list]
-        total_pos = sum([len(gt_bboxes) for gt_bboxes in gt_bboxes_list])
-        # print('#Gt boxes:', total_pos)
+    matched = [[False for gt_bbox in gt_bboxes]
+               for gt_bboxes in gt_bboxes_list]
+    total_pos = sum([len(gt_bboxes) for gt_bboxes in gt_bboxes_list])
 
-        for img_id, pred_bbox in pred_bboxes:
+    for img_id, pred_bbox in pred_bboxes:
 
-            max_iou = -1
-            selected_gt_bbox_id = -1
+        max_iou = -1
+        selected_gt_bbox_id = -1
 
-            for gt_bbox_id, gt_bbox in enumerate(gt_bboxes_list[img_id]):
-                if matched[img_id][gt_bbox_id] is True:
-                    continue
+        for gt_bbox_id, gt_bbox in enumerate(gt_bboxes_list[img_id]):
+            if matched[img_id][gt_bbox_id] is True:
+                continue
 
-                iou = IoU(pred_bbox, gt_bbox)
-                if iou >= iou_thres and iou > max_iou:
-                    max_iou = iou
+            if iou_thres is None:
+                if isCenterInGTbbox(pred_bbox, gt_bbox):
                     selected_gt_bbox_id = gt_bbox_id
+                continue
 
-            if selected_gt_bbox_id != -1:
-                matched[img_id][selected_gt_bbox_id] = True
-                true_pos += 1
-            else:
-                false_pos += 1
-
-            images_set.add(img_id)
-
-            precision_values.append(true_pos/(true_pos+false_pos))
-            recall_values.append(true_pos/(total_pos))
-            false_pos_per_img_values.append(false_pos/len(images_set))
-            img_filenames.append(pred_bbox[5])
+            iou = IoU(pred_bbox, gt_bbox)
+            if iou >= iou_thres and iou > max_iou:
+                max_iou = iou
+                selected_gt_bbox_id = gt_bbox_id
 
-        # Compute Average Precision
-        ap = sum([(recall_values[r] - recall_values[r-1])*precision_values[r]
-                  for r in range(1, len(precision_values))])
-        ap = round(ap, 2)
-        # print('Average Precision:', ap)
+        if selected_gt_bbox_id != -1:
+            matched[img_id][selected_gt_bbox_id] = True
+            true_pos += 1
+        else:
+            false_pos += 1
 
-        for idx in range(0, len(precision_values)-1):
-            precision_values[idx] = max(precision_values[idx:])
-            false_pos_per_img_values[idx] = min(
-                false_pos_per_img_values[idx:])
+        images_set.add(img_id)
 
-        return precision_values, recall_values, false_pos_per_img_values, ap, img_filenames
+        precision_values.append(true_pos/(true_pos+false_pos))
+        recall_values.append(true_pos/(total_pos))
+        false_pos_per_img_values.append(false_pos/len(images_set))
+        img_filenames.append(pred_bbox[5])
 
-    # Evaluation for all classes
-    eval_log = dict()
-    eval_plot = dict()
-    aps = []
-    for class_info in gt_categories:
-        _category_id = class_info['id']
+    # Compute Average Precision
+    ap = sum([(recall_values[r] - recall_values[r-1])*precision_values[r]
+              for r in range(1, len(precision_values))])
+    ap = round(ap, 2)
 
-        gt_bboxes_list, pred_bboxes_list  = \
-            get_bboxes_lists(gt_bboxes_json=_gt_bboxes_json,
-                             pred_bboxes_json=_pred_bboxes_json,
-                             category_id=_category_id, bbox_select=_bbox_select,
-                             thres=bbox_thres)
-        p_vals, r_vals, fp_img_vals, ap, img_filenames = detection_prec_rec(
-            gt_bboxes_list, pred_bboxes_list, _iou_thres)
-        eval_log[_category_id] = {'AP': ap}
-        eval_plot[_category_id] = {'precisions': p_vals, 'recalls': r_vals,
-                                   'false_positives_per_image': fp_img_vals, 'auc': ap,
-                                   'img_filenames': img_filenames}
-        aps.append(ap)
-
-    eval_log['mAP'] = sum(aps)/len(aps)
-    return eval_log, eval_plot
-
-
-def all_classes_detection_loose_prec_rec(gt_categories, _gt_bboxes_json, _pred_bboxes_json, _bbox_select, bbox_thres):
-    def detection_loose_prec_rec(gt_bboxes_list, pred_bboxes_list):
-        ''' Plot precision-recall curve using the center metric, i.e.,
-        if the center of the predicted box is in the ground-truth box, is
-        will be determined as true positive alarm.
-
-        pred_bboxes_list - list of sublists of predicted bounding boxes.
-                        Each sublist represents all detected bounding
-                        boxes of one specific image (bbox_format: 
-                        (left, top, right, bottom, score))
-        gt_bboxes_list - list of sublists of ground-truth bounding boxes.
-                        Each sublist represents all ground-truth bounding
-                        boxes of one specific image (bbox_format: 
-                        (left, top, right, bottom))
-        '''
+    for idx in range(0, len(precision_values)-1):
+        precision_values[idx] = max(precision_values[idx:])
+        false_pos_per_img_values[idx] = min(
+            false_pos_per_img_values[idx:])
 
-        precision_values = []
-        recall_values = []
-        false_pos_per_img_values = []
-        images_set = set()
-        img_filenames = []
+    return precision_values, recall_values, false_pos_per_img_values, ap, img_filenames
 
-        true_pos = 0
-        false_pos = 0
 
-        pred_bboxes = [(img_id, pred_bbox) for img_id, img_pred_bboxes in enumerate(
-            pred_bboxes_list) for pred_bbox in img_pred_bboxes]
-        pred_bboxes = sorted(
-            pred_bboxes, key=lambda x: x[1][4], reverse=True)
-        # print('#Pred boxes:', len(pred_bboxes))
+def match_detections(gt_bboxes_list, pred_bboxes, pred_scores, pred_images, iou_thresholds=(), center=False):
+    ''' Greedily match the predictions to the ground-truth boxes for several
+    criteria at once: every IoU threshold of iou_thresholds, then the center
+    metric if center is set. Same matching as the one-prediction-at-a-time loop,
+    i.e. predictions are visited by decreasing score and each of them takes the
+    unmatched ground-truth box of its image with the highest IoU (center metric:
+    the last unmatched box containing its center).
 
-        matched = [[False for gt_bbox in gt_bboxes]
-                   for gt_bboxes in gt_bboxes_list]
-        total_pos = sum([len(gt_bboxes) for gt_bboxes in gt_bboxes_list])
-        # print('#Gt boxes:', total_pos)
+    The matching only depends on the order of the predictions inside their own
+    image, so the r-th prediction of every image is matched in the same step,
+    against a (#images, max #gt boxes) padded array of ground-truth boxes. The
+    IoU matrix of a step is computed once for all the criteria.
 
-        for img_id, pred_bbox in pred_bboxes:
+    Args:
+    gt_bboxes_list (list) - (G, 4) arrays of (left, top, right, bottom), one per image
+    pred_bboxes (np.ndarray) - (P, 4) predicted boxes of all images
+    pred_scores (np.ndarray) - (P,) scores
+    pred_images (np.ndarray) - (P,) index of the image of each prediction in gt_bboxes_list
 
-            selected_gt_bbox_id = -1
+    Returns:
+    order (np.ndarray) - (P,) prediction indices sorted by decreasing score (stable)
+    true_pos (np.ndarray) - (#criteria, P) bool, whether each prediction of order is a true positive
+    '''
+    num_criteria = len(iou_thresholds) + int(center)
+    order = np.argsort(-pred_scores, kind='stable')
+    true_pos = np.zeros((num_criteria, len(order)), dtype=bool)
+    if len(order) == 0 or num_criteria == 0:
+        return order, true_pos
+
+    num_gts = np.array([len(gt_bboxes) for gt_bboxes in gt_bboxes_list], dtype=np.int64)
+    max_num_gts = max(num_gts.max(), 1)
+    gt_bboxes = np.zeros((len(gt_bboxes_list), max_num_gts, 4), dtype=np.float64)
+    for img_id, img_gt_bboxes in enumerate(gt_bboxes_list):
+        gt_bboxes[img_id, :len(img_gt_bboxes)] = img_gt_bboxes
+    gt_valid = np.arange(max_num_gts) < num_gts[:, None]
+    gt_areas = (gt_bboxes[..., 2] - gt_bboxes[..., 0] + 1) * (gt_bboxes[..., 3] - gt_bboxes[..., 1] + 1)
+
+    # rank of every prediction among the predictions of its image
+    sorted_images = pred_images[order]
+    by_image = np.argsort(sorted_images, kind='stable')
+    group_starts = np.searchsorted(sorted_images[by_image], sorted_images[by_image])
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[by_image] = np.arange(len(order)) - group_starts
+
+    iou_thresholds = np.asarray(iou_thresholds, dtype=np.float64)
+    matched = np.zeros((num_criteria,) + gt_valid.shape, dtype=bool)
+    step_positions = np.split(np.argsort(ranks, kind='stable'),
+                              np.cumsum(np.bincount(ranks))[:-1])
+    gt_ids = np.arange(max_num_gts)
+
+    for positions in step_positions:
+        images = sorted_images[positions]
+        preds = pred_bboxes[order[positions]][:, None]
+        gts = gt_bboxes[images]
+
+        # same operations (and rounding) as IoU and isCenterInGTbbox
+        intersec_width = np.maximum(np.minimum(preds[..., 2], gts[..., 2]) -
+                                    np.maximum(preds[..., 0], gts[..., 0]) + 1, 0)
+        intersec_height = np.maximum(np.minimum(preds[..., 3], gts[..., 3]) -
+                                     np.maximum(preds[..., 1], gts[..., 1]) + 1, 0)
+        intersec_area = intersec_width * intersec_height
+        pred_area = (preds[..., 2] - preds[..., 0] + 1) * (preds[..., 3] - preds[..., 1] + 1)
+        union_area = pred_area + gt_areas[images] - intersec_area
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ious = intersec_area / union_area
+
+        available = gt_valid[images] & ~matched[:, images]
+        candidates = (ious >= iou_thresholds[:, None, None]) & available[:len(iou_thresholds)]
+        # first box with the highest IoU
+        selected = np.where(candidates, ious, -1).argmax(axis=-1)
+
+        if center:
+            center_x = (preds[..., 0] + preds[..., 2]) / 2
+            center_y = (preds[..., 1] + preds[..., 3]) / 2
+            center_candidates = (center_x > gts[..., 0]) & (center_x < gts[..., 2]) & \
+                (center_y > gts[..., 1]) & (center_y < gts[..., 3]) & available[-1]
+            # last box containing the center
+            center_selected = np.where(center_candidates, gt_ids, -1).argmax(axis=-1)
+            candidates = np.concatenate([candidates, center_candidates[None]])
+            selected = np.concatenate([selected, center_selected[None]])
+
+        hits = candidates.any(axis=-1)
+        criteria, hit_preds = np.nonzero(hits)
+        matched[criteria, images[hit_preds], selected[criteria, hit_preds]] = True
+        true_pos[:, positions] = hits
+
+    return order, true_pos
+
+
+def detection_curves(true_pos, sorted_images, total_pos):
+    ''' Precision, recall and false positives per image curves of one
+    criterion of match_detections, and the (non-interpolated) average precision.
+    The returned precision and false positives per image are the interpolated
+    envelopes, i.e. precision_values[idx] = max(precision[idx:]) and
+    false_pos_per_img_values[idx] = min(false_pos_per_img[idx:]), built with
+    a reverse cumulative max/min.
+    '''
+    if len(true_pos) > 0 and total_pos == 0:
+        raise ZeroDivisionError('No ground-truth boxes to compute the recall')
 
-            for gt_bbox_id, gt_bbox in enumerate(gt_bboxes_list[img_id]):
-                if matched[img_id][gt_bbox_id] is True:
-                    continue
+    true_pos_cum = np.cumsum(true_pos, dtype=np.int64)
+    false_pos_cum = np.arange(1, len(true_pos) + 1) - true_pos_cum
+    first_seen = np.zeros(len(sorted_images), dtype=bool)
+    first_seen[np.unique(sorted_images, return_index=True)[1]] = True
+    num_images_seen = np.cumsum(first_seen)
 
-                if isCenterInGTbbox(pred_bbox, gt_bbox):
-                    selected_gt_bbox_id = gt_bbox_id
+    precision_values = true_pos_cum / (true_pos_cum + false_pos_cum)
+    recall_values = true_pos_cum / max(total_pos, 1)
+    false_pos_per_img_values = false_pos_cum / num_images_seen
 
-            if selected_gt_bbox_id != -1:
-                matched[img_id][selected_gt_bbox_id] = True
-                true_pos += 1
-            else:
-                false_pos += 1
+    # Compute Average Precision (summed in order, like the reference loop)
+    ap = sum(((recall_values[1:] - recall_values[:-1]) * precision_values[1:]).tolist())
+    ap = round(ap, 2)
 
-            images_set.add(img_id)
+    precision_values = np.maximum.accumulate(precision_values[::-1])[::-1]
+    false_pos_per_img_values = np.minimum.accumulate(false_pos_per_img_values[::-1])[::-1]
 
-            precision_values.append(true_pos/(true_pos+false_pos))
-            recall_values.append(true_pos/(total_pos))
-            false_pos_per_img_values.append(false_pos/len(images_set))
-            img_filenames.append(pred_bbox[5])
+    return precision_values.tolist(), recall_values.tolist(), false_pos_per_img_values.tolist(), ap
 
-        # Compute Average Precision
-        ap = sum([(recall_values[r] - recall_values[r-1])*precision_values[r]
-                  for r in range(1, len(precision_values))])
-        ap = round(ap, 2)
-        # print('Average Precision:', ap)
 
-        for idx in range(0, len(precision_values)-1):
-            precision_values[idx] = max(precision_values[idx:])
-            false_pos_per_img_values[idx] = min(
-                false_pos_per_img_values[idx:])
+def all_classes_detection_curves(gt_categories, bboxes_store, _bbox_select, iou_thresholds=(0.75, 0.5, 0.25), center=True, bbox_thres=None):
+    ''' Evaluation of all classes for every IoU threshold of iou_thresholds
+    and the center metric, with a single matching sweep per class
 
-        return precision_values, recall_values, false_pos_per_img_values, ap, img_filenames
+    Returns:
+    dict of {iou threshold | 'center': (eval_log, eval_plot)}
+    '''
+    metrics = list(iou_thresholds) + (['center'] if center else [])
+    eval_logs = {metric: dict() for metric in metrics}
+    eval_plots = {metric: dict() for metric in metrics}
 
-    # Evaluation for all classes
-    eval_log = dict()
-    eval_plot = dict()
-    aps = []
     for class_info in gt_categories:
         _category_id = class_info['id']
 
-        gt_bboxes_list, pred_bboxes_list = \
-            get_bboxes_lists(gt_bboxes_json=_gt_bboxes_json,
-                             pred_bboxes_json=_pred_bboxes_json,
-                             category_id=_category_id, bbox_select=_bbox_select,
-                             thres=bbox_thres)
-        p_vals, r_vals, fp_img_vals, ap, img_filenames = detection_loose_prec_rec(
-            gt_bboxes_list, pred_bboxes_list)
-        eval_log[_category_id] = {'AP': ap}
-        eval_plot[_category_id] = {'precisions': p_vals, 'recalls': r_vals,
-                                   'false_positives_per_image': fp_img_vals, 'auc': ap,
-                                   'img_filenames': img_filenames}
-        aps.append(ap)
+        gt_bboxes_list, pred_bboxes, pred_scores, pred_images = \
+            bboxes_store.get_bboxes_arrays(category_id=_category_id,
+                                           bbox_select=_bbox_select,
+                                           thres=bbox_thres)
+        order, true_pos = match_detections(gt_bboxes_list, pred_bboxes, pred_scores, pred_images,
+                                           iou_thresholds=iou_thresholds, center=center)
+        sorted_images = pred_images[order]
+        img_filenames = [bboxes_store.filenames[img_id] for img_id in sorted_images.tolist()]
+        total_pos = sum([len(gt_bboxes) for gt_bboxes in gt_bboxes_list])
+
+        for metric, metric_true_pos in zip(metrics, true_pos):
+            p_vals, r_vals, fp_img_vals, ap = detection_curves(
+                metric_true_pos, sorted_images, total_pos)
+            eval_logs[metric][_category_id] = {'AP': ap}
+            eval_plots[metric][_category_id] = {'precisions': p_vals, 'recalls': r_vals,
+                                                'false_positives_per_image': fp_img_vals, 'auc': ap,
+                                                'img_filenames': list(img_filenames)}
+
+    for metric in metrics:
+        aps = [eval_logs[metric][class_info['id']]['AP'] for class_info in gt_categories]
+        eval_logs[metric]['mAP'] = sum(aps)/len(aps)
+
+    return {metric: (eval_logs[metric], eval_plots[metric]) for metric in metrics}
+
 
-    eval_log['mAP'] = sum(aps)/len(aps)
-    return eval_log, eval_plot
+def all_classes_detection_prec_rec(gt_categories, bboxes_store, _bbox_select, _iou_thres, bbox_thres=None):
+    return all_classes_detection_curves(gt_categories, bboxes_store, _bbox_select,
+                                        iou_thresholds=[_iou_thres], center=False,
+                                        bbox_thres=bbox_thres)[_iou_thres]
+
+
+def all_classes_detection_loose_prec_rec(gt_categories, bboxes_store, _bbox_select, bbox_thres):
+    ''' Precision-recall using the center metric, i.e., if the center of the
+    predicted box is in the ground-truth box, is will be determined as true
+    positive alarm '''
+    return all_classes_detection_curves(gt_categories, bboxes_store, _bbox_select,
+                                        iou_thresholds=[], center=True,
+                                        bbox_thres=bbox_thres)['center']
 
 
 def plot_pr_curve_true_pos_metric(_save_path, _bbox_select, gt_categories, iou75_eval_plot, iou50_eval_plot, iou25_eval_plot, center_eval_plot, log_title, fig_only=False):
@@ -359,9 +416,127 @@ def plot_froc_curve_true_pos_metric(_save_path, _bbox_select, gt_categories, iou
         plt.close()
 
 
+class BBoxesStore:
+    ''' Ground-truth and predicted bounding boxes, loaded once and grouped by
+    (image_id, category_id) into NumPy arrays so that every metric and
+    category can be evaluated without re-reading nor re-scanning the json files
+
+    Args:
+    gt_bboxes_json (str): path to the ground-truth json file
+    pred_bboxes_json (str): path to the predicted boxes json file
+    '''
+
+    def __init__(self, gt_bboxes_json, pred_bboxes_json):
+        gt_json = json.read(gt_bboxes_json)
+        pred_json = json.read(pred_bboxes_json)
+
+        self.categories = gt_json['categories']
+        self.image_ids = [image['id'] for image in gt_json['images']]
+        self.filenames = [image['file_name'] for image in gt_json['images']]
+
+        # (image_id, category_id) -> (N, 4) array of (left, top, right, bottom)
+        self.gt_bboxes = self._group(gt_json['annotations'])
+        # (image_id, category_id) -> ((N, 4) boxes array, (N,) scores array),
+        # boxes keep the order of the json file
+        self.pred_bboxes = self._group(pred_json, with_scores=True)
+
+        self._arrays = dict()
+
+    @staticmethod
+    def _group(anns, with_scores=False):
+        grouped_bboxes = dict()
+        grouped_scores = dict()
+        for ann in anns:
+            key = (ann['image_id'], ann['category_id'])
+            grouped_bboxes.setdefault(key, []).append(ann['bbox'])
+            if with_scores:
+                grouped_scores.setdefault(key, []).append(ann['score'])
+
+        groups = dict()
+        for key, bboxes in grouped_bboxes.items():
+            bboxes = np.array(bboxes, dtype=np.float64).reshape(-1, 4)
+            # (x, y, w, h) -> (left, top, right, bottom)
+            bboxes[:, 2:] = bboxes[:, :2] + bboxes[:, 2:] - 1
+            if with_scores:
+                groups[key] = (bboxes, np.array(grouped_scores[key], dtype=np.float64))
+            else:
+                groups[key] = bboxes
+
+        return groups
+
+    def select_pred_bboxes(self, image_id, category_id, bbox_select='all', thres=None):
+        ''' Indices of the predicted boxes of one image that take part in the
+        evaluation, in the order of the json file '''
+        if (image_id, category_id) not in self.pred_bboxes:
+            return np.zeros(0, dtype=np.int64)
+
+        _, scores = self.pred_bboxes[(image_id, category_id)]
+        keep = np.arange(len(scores))
+        if thres is not None:
+            keep = keep[scores > thres]
+
+        if bbox_select == 'opi':
+            # first box with the highest (positive) score
+            if len(keep) == 0 or scores[keep].max() <= 0:
+                return keep[:0]
+            return keep[[np.argmax(scores[keep])]]
+        elif bbox_select == 'all':
+            return keep
+
+        return keep[:0]
+
+    def get_bboxes_arrays(self, category_id, bbox_select='all', thres=None):
+        ''' Boxes of one category taking part in the evaluation, computed once
+        per set of arguments
+
+        Returns:
+        gt_bboxes_list (list) - (G, 4) arrays of ground-truth boxes, one per image
+        pred_bboxes (np.ndarray) - (P, 4) selected predicted boxes of all images
+        pred_scores (np.ndarray) - (P,) their scores
+        pred_images (np.ndarray) - (P,) index of their image in gt_bboxes_list
+        '''
+        key = (category_id, bbox_select, thres)
+        if key in self._arrays:
+            return self._arrays[key]
+
+        empty_bboxes = np.zeros((0, 4), dtype=np.float64)
+        gt_bboxes_list = []
+        pred_bboxes = [empty_bboxes]
+        pred_scores = [np.zeros(0, dtype=np.float64)]
+        pred_images = [np.zeros(0, dtype=np.int64)]
+        for img_id, image_id in enumerate(self.image_ids):
+            gt_bboxes_list.append(self.gt_bboxes.get((image_id, category_id), empty_bboxes))
+
+            selected = self.select_pred_bboxes(image_id, category_id, bbox_select, thres)
+            if len(selected) > 0:
+                bboxes, scores = self.pred_bboxes[(image_id, category_id)]
+                pred_bboxes.append(bboxes[selected])
+                pred_scores.append(scores[selected])
+                pred_images.append(np.full(len(selected), img_id, dtype=np.int64))
+
+        self._arrays[key] = (gt_bboxes_list, np.concatenate(pred_bboxes),
+                             np.concatenate(pred_scores), np.concatenate(pred_images))
+        return self._arrays[key]
+
+    def get_bboxes_lists(self, category_id, bbox_select='all', thres=None):
+        ''' Same output as get_bboxes_lists '''
+        gt_bboxes_list, pred_bboxes, pred_scores, pred_images = \
+            self.get_bboxes_arrays(category_id, bbox_select=bbox_select, thres=thres)
+
+        pred_bboxes_list = [[] for _ in self.image_ids]
+        for bbox, score, img_id in zip(pred_bboxes.tolist(), pred_scores.tolist(), pred_images.tolist()):
+            pred_bboxes_list[img_id].append((*bbox, score, self.filenames[img_id]))
+
+        gt_bboxes_list = [[(*bbox, filename) for bbox in gt_bboxes.tolist()]
+                          for gt_bboxes, filename in zip(gt_bboxes_list, self.filenames)]
+
+        return gt_bboxes_list, pred_bboxes_list
+
+
 def get_bboxes_lists(gt_bboxes_json, pred_bboxes_json, category_id, bbox_select='all', thres=None):
     ''' Load ground-truth and predicted bounding boxes data of specific
-    category ID for evaluation
+    category ID for evaluation. Prefer building one BBoxesStore and calling
+    its get_bboxes_lists when evaluating several categories or metrics.
 
     Args:
     gt_bboxes_json (str): path to the ground-truth json file
@@ -376,57 +551,70 @@ def get_bboxes_lists(gt_bboxes_json, pred_bboxes_json, category_id, bbox_select=
     pred_bboxes_list (list) - list of predicted boxes
     '''
 
-    gt_json = json.read(gt_bboxes_json)
-    pred_json = json.read(pred_bboxes_json)
+    return BBoxesStore(gt_bboxes_json, pred_bboxes_json).get_bboxes_lists(
+        category_id, bbox_select=bbox_select, thres=thres)
 
-    gt_bboxes_list = []
-    pred_bboxes_list = []
 
-    # print('#test images:', len(gt_json['images']))
-    for image in gt_json['images']:
-        image_id = image['id']
-        filename = image['file_name']
+def benchmark_detection_matcher(num_preds=100000, num_images=2000, num_loop_images=100, seed=0):
+    ''' Time match_detections + detection_curves (IoU 0.75/0.5/0.25 and center
+    metric in one sweep) on a synthetic set, and check them against the
+    one-prediction-at-a-time loop on the first num_loop_images images (the
+    loop is quadratic in the number of predictions) '''
+    import time
 
-        gt_bboxes = []
-        for ann in gt_json['annotations']:
-            if ann['category_id'] != category_id:
-                continue
-            if ann['image_id'] == image_id:
-                x1, y1, w, h = ann['bbox']
-                x2 = x1 + w - 1
-                y2 = y1 + h - 1
-                gt_bboxes.append((x1, y1, x2, y2, filename))
-        gt_bboxes_list.append(gt_bboxes)
-
-        pred_bboxes = []
-        if bbox_select == 'opi':
-            best_score = 0
-            selected_bb = None
+    rng = np.random.RandomState(seed)
+    iou_thresholds = (0.75, 0.5, 0.25)
 
-        for pred in pred_json:
-            if pred['category_id'] != category_id:
-                continue
-            if pred['image_id'] == image_id:
-                x1, y1, w, h = pred['bbox']
-                x2 = x1 + w - 1
-                y2 = y1 + h - 1
-                s = pred['score']
-
-                if thres is not None and s <= thres:
-                    continue
-
-                if bbox_select == 'opi' and s > best_score:
-                    best_score = s
-                    selected_bb = (x1, y1, x2, y2, s, filename)
-                elif bbox_select == 'all':
-                    pred_bboxes.append((x1, y1, x2, y2, s, filename))
-
-        if bbox_select == 'opi' and selected_bb is not None:
-            pred_bboxes.append(selected_bb)
-
-        pred_bboxes_list.append(pred_bboxes)
-
-    return gt_bboxes_list, pred_bboxes_list
+    gt_bboxes_list = []
+    for _ in range(num_images):
+        xy = rng.randint(0, 1000, size=(rng.randint(0, 4), 2))
+        wh = rng.randint(10, 200, size=xy.shape)
+        gt_bboxes_list.append(np.concatenate([xy, xy + wh - 1], axis=1).astype(np.float64))
+
+    pred_images = np.sort(rng.randint(0, num_images, size=num_preds))
+    xy = rng.randint(0, 1000, size=(num_preds, 2))
+    wh = rng.randint(10, 200, size=(num_preds, 2))
+    for pred_id, img_id in enumerate(pred_images):
+        # half of the predictions jitter around a ground-truth box
+        if len(gt_bboxes_list[img_id]) > 0 and pred_id % 2 == 0:
+            gt_bbox = gt_bboxes_list[img_id][pred_id % len(gt_bboxes_list[img_id])]
+            xy[pred_id] = gt_bbox[:2] + rng.randint(-20, 21, size=2)
+            wh[pred_id] = gt_bbox[2:] - gt_bbox[:2] + 1 + rng.randint(-20, 21, size=2)
+    pred_bboxes = np.concatenate([xy, xy + wh - 1], axis=1).astype(np.float64)
+    pred_scores = np.round(rng.rand(num_preds), 3)
+
+    def vectorized(gt_bboxes_list, pred_bboxes, pred_scores, pred_images):
+        order, true_pos = match_detections(gt_bboxes_list, pred_bboxes, pred_scores, pred_images,
+                                           iou_thresholds=iou_thresholds, center=True)
+        total_pos = sum([len(gt_bboxes) for gt_bboxes in gt_bboxes_list])
+        return [detection_curves(metric_true_pos, pred_images[order], total_pos)
+                for metric_true_pos in true_pos]
+
+    start = time.time()
+    vectorized(gt_bboxes_list, pred_bboxes, pred_scores, pred_images)
+    vectorized_time = time.time() - start
+
+    # reference loop on a subset
+    subset = pred_images < num_loop_images
+    gt_subset = gt_bboxes_list[:num_loop_images]
+    start = time.time()
+    subset_results = vectorized(gt_subset, pred_bboxes[subset], pred_scores[subset], pred_images[subset])
+    subset_time = time.time() - start
+
+    gt_lists = [[(*bbox, '') for bbox in gt_bboxes.tolist()] for gt_bboxes in gt_subset]
+    pred_lists = [[] for _ in gt_subset]
+    for bbox, score, img_id in zip(pred_bboxes[subset].tolist(), pred_scores[subset].tolist(),
+                                   pred_images[subset].tolist()):
+        pred_lists[img_id].append((*bbox, score, ''))
+    start = time.time()
+    loop_results = [_detection_prec_rec_loop(gt_lists, pred_lists, iou_thres)[:4]
+                    for iou_thres in list(iou_thresholds) + [None]]
+    loop_time = time.time() - start
+
+    print(f'{num_preds} predictions, {num_images} images: {vectorized_time:.2f}s for the 4 metrics')
+    print(f'{subset.sum()} predictions, {num_loop_images} images: '
+          f'loop {loop_time:.2f}s, vectorized {subset_time:.3f}s, '
+          f'identical: {[tuple(r) for r in subset_results] == [tuple(r) for r in loop_results]}')
 
 
 if __name__ == '__main__':
@@ -440,42 +628,34 @@ if __name__ == '__main__':
     parser.add_argument("-s", "--save_path", help="choose path to save figure")
     parser.add_argument("--bbox_thres", type=float, help="choose threshold score for selecting bboxes")
     parser.add_argument("--log_title")
+    parser.add_argument("--benchmark", action='store_true',
+                        help="time the detection matcher on a synthetic set and exit")
 
     args = parser.parse_args()
     vars_dict = vars(args)
 
-    gt_json = json.read(args.gt_bboxes_json)
-    # print('Ground-Truth Categories:', gt_json['categories'])
-    gt_categories = gt_json['categories']
+    if args.benchmark:
+        benchmark_detection_matcher()
+        exit(0)
 
-    iou75_eval_log, iou75_eval_plot = all_classes_detection_prec_rec(
-        gt_categories,
-        args.gt_bboxes_json,
-        args.pred_bboxes_json,
-        args.bbox_select,
-        _iou_thres=0.75,
-        bbox_thres=args.bbox_thres)
-    iou50_eval_log, iou50_eval_plot = all_classes_detection_prec_rec(
-        gt_categories,
-        args.gt_bboxes_json,
-        args.pred_bboxes_json,
-        args.bbox_select,
-        _iou_thres=0.5,
-        bbox_thres=args.bbox_thres)
-    iou25_eval_log, iou25_eval_plot = all_classes_detection_prec_rec(
+    # both json files are read once for all the metrics and categories
+    bboxes_store = BBoxesStore(args.gt_bboxes_json, args.pred_bboxes_json)
+    # print('Ground-Truth Categories:', bboxes_store.categories)
+    gt_categories = bboxes_store.categories
+
+    # one matching sweep per class for all the metrics
+    eval_results = all_classes_detection_curves(
         gt_categories,
-        args.gt_bboxes_json,
-        args.pred_bboxes_json,
+        bboxes_store,
         args.bbox_select,
-        _iou_thres=0.25,
+        iou_thresholds=(0.75, 0.5, 0.25),
+        center=True,
         bbox_thres=args.bbox_thres)
+    iou75_eval_log, iou75_eval_plot = eval_results[0.75]
+    iou50_eval_log, iou50_eval_plot = eval_results[0.5]
+    iou25_eval_log, iou25_eval_plot = eval_results[0.25]
+    center_eval_log, center_eval_plot = eval_results['center']
     print(list(zip(iou25_eval_plot[1]['recalls'], iou25_eval_plot[1]['img_filenames'])))
-    center_eval_log, center_eval_plot = all_classes_detection_loose_prec_rec(
-        gt_categories,
-        args.gt_bboxes_json,
-        args.pred_bboxes_json,
-        args.bbox_select,
-        bbox_thres=args.bbox_thres)
 
     # Plot PR curves
     plot_pr_curve_true_pos_metric(args.save_path,
@@ -57,6 +57,14 @@ parser.add_option("--ckpt", dest="ckpt_path",
                   default=None, help="Path to load the model checkpoint")
 parser.add_option("--njobs", dest="num_workers", type=int,
                   default=0)
+parser.add_option("--test_every", dest="test_every", type=int,
+                  default=1, help="Evaluate on the test set every n epochs (0 to disable)")
+parser.add_option("--eval_cache", dest="eval_cache", choices=['none', 'ram', 'disk'],
+                  default='none', help="Cache the decoded val/test tensors across epochs in RAM or in a disk-backed file")
+parser.add_option("--eval_cache_size", dest="eval_cache_size", type=float,
+                  default=4096, help="Size cap of the val/test cache in MB, in total over all the DataLoader workers (least recently used samples are evicted)")
+parser.add_option("--eval_cache_dir", dest="eval_cache_dir",
+                  default=None, help="Directory of the disk-backed val/test cache (system tmp dir by default)")
 
 # Train one stage
 parser.add_option("--one_stage_training", dest="one_stage_training",
@@ -117,6 +125,9 @@ parser.add_option("--sim_func",
 parser.add_option("--margin",
                   dest="margin", type=float, default=3,
                   help="Hinge margin")
+parser.add_option("--imposter",
+                  dest="imposter", choices=['neighbor', 'hardest'],
+                  default='neighbor', help="Imposter of the ranking loss: next sample of the batch or hardest in-batch sample")
 
 options, _ = parser.parse_args()
 # config['hyperparams'] = {}
@@ -1,5 +1,4 @@
 import os
-import glob
 import pandas as pd
 import torch
 import numpy as np
@@ -9,12 +8,12 @@ import cv2
 import albumentations
 
 from torch.utils.data import Dataset
-from PIL import Image
 # from dataprocessing.process_cbis_ddsm import get_info_lesion
 from sklearn.preprocessing import label_binarize
 from natsort import natsorted
 
 from features_classification.train.train_utils import compute_classes_weights
+from features_classification.datasets.patch_store import glob_patches, open_patch
 
 
 class BCDR_Pathology_Dataset(Dataset):
@@ -30,8 +29,9 @@ class BCDR_Pathology_Dataset(Dataset):
         
     def __init__(self, mass_root_dir, calc_root_dir, microcalc_root_dir,
                  masscalc_root_dir, massmicrocalc_root_dir, calcmicrocalc_root_dir,
-                 bg_root_dir, transform=None):
+                 bg_root_dir, transform=None, packed=False):
         self.transform = transform
+        self.packed = packed
 
         self.mass_root_dir = mass_root_dir
         self.calc_root_dir = calc_root_dir
@@ -48,7 +48,7 @@ class BCDR_Pathology_Dataset(Dataset):
 
         for idx, class_name in enumerate(BCDR_Pathology_Dataset.classes):
             if class_name == 'BACKGROUND':
-                bg_images = glob.glob(os.path.join(bg_root_dir, '*.png'))
+                bg_images = glob_patches(bg_root_dir, self.packed)
                 self.images_list += bg_images
                 self.labels += [idx] * len(bg_images)
 
@@ -59,54 +59,42 @@ class BCDR_Pathology_Dataset(Dataset):
                 pathology, lesion_type = class_name.split('_')
 
                 if lesion_type == 'MASS':
-                    mass_images = glob.glob(os.path.join(
-                        mass_root_dir, pathology, '*.png'
-                    ))
+                    mass_images = glob_patches(os.path.join(mass_root_dir, pathology), self.packed)
                     self.images_list += mass_images
                     self.labels += [idx] * len(mass_images)
 
                     # if len(mass_images) == 0:
                     #     raise ValueError
                 elif lesion_type == 'CALC':
-                    calc_images = glob.glob(os.path.join(
-                        calc_root_dir, pathology, '*.png'
-                    ))
+                    calc_images = glob_patches(os.path.join(calc_root_dir, pathology), self.packed)
                     self.images_list += calc_images
                     self.labels += [idx] * len(calc_images)
 
                     # if len(calc_images) == 0:
                     #     raise ValueError
                 elif lesion_type == 'MICROCALC':
-                    microcalc_images = glob.glob(os.path.join(
-                        microcalc_root_dir, pathology, '*.png'
-                    ))
+                    microcalc_images = glob_patches(os.path.join(microcalc_root_dir, pathology), self.packed)
                     self.images_list += microcalc_images
                     self.labels += [idx] * len(microcalc_images)
 
                     # if len(microcalc_images) == 0:
                     #     raise ValueError
                 elif lesion_type == 'MASS-CALC':
-                    masscalc_images = glob.glob(os.path.join(
-                        masscalc_root_dir, pathology, '*.png'
-                    ))
+                    masscalc_images = glob_patches(os.path.join(masscalc_root_dir, pathology), self.packed)
                     self.images_list += masscalc_images
                     self.labels += [idx] * len(masscalc_images)
 
                     if len(masscalc_images) == 0:
                         raise ValueError
                 elif lesion_type == 'MASS-MICROCALC':
-                    massmicrocalc_images = glob.glob(os.path.join(
-                        massmicrocalc_root_dir, pathology, '*.png'
-                    ))
+                    massmicrocalc_images = glob_patches(os.path.join(massmicrocalc_root_dir, pathology), self.packed)
                     self.images_list += massmicrocalc_images
                     self.labels += [idx] * len(massmicrocalc_images)
 
                     # if len(massmicrocalc_images) == 0:
                     #     raise ValueError
                 elif lesion_type == 'CALC-MICROCALC':
-                    calcmicrocalc_images = glob.glob(os.path.join(
-                        calcmicrocalc_root_dir, pathology, '*.png'
-                    ))
+                    calcmicrocalc_images = glob_patches(os.path.join(calcmicrocalc_root_dir, pathology), self.packed)
                     self.images_list += calcmicrocalc_images
                     self.labels += [idx] * len(calcmicrocalc_images)
 
@@ -128,7 +116,7 @@ class BCDR_Pathology_Dataset(Dataset):
 
         img_path = self.images_list[idx]
         img_name, _ = os.path.splitext(os.path.basename(img_path))
-        image = Image.open(img_path)
+        image = open_patch(img_path, self.packed)
 
         if image.mode == 'L':
             image = image.convert("RGB")
@@ -152,8 +140,9 @@ class BCDR_Pathology_RandomCrops_Dataset(Dataset):
     classes = np.array(['BACKGROUND'])
 
         
-    def __init__(self, bg_root_dir, transform=None):
+    def __init__(self, bg_root_dir, transform=None, packed=False):
         self.transform = transform
+        self.packed = packed
 
         self.bg_root_dir = bg_root_dir
 
@@ -162,7 +151,7 @@ class BCDR_Pathology_RandomCrops_Dataset(Dataset):
 
         for idx, class_name in enumerate(BCDR_Pathology_RandomCrops_Dataset.classes):
             if class_name == 'BACKGROUND':
-                bg_images = glob.glob(os.path.join(bg_root_dir, '*.png'))
+                bg_images = glob_patches(bg_root_dir, self.packed)
                 self.images_list += bg_images
                 self.labels += [idx] * len(bg_images)
 
@@ -185,7 +174,7 @@ class BCDR_Pathology_RandomCrops_Dataset(Dataset):
 
         img_path = self.images_list[idx]
         img_name, _ = os.path.splitext(os.path.basename(img_path))
-        image = Image.open(img_path)
+        image = open_patch(img_path, self.packed)
 
         if image.mode == 'L':
             image = image.convert("RGB")
@@ -216,8 +205,9 @@ class All_BCDR_Pathology_Dataset(Dataset):
 
         
     def __init__(self, film_root, digital_root, data_type='pathology',
-                 transform=None, use_dn01=False):
+                 transform=None, use_dn01=False, packed=False):
         self.transform = transform
+        self.packed = packed
 
         F01_cls_root = os.path.join(film_root, 'BCDR-F01_dataset', 'cls')
         F01_dataset = BCDR_Pathology_Dataset(
@@ -228,7 +218,8 @@ class All_BCDR_Pathology_Dataset(Dataset):
             os.path.join(F01_cls_root, 'mass_microcalc', data_type),
             os.path.join(F01_cls_root, 'calc_microcalc', data_type),
             os.path.join(F01_cls_root, 'background', 'background_tfds'),
-            transform=transform
+            transform=transform,
+            packed=packed
         )
 
         F02_cls_root = os.path.join(film_root, 'BCDR-F02_dataset', 'cls')
@@ -240,7 +231,8 @@ class All_BCDR_Pathology_Dataset(Dataset):
             os.path.join(F02_cls_root, 'mass_microcalc', data_type),
             os.path.join(F02_cls_root, 'calc_microcalc', data_type),
             os.path.join(F02_cls_root, 'background', 'background_tfds'),
-            transform=transform
+            transform=transform,
+            packed=packed
         )
 
         F03_cls_root = os.path.join(film_root, 'BCDR-F03_dataset', 'cls')
@@ -252,7 +244,8 @@ class All_BCDR_Pathology_Dataset(Dataset):
             os.path.join(F03_cls_root, 'mass_microcalc', data_type),
             os.path.join(F03_cls_root, 'calc_microcalc', data_type),
             os.path.join(F03_cls_root, 'background', 'background_tfds'),
-            transform=transform
+            transform=transform,
+            packed=packed
         )
 
         D01_cls_root = os.path.join(digital_root, 'BCDR-D01_dataset', 'cls')
@@ -264,7 +257,8 @@ class All_BCDR_Pathology_Dataset(Dataset):
             os.path.join(D01_cls_root, 'mass_microcalc', data_type),
             os.path.join(D01_cls_root, 'calc_microcalc', data_type),
             os.path.join(D01_cls_root, 'background', 'background_tfds'),
-            transform=transform
+            transform=transform,
+            packed=packed
         )
 
         D02_cls_root = os.path.join(digital_root, 'BCDR-D02_dataset', 'cls')
@@ -276,7 +270,8 @@ class All_BCDR_Pathology_Dataset(Dataset):
             os.path.join(D02_cls_root, 'mass_microcalc', data_type),
             os.path.join(D02_cls_root, 'calc_microcalc', data_type),
             os.path.join(D02_cls_root, 'background', 'background_tfds'),
-            transform=transform
+            transform=transform,
+            packed=packed
         )
 
         self.images_list = \
@@ -307,7 +302,8 @@ class All_BCDR_Pathology_Dataset(Dataset):
         if use_dn01:
             DN01_cls_root = os.path.join(digital_root, 'BCDR-DN01_dataset', 'cls')
             DN01_dataset = BCDR_Pathology_RandomCrops_Dataset(
-                os.path.join(DN01_cls_root, 'background', 'background_tfds')
+                os.path.join(DN01_cls_root, 'background', 'background_tfds'),
+                packed=packed
             )
             if len(DN01_dataset.get_images_list()) == 0:
                 raise ValueError
@@ -330,7 +326,7 @@ class All_BCDR_Pathology_Dataset(Dataset):
 
         img_path = self.images_list[idx]
         img_name, _ = os.path.splitext(os.path.basename(img_path))
-        image = Image.open(img_path)
+        image = open_patch(img_path, self.packed)
 
         if image.mode == 'L':
             image = image.convert("RGB")
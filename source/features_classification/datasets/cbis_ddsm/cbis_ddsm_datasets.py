@@ -1,5 +1,4 @@
 import os
-import glob
 import pandas as pd
 import torch
 import numpy as np
@@ -9,7 +8,6 @@ import cv2
 import albumentations
 
 from torch.utils.data import Dataset
-from PIL import Image
 from sklearn.preprocessing import label_binarize
 from natsort import natsorted
 
@@ -17,18 +15,8 @@ from features_classification.train.train_utils import compute_classes_weights
 from features_classification.train.train_utils import compute_classes_weights_mass_calc
 from features_classification.train.train_utils import compute_classes_weights_mass_calc_pathology_4class
 from features_classification.train.train_utils import compute_classes_weights_mass_calc_pathology_5class
-
-
-def get_info_lesion(df, ROI_ID):
-    _, _, patient_id, left_or_right, image_view, abnormality_id = ROI_ID.split(
-        '_')
-
-    rslt_df = df[(df['patient_id'] == ('P_' + patient_id)) &
-                 (df['left or right breast'] == left_or_right) &
-                 (df['image view'] == image_view) &
-                 (df['abnormality id'] == int(abnormality_id))]
-
-    return rslt_df
+from utilities.datautil.lesion_index import LesionIndex
+from features_classification.datasets.patch_store import glob_patches, open_patch
 
 
 class Mass_Shape_Dataset(Dataset):
@@ -84,19 +72,22 @@ class Mass_Shape_Dataset(Dataset):
         return new_combined_class
 
 
-    def __init__(self, root_dir, transform=None, train_rate=1):
+    def __init__(self, root_dir, transform=None, train_rate=1, packed=False):
         self.root_dir = root_dir
         self.transform = transform
+        self.packed = packed
         self.train_rate = train_rate
 
         self.images_list = []
         self.labels = []
+        self.image_counts = dict()
 
         self.all_classes = np.concatenate((Mass_Shape_Dataset.classes,
                                            Mass_Shape_Dataset.combined_classes))
 
         for idx, mass_shape in enumerate(self.all_classes):
-            images = glob.glob(os.path.join(root_dir, mass_shape, '*.png'))
+            images = glob_patches(os.path.join(root_dir, mass_shape), self.packed)
+            self.image_counts[os.path.join(root_dir, mass_shape)] = len(images)
 
             # For training using part of data
             images_len = len(images)
@@ -110,7 +101,8 @@ class Mass_Shape_Dataset(Dataset):
         classes_weights = compute_classes_weights(
             data_root=self.root_dir,
             classes_names=Mass_Shape_Dataset.classes,
-            combined_classes_names=Mass_Shape_Dataset.combined_classes
+            combined_classes_names=Mass_Shape_Dataset.combined_classes,
+            image_counts=self.image_counts
         )
         return classes_weights
 
@@ -123,7 +115,7 @@ class Mass_Shape_Dataset(Dataset):
 
         img_path = self.images_list[idx]
         img_name, _ = os.path.splitext(os.path.basename(img_path))
-        image = Image.open(img_path)
+        image = open_patch(img_path, self.packed)
 
         if image.mode == 'L':
             image = image.convert("RGB")
@@ -200,19 +192,22 @@ class Mass_Margins_Dataset(Dataset):
         return new_combined_class
 
 
-    def __init__(self, root_dir, transform=None, train_rate=1):
+    def __init__(self, root_dir, transform=None, train_rate=1, packed=False):
         self.root_dir = root_dir
         self.transform = transform
+        self.packed = packed
         self.train_rate = train_rate
 
         self.images_list = []
         self.labels = []
+        self.image_counts = dict()
 
         self.all_classes = np.concatenate((Mass_Margins_Dataset.classes,
                                            Mass_Margins_Dataset.combined_classes))
 
         for idx, mass_margins in enumerate(self.all_classes):
-            images = glob.glob(os.path.join(root_dir, mass_margins, '*.png'))
+            images = glob_patches(os.path.join(root_dir, mass_margins), self.packed)
+            self.image_counts[os.path.join(root_dir, mass_margins)] = len(images)
 
             # For training using part of data
             images_len = len(images)
@@ -226,7 +221,8 @@ class Mass_Margins_Dataset(Dataset):
         classes_weights = compute_classes_weights(
             data_root=self.root_dir,
             classes_names=Mass_Margins_Dataset.classes,
-            combined_classes_names=Mass_Margins_Dataset.combined_classes
+            combined_classes_names=Mass_Margins_Dataset.combined_classes,
+            image_counts=self.image_counts
         )
         return classes_weights
 
@@ -239,7 +235,7 @@ class Mass_Margins_Dataset(Dataset):
 
         img_path = self.images_list[idx]
         img_name, _ = os.path.splitext(os.path.basename(img_path))
-        image = Image.open(img_path)
+        image = open_patch(img_path, self.packed)
 
         if image.mode == 'L':
             image = image.convert("RGB")
@@ -333,19 +329,22 @@ class Calc_Type_Dataset(Dataset):
         return new_combined_class
 
 
-    def __init__(self, root_dir, transform=None, train_rate=1):
+    def __init__(self, root_dir, transform=None, train_rate=1, packed=False):
         self.root_dir = root_dir
         self.transform = transform
+        self.packed = packed
         self.train_rate = train_rate
 
         self.images_list = []
         self.labels = []
+        self.image_counts = dict()
 
         self.all_classes = np.concatenate((Calc_Type_Dataset.classes,
                                            Calc_Type_Dataset.combined_classes))
 
         for idx, calc_type in enumerate(self.all_classes):
-            images = glob.glob(os.path.join(root_dir, calc_type, '*.png'))
+            images = glob_patches(os.path.join(root_dir, calc_type), self.packed)
+            self.image_counts[os.path.join(root_dir, calc_type)] = len(images)
 
             # For training using part of data
             images_len = len(images)
@@ -359,7 +358,8 @@ class Calc_Type_Dataset(Dataset):
         classes_weights = compute_classes_weights(
             data_root=self.root_dir,
             classes_names=Calc_Type_Dataset.classes,
-            combined_classes_names=Calc_Type_Dataset.combined_classes
+            combined_classes_names=Calc_Type_Dataset.combined_classes,
+            image_counts=self.image_counts
         )
         return classes_weights
 
@@ -372,7 +372,7 @@ class Calc_Type_Dataset(Dataset):
 
         img_path = self.images_list[idx]
         img_name, _ = os.path.splitext(os.path.basename(img_path))
-        image = Image.open(img_path)
+        image = open_patch(img_path, self.packed)
 
         if image.mode == 'L':
             image = image.convert("RGB")
@@ -438,19 +438,22 @@ class Calc_Dist_Dataset(Dataset):
         return new_combined_class
 
 
-    def __init__(self, root_dir, transform=None, train_rate=1):
+    def __init__(self, root_dir, transform=None, train_rate=1, packed=False):
         self.root_dir = root_dir
         self.transform = transform
+        self.packed = packed
         self.train_rate = train_rate
 
         self.images_list = []
         self.labels = []
+        self.image_counts = dict()
 
         self.all_classes = np.concatenate((Calc_Dist_Dataset.classes,
                                            Calc_Dist_Dataset.combined_classes))
 
         for idx, mass_shape in enumerate(self.all_classes):
-            images = glob.glob(os.path.join(root_dir, mass_shape, '*.png'))
+            images = glob_patches(os.path.join(root_dir, mass_shape), self.packed)
+            self.image_counts[os.path.join(root_dir, mass_shape)] = len(images)
 
             # For training using part of data
             images_len = len(images)
@@ -464,7 +467,8 @@ class Calc_Dist_Dataset(Dataset):
         classes_weights = compute_classes_weights(
             data_root=self.root_dir,
             classes_names=Calc_Dist_Dataset.classes,
-            combined_classes_names=Calc_Dist_Dataset.combined_classes
+            combined_classes_names=Calc_Dist_Dataset.combined_classes,
+            image_counts=self.image_counts
         )
         return classes_weights
 
@@ -477,7 +481,7 @@ class Calc_Dist_Dataset(Dataset):
 
         img_path = self.images_list[idx]
         img_name, _ = os.path.splitext(os.path.basename(img_path))
-        image = Image.open(img_path)
+        image = open_patch(img_path, self.packed)
 
         if image.mode == 'L':
             image = image.convert("RGB")
@@ -500,19 +504,21 @@ class Calc_Dist_Dataset(Dataset):
 class Breast_Density_Dataset(Dataset):
     classes = np.array(['1', '2', '3', '4'])
 
-    def __init__(self, mass_root_dir, calc_root_dir, transform=None, train_rate=1):
+    def __init__(self, mass_root_dir, calc_root_dir, transform=None, train_rate=1, packed=False):
         self.mass_root_dir = mass_root_dir
         self.calc_root_dir = calc_root_dir
         self.transform = transform
+        self.packed = packed
         self.train_rate = train_rate
 
         self.images_list = []
         self.labels = []
+        self.image_counts = dict()
 
         for idx, breast_density in enumerate(Breast_Density_Dataset.classes):
             #### Mass ####
-            mass_images = glob.glob(os.path.join(
-                mass_root_dir, str(breast_density), '*.png'))
+            mass_images = glob_patches(os.path.join(mass_root_dir, str(breast_density)), self.packed)
+            self.image_counts[os.path.join(mass_root_dir, str(breast_density))] = len(mass_images)
 
             # For training using part of data
             mass_images_len = len(mass_images)
@@ -522,8 +528,8 @@ class Breast_Density_Dataset(Dataset):
             self.labels += [idx] * len(mass_images)
 
             #### Calc ####
-            calc_images = glob.glob(os.path.join(
-                calc_root_dir, str(breast_density), '*.png'))
+            calc_images = glob_patches(os.path.join(calc_root_dir, str(breast_density)), self.packed)
+            self.image_counts[os.path.join(calc_root_dir, str(breast_density))] = len(calc_images)
 
             # For training using part of data
             calc_images_len = len(calc_images)
@@ -536,7 +542,8 @@ class Breast_Density_Dataset(Dataset):
         classes_weights = compute_classes_weights_mass_calc(
             mass_root=self.mass_root_dir,
             calc_root=self.calc_root_dir,
-            classes_names=Breast_Density_Dataset.classes
+            classes_names=Breast_Density_Dataset.classes,
+            image_counts=self.image_counts
         )
         return classes_weights
 
@@ -549,7 +556,7 @@ class Breast_Density_Dataset(Dataset):
 
         img_path = self.images_list[idx]
         img_name, _ = os.path.splitext(os.path.basename(img_path))
-        image = Image.open(img_path)
+        image = open_patch(img_path, self.packed)
         label = self.labels[idx]
 
         if self.transform:
@@ -561,22 +568,26 @@ class Breast_Density_Dataset(Dataset):
 class Pathology_Dataset(Dataset):
     classes = np.array(['BENIGN', 'MALIGNANT'])
 
-    def __init__(self, root_dir, transform=None):
+    def __init__(self, root_dir, transform=None, packed=False):
         self.root_dir = root_dir
         self.transform = transform
+        self.packed = packed
 
         self.images_list = []
         self.labels = []
+        self.image_counts = dict()
 
         for idx, pathology in enumerate(Pathology_Dataset.classes):
-            images = glob.glob(os.path.join(root_dir, pathology, '*.png'))
+            images = glob_patches(os.path.join(root_dir, pathology), self.packed)
+            self.image_counts[os.path.join(root_dir, pathology)] = len(images)
             self.images_list += images
             self.labels += [idx] * len(images)
 
     def get_classes_weights(self):
         classes_weights = compute_classes_weights(
             data_root=self.root_dir,
-            classes_names=Pathology_Dataset.classes)
+            classes_names=Pathology_Dataset.classes,
+            image_counts=self.image_counts)
         return classes_weights
 
     def __len__(self):
@@ -588,7 +599,7 @@ class Pathology_Dataset(Dataset):
 
         img_path = self.images_list[idx]
         img_name, _ = os.path.splitext(os.path.basename(img_path))
-        image = Image.open(img_path)
+        image = open_patch(img_path, self.packed)
         label = self.labels[idx]
 
         if self.transform:
@@ -600,22 +611,24 @@ class Pathology_Dataset(Dataset):
 class Mass_Calc_Pathology_Dataset(Dataset):
     classes = np.array(['BENIGN', 'MALIGNANT'])
 
-    def __init__(self, mass_root_dir, calc_root_dir, transform=None, train_rate=1):
+    def __init__(self, mass_root_dir, calc_root_dir, transform=None, train_rate=1, packed=False):
         self.transform = transform
+        self.packed = packed
         self.mass_root_dir = mass_root_dir
         self.calc_root_dir = calc_root_dir
 
         self.images_list = []
         self.labels = []
+        self.image_counts = dict()
 
         for idx, pathology in enumerate(Mass_Calc_Pathology_Dataset.classes):
-            mass_images = glob.glob(os.path.join(
-                mass_root_dir, pathology, '*.png'))
+            mass_images = glob_patches(os.path.join(mass_root_dir, pathology), self.packed)
+            self.image_counts[os.path.join(mass_root_dir, pathology)] = len(mass_images)
             self.images_list += mass_images
             self.labels += [idx] * len(mass_images)
 
-            calc_images = glob.glob(os.path.join(
-                calc_root_dir, pathology, '*.png'))
+            calc_images = glob_patches(os.path.join(calc_root_dir, pathology), self.packed)
+            self.image_counts[os.path.join(calc_root_dir, pathology)] = len(calc_images)
             self.images_list += calc_images
             self.labels += [idx] * len(calc_images)
 
@@ -623,7 +636,8 @@ class Mass_Calc_Pathology_Dataset(Dataset):
         classes_weights = compute_classes_weights_mass_calc(
             mass_root=self.mass_root_dir,
             calc_root=self.calc_root_dir,
-            classes_names=Mass_Calc_Pathology_Dataset.classes
+            classes_names=Mass_Calc_Pathology_Dataset.classes,
+            image_counts=self.image_counts
         )
         return classes_weights
 
@@ -636,7 +650,7 @@ class Mass_Calc_Pathology_Dataset(Dataset):
 
         img_path = self.images_list[idx]
         img_name, _ = os.path.splitext(os.path.basename(img_path))
-        image = Image.open(img_path)
+        image = open_patch(img_path, self.packed)
         label = self.labels[idx]
 
         if self.transform:
@@ -648,25 +662,27 @@ class Mass_Calc_Pathology_Dataset(Dataset):
 class Four_Classes_Mass_Calc_Pathology_Dataset(Dataset):
     classes = np.array(['BENIGN_MASS', 'MALIGNANT_MASS', 'BENIGN_CALC', 'MALIGNANT_CALC'])
 
-    def __init__(self, mass_root_dir, calc_root_dir, transform=None, train_rate=1):
+    def __init__(self, mass_root_dir, calc_root_dir, transform=None, train_rate=1, packed=False):
         '''
         Args:
         train_rate(float) - part of training data you want to use for training. This is for plotting the learning curve
         '''
         self.transform = transform
+        self.packed = packed
         self.train_rate = train_rate
         self.mass_root_dir = mass_root_dir
         self.calc_root_dir = calc_root_dir
 
         self.images_list = []
         self.labels = []
+        self.image_counts = dict()
 
         for idx, class_name in enumerate(Four_Classes_Mass_Calc_Pathology_Dataset.classes):
             pathology, lesion_type = class_name.split('_')
 
             if lesion_type == 'MASS':
-                mass_images = glob.glob(os.path.join(
-                    mass_root_dir, pathology, '*.png'))
+                mass_images = glob_patches(os.path.join(mass_root_dir, pathology), self.packed)
+                self.image_counts[os.path.join(mass_root_dir, pathology)] = len(mass_images)
 
                 if self.train_rate is not None:
                     mass_images_len = len(mass_images)
@@ -675,8 +691,8 @@ class Four_Classes_Mass_Calc_Pathology_Dataset(Dataset):
                 self.images_list += mass_images
                 self.labels += [idx] * len(mass_images)
             elif lesion_type == 'CALC':
-                calc_images = glob.glob(os.path.join(
-                    calc_root_dir, pathology, '*.png'))
+                calc_images = glob_patches(os.path.join(calc_root_dir, pathology), self.packed)
+                self.image_counts[os.path.join(calc_root_dir, pathology)] = len(calc_images)
 
                 if self.train_rate is not None:
                     calc_images_len = len(calc_images)
@@ -689,7 +705,8 @@ class Four_Classes_Mass_Calc_Pathology_Dataset(Dataset):
         classes_weights = compute_classes_weights_mass_calc_pathology_4class(
             mass_root=self.mass_root_dir,
             calc_root=self.calc_root_dir,
-            classes_names=Four_Classes_Mass_Calc_Pathology_Dataset.classes
+            classes_names=Four_Classes_Mass_Calc_Pathology_Dataset.classes,
+            image_counts=self.image_counts
         )
         return classes_weights
 
@@ -703,7 +720,7 @@ class Four_Classes_Mass_Calc_Pathology_Dataset(Dataset):
         img_path = self.images_list[idx]
         img_name, _ = os.path.splitext(os.path.basename(img_path))
 
-        image = Image.open(img_path)
+        image = open_patch(img_path, self.packed)
 
         if image.mode == 'L':
             image = image.convert("RGB")
@@ -724,19 +741,22 @@ class Four_Classes_Mass_Calc_Pathology_Dataset(Dataset):
 class Five_Classes_Mass_Calc_Pathology_Dataset(Dataset):
     classes = np.array(['BACKGROUND', 'BENIGN_MASS', 'MALIGNANT_MASS', 'BENIGN_CALC', 'MALIGNANT_CALC'])
 
-    def __init__(self, mass_root_dir, calc_root_dir, bg_root_dir, transform=None):
+    def __init__(self, mass_root_dir, calc_root_dir, bg_root_dir, transform=None, packed=False):
         self.transform = transform
+        self.packed = packed
         self.mass_root_dir = mass_root_dir
         self.calc_root_dir = calc_root_dir
         self.bg_root_dir = bg_root_dir
 
         self.images_list = []
         self.labels = []
+        self.image_counts = dict()
 
 
         for idx, class_name in enumerate(Five_Classes_Mass_Calc_Pathology_Dataset.classes):
             if class_name == 'BACKGROUND':
-                bg_images = glob.glob(os.path.join(bg_root_dir, class_name, '*.png'))
+                bg_images = glob_patches(os.path.join(bg_root_dir, class_name), self.packed)
+                self.image_counts[os.path.join(bg_root_dir, class_name)] = len(bg_images)
                 self.images_list += bg_images
                 self.labels += [idx] * len(bg_images)
 
@@ -746,16 +766,16 @@ class Five_Classes_Mass_Calc_Pathology_Dataset(Dataset):
                 pathology, lesion_type = class_name.split('_')
 
                 if lesion_type == 'MASS':
-                    mass_images = glob.glob(os.path.join(
-                        mass_root_dir, pathology, '*.png'))
+                    mass_images = glob_patches(os.path.join(mass_root_dir, pathology), self.packed)
+                    self.image_counts[os.path.join(mass_root_dir, pathology)] = len(mass_images)
                     self.images_list += mass_images
                     self.labels += [idx] * len(mass_images)
 
                     if len(mass_images) == 0:
                         raise ValueError
                 elif lesion_type == 'CALC':
-                    calc_images = glob.glob(os.path.join(
-                        calc_root_dir, pathology, '*.png'))
+                    calc_images = glob_patches(os.path.join(calc_root_dir, pathology), self.packed)
+                    self.image_counts[os.path.join(calc_root_dir, pathology)] = len(calc_images)
                     self.images_list += calc_images
                     self.labels += [idx] * len(calc_images)
 
@@ -772,8 +792,9 @@ class Five_Classes_Mass_Calc_Pathology_Dataset(Dataset):
         classes_weights = compute_classes_weights_mass_calc_pathology_5class(
             mass_root=self.mass_root_dir,
             calc_root=self.calc_root_dir,
-            bg_root=os.path.join(self.bg_root_dir, 'train'),
-            classes_names=Five_Classes_Mass_Calc_Pathology_Dataset.classes
+            bg_root=os.path.join(self.bg_root_dir, 'BACKGROUND'),
+            classes_names=Five_Classes_Mass_Calc_Pathology_Dataset.classes,
+            image_counts=self.image_counts
         )
         return classes_weights
 
@@ -787,7 +808,7 @@ class Five_Classes_Mass_Calc_Pathology_Dataset(Dataset):
 
         img_path = self.images_list[idx]
         img_name, _ = os.path.splitext(os.path.basename(img_path))
-        image = Image.open(img_path)
+        image = open_patch(img_path, self.packed)
 
         if image.mode == 'L':
             image = image.convert("RGB")
@@ -809,13 +830,16 @@ class Five_Classes_Mass_Calc_Pathology_Dataset(Dataset):
 class  Four_Classes_Features_Pathology_Dataset(Dataset):
     classes = np.array(['BENIGN_MASS', 'MALIGNANT_MASS', 'BENIGN_CALC', 'MALIGNANT_CALC'])
 
-    def __init__(self, mass_annotation_file, mass_root_dir, calc_annotation_file, calc_root_dir, uncertainty=0, missed_feats_num=0, missing_feats_fill='zeroes', transform=None, train_rate=1):
+    def __init__(self, mass_annotation_file, mass_root_dir, calc_annotation_file, calc_root_dir, uncertainty=0, missed_feats_num=0, missing_feats_fill='zeroes', transform=None, train_rate=1, packed=False):
         self.mass_annotations = pd.read_csv(mass_annotation_file)
         self.calc_annotations = pd.read_csv(calc_annotation_file)
+        self.mass_index = LesionIndex(self.mass_annotations)
+        self.calc_index = LesionIndex(self.calc_annotations)
         self.uncertainty = uncertainty
         self.missed_feats_num = missed_feats_num
         self.missing_feats_fill = missing_feats_fill
         self.transform = transform
+        self.packed = packed
         self.train_rate = train_rate
 
         self.mass_root_dir = mass_root_dir
@@ -823,13 +847,14 @@ class  Four_Classes_Features_Pathology_Dataset(Dataset):
 
         self.images_list = []
         self.labels = []
+        self.image_counts = dict()
         self.lesion_types = []
 
         for idx, cls in enumerate(Four_Classes_Features_Pathology_Dataset.classes):
             pathology, lesion_type = cls.split("_")
             if lesion_type == "MASS":
-                mass_images = glob.glob(os.path.join(
-                    mass_root_dir, pathology, '*.png'))
+                mass_images = glob_patches(os.path.join(mass_root_dir, pathology), self.packed)
+                self.image_counts[os.path.join(mass_root_dir, pathology)] = len(mass_images)
 
                 if self.train_rate is not None:
                     mass_images_len = len(mass_images)
@@ -839,8 +864,8 @@ class  Four_Classes_Features_Pathology_Dataset(Dataset):
                 self.labels += [idx] * len(mass_images)
                 self.lesion_types += ['MASS'] * len(mass_images)
             else:
-                calc_images = glob.glob(os.path.join(
-                    calc_root_dir, pathology, '*.png'))
+                calc_images = glob_patches(os.path.join(calc_root_dir, pathology), self.packed)
+                self.image_counts[os.path.join(calc_root_dir, pathology)] = len(calc_images)
 
                 if self.train_rate is not None:
                     calc_images_len = len(calc_images)
@@ -851,15 +876,22 @@ class  Four_Classes_Features_Pathology_Dataset(Dataset):
                 self.lesion_types += ['CALC'] * len(calc_images)
 
         # For random feature values
-        self.mass_feats_dist = Four_Classes_Features_Pathology_Dataset.get_mass_feats_empirical_dist(self.images_list, self.lesion_types, self.mass_annotations)
-        self.calc_feats_dist = Four_Classes_Features_Pathology_Dataset.get_calc_feats_empirical_dist(self.images_list, self.lesion_types, self.calc_annotations)
+        self.mass_feats_dist = Four_Classes_Features_Pathology_Dataset.get_mass_feats_empirical_dist(self.images_list, self.lesion_types, self.mass_index)
+        self.calc_feats_dist = Four_Classes_Features_Pathology_Dataset.get_calc_feats_empirical_dist(self.images_list, self.lesion_types, self.calc_index)
+
+        # Clinical vectors are deterministic per sample, so build them once;
+        # __getitem__ only applies the random masking/sampling on top
+        self.feature_table = self.build_feature_table()
+        self.mass_feats_table, self.calc_feats_table = self.build_empirical_feats_tables()
+        self.feats_blocks = Four_Classes_Features_Pathology_Dataset.build_feats_blocks()
 
 
     def get_classes_weights(self):
         classes_weights = compute_classes_weights_mass_calc_pathology_4class(
             mass_root=self.mass_root_dir,
             calc_root=self.calc_root_dir,
-            classes_names=Four_Classes_Mass_Calc_Pathology_Dataset.classes
+            classes_names=Four_Classes_Mass_Calc_Pathology_Dataset.classes,
+            image_counts=self.image_counts
         )
         return classes_weights
 
@@ -986,8 +1018,79 @@ class  Four_Classes_Features_Pathology_Dataset(Dataset):
 
         return ret, one_hot_breast_density
 
+    # Layout of the clinical feature vector:
+    # [breast density (4) | mass shape (8), mass margins (5) | calc type (14), calc distribution (5)]
+    FEATS_DIM = 36
+    MASS_FEATS_SLICE = slice(4, 17)
+    CALC_FEATS_SLICE = slice(17, 36)
+    # slots zeroed by each entry of ignore_vector
+    FEATS_BLOCKS = {
+        'MASS': [slice(0, 4), slice(4, 12), slice(12, 17)],
+        'CALC': [slice(0, 4), slice(17, 31), slice(31, 36)]
+    }
+
+    def build_feature_table(self):
+        '''Clinical vector of every sample (without missing features filled) as a float32 array'''
+        feature_table = np.zeros((len(self.images_list), Four_Classes_Features_Pathology_Dataset.FEATS_DIM),
+                                 dtype=np.float32)
+
+        for idx, (img_path, lesion_type) in enumerate(zip(self.images_list, self.lesion_types)):
+            img_name, _ = os.path.splitext(os.path.basename(img_path))
+
+            if lesion_type == 'MASS':
+                breast_density = self.mass_index.get(img_name, 'breast_density')
+                mass_shape = self.mass_index.get(img_name, 'mass shape')
+                mass_margins = self.mass_index.get(img_name, 'mass margins')
+                feature_vector, breast_density_1hot = Four_Classes_Features_Pathology_Dataset.convert_mass_feats_1hot(
+                    breast_density, mass_shape, mass_margins)
+
+                feature_table[idx, Four_Classes_Features_Pathology_Dataset.MASS_FEATS_SLICE] = feature_vector
+            elif lesion_type == 'CALC':
+                breast_density = self.calc_index.get(img_name, 'breast density')
+                calc_type = self.calc_index.get(img_name, 'calc type')
+                calc_distribution = self.calc_index.get(img_name, 'calc distribution')
+                feature_vector, breast_density_1hot = Four_Classes_Features_Pathology_Dataset.convert_calc_feats_1hot(
+                    breast_density, calc_type, calc_distribution)
+
+                feature_table[idx, Four_Classes_Features_Pathology_Dataset.CALC_FEATS_SLICE] = feature_vector
+
+            feature_table[idx, :4] = breast_density_1hot
+
+        return feature_table
+
+    def build_empirical_feats_tables(self):
+        '''Vectors for empirical sampling of the missing lesion type features.
+        Rows follow the iteration order of mass_feats_dist/calc_feats_dist'''
+        mass_feats_table = np.zeros((len(self.mass_feats_dist), Four_Classes_Features_Pathology_Dataset.FEATS_DIM),
+                                    dtype=np.float32)
+        for idx, (mass_shape, mass_margins) in enumerate(self.mass_feats_dist):
+            mass_feature_vector, _ = Four_Classes_Features_Pathology_Dataset.convert_mass_feats_1hot(
+                1, mass_shape, mass_margins, ignore_vector=None)
+            mass_feats_table[idx, Four_Classes_Features_Pathology_Dataset.MASS_FEATS_SLICE] = mass_feature_vector
+
+        calc_feats_table = np.zeros((len(self.calc_feats_dist), Four_Classes_Features_Pathology_Dataset.FEATS_DIM),
+                                    dtype=np.float32)
+        for idx, (calc_type, calc_distribution) in enumerate(self.calc_feats_dist):
+            calc_feature_vector, _ = Four_Classes_Features_Pathology_Dataset.convert_calc_feats_1hot(
+                1, calc_type, calc_distribution, ignore_vector=None)
+            calc_feats_table[idx, Four_Classes_Features_Pathology_Dataset.CALC_FEATS_SLICE] = calc_feature_vector
+
+        return mass_feats_table, calc_feats_table
+
     @staticmethod
-    def get_mass_feats_empirical_dist(images_list, lesion_types, mass_annotations):
+    def build_feats_blocks():
+        '''One 0/1 row per entry of ignore_vector marking the slots it zeroes,
+        so that the keep-mask of a sample is 1 - ignore_vector @ blocks'''
+        feats_blocks = dict()
+        for lesion_type, blocks in Four_Classes_Features_Pathology_Dataset.FEATS_BLOCKS.items():
+            feats_blocks[lesion_type] = np.zeros((len(blocks), Four_Classes_Features_Pathology_Dataset.FEATS_DIM),
+                                                 dtype=np.float32)
+            for idx, block in enumerate(blocks):
+                feats_blocks[lesion_type][idx, block] = 1
+        return feats_blocks
+
+    @staticmethod
+    def get_mass_feats_empirical_dist(images_list, lesion_types, mass_index):
         mass_feats_empirical_dist = set()
 
         for img_path, lesion_type in zip(images_list, lesion_types):
@@ -996,23 +1099,15 @@ class  Four_Classes_Features_Pathology_Dataset(Dataset):
 
             img_name, _ = os.path.splitext(os.path.basename(img_path))
 
-            roi_idx = 0
-            while True:
-                roi_idx += 1
-                rslt_df = get_info_lesion(mass_annotations, f'{img_name}')
-
-                if len(rslt_df) > 0:
-                    break
-
-            mass_shape = rslt_df['mass shape'].to_numpy()[0]
-            mass_margins = rslt_df['mass margins'].to_numpy()[0]
+            mass_shape = mass_index.get(img_name, 'mass shape')
+            mass_margins = mass_index.get(img_name, 'mass margins')
 
             mass_feats_empirical_dist.add((mass_shape, mass_margins))
 
         return mass_feats_empirical_dist
 
     @staticmethod
-    def get_calc_feats_empirical_dist(images_list, lesion_types, calc_annotations):
+    def get_calc_feats_empirical_dist(images_list, lesion_types, calc_index):
         calc_feats_empirical_dist = set()
 
         for img_path, lesion_type in zip(images_list, lesion_types):
@@ -1021,16 +1116,8 @@ class  Four_Classes_Features_Pathology_Dataset(Dataset):
 
             img_name, _ = os.path.splitext(os.path.basename(img_path))
 
-            roi_idx = 0
-            while True:
-                roi_idx += 1
-                rslt_df = get_info_lesion(calc_annotations, f'{img_name}')
-
-                if len(rslt_df) > 0:
-                    break
-
-            calc_type = rslt_df['calc type'].to_numpy()[0]
-            calc_distribution = rslt_df['calc distribution'].to_numpy()[0]
+            calc_type = calc_index.get(img_name, 'calc type')
+            calc_distribution = calc_index.get(img_name, 'calc distribution')
 
             calc_feats_empirical_dist.add((calc_type, calc_distribution))
 
@@ -1045,69 +1132,28 @@ class  Four_Classes_Features_Pathology_Dataset(Dataset):
 
         img_path = self.images_list[idx]
         lesion_type = self.lesion_types[idx]
-        img_name, _ = os.path.splitext(os.path.basename(img_path))
-        image = Image.open(img_path)
+        image = open_patch(img_path, self.packed)
         label = self.labels[idx]
 
-        ignore_vector = None
+        feature_vector = self.feature_table[idx].copy()
+
         if self.missed_feats_num > 0:
             avail_feats_num = 3 - self.missed_feats_num
             ignore_vector = [0] * avail_feats_num + [1] * self.missed_feats_num
             ignore_vector = np.random.permutation(ignore_vector)
 
+            feature_vector *= 1 - ignore_vector.astype(np.float32) @ self.feats_blocks[lesion_type]
+
+        if self.missing_feats_fill == 'emp_sampling':
+            # We dont use the parameter 'Breast Density' of the sampled
+            # features, so only their lesion type slots are filled
+            if lesion_type == 'MASS':
+                feature_vector += self.calc_feats_table[random.randrange(len(self.calc_feats_table))]
+            elif lesion_type == 'CALC':
+                feature_vector += self.mass_feats_table[random.randrange(len(self.mass_feats_table))]
 
-        if lesion_type == 'MASS':
-            roi_idx = 0
-            while True:
-                roi_idx += 1
-                rslt_df = get_info_lesion(self.mass_annotations, f'{img_name}')
-
-                if len(rslt_df) > 0:
-                    break
-
-            breast_density = rslt_df['breast_density'].to_numpy()[0]
-            mass_shape = rslt_df['mass shape'].to_numpy()[0]
-            mass_margins = rslt_df['mass margins'].to_numpy()[0]
-            feature_vector, breast_density_1hot = Four_Classes_Features_Pathology_Dataset.convert_mass_feats_1hot(
-                breast_density, mass_shape, mass_margins, ignore_vector)
-
-            if self.missing_feats_fill == 'zeroes':
-                feature_vector = np.concatenate((breast_density_1hot, feature_vector, np.zeros(19)))
-            elif self.missing_feats_fill == 'emp_sampling':
-                calc_type, calc_distribution = random.choice(tuple(self.calc_feats_dist))
-                missing_calc_feature_vector, _ = Four_Classes_Features_Pathology_Dataset.convert_calc_feats_1hot(
-                    1, calc_type, calc_distribution, ignore_vector=None) # We dont use the parameter 'Breast Density', so just
-                                                                    # set it to random value. (for e.g.: 1)
-                feature_vector = np.concatenate((breast_density_1hot, feature_vector, missing_calc_feature_vector))
-
-            if random.random() < self.uncertainty:
-                feature_vector = np.zeros(feature_vector.shape)
-        elif lesion_type == 'CALC':
-            roi_idx = 0
-            while True:
-                roi_idx += 1
-                rslt_df = get_info_lesion(self.calc_annotations, f'{img_name}')
-
-                if len(rslt_df) > 0:
-                    break
-
-            breast_density = rslt_df['breast density'].to_numpy()[0]
-            calc_type = rslt_df['calc type'].to_numpy()[0]
-            calc_distribution = rslt_df['calc distribution'].to_numpy()[0]
-            feature_vector, breast_density_1hot = Four_Classes_Features_Pathology_Dataset.convert_calc_feats_1hot(
-                breast_density, calc_type, calc_distribution, ignore_vector)
-
-            if self.missing_feats_fill == 'zeroes':
-                feature_vector = np.concatenate((breast_density_1hot, np.zeros(13), feature_vector))
-            elif self.missing_feats_fill == 'emp_sampling':
-                mass_shape, mass_margins = random.choice(tuple(self.mass_feats_dist))
-                missing_mass_feature_vector, _ = Four_Classes_Features_Pathology_Dataset.convert_mass_feats_1hot(
-                    1, mass_shape, mass_margins, ignore_vector=None)
-
-                feature_vector = np.concatenate((breast_density_1hot, missing_mass_feature_vector, feature_vector))
-
-            if random.random() < self.uncertainty:
-                feature_vector = np.zeros(feature_vector.shape)
+        if random.random() < self.uncertainty:
+            feature_vector[:] = 0
 
         if self.transform:
             image = self.transform(image)
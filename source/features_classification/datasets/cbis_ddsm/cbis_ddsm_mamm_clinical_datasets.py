@@ -1,3 +1,17 @@
+import os
+import glob
+import pandas as pd
+import torch
+import numpy as np
+import math
+import random
+
+from torch.utils.data import Dataset
+from PIL import Image
+
+from utilities.datautil.lesion_index import LesionIndex
+
+
 
 class  Four_Classes_Features_Pathology_Dataset(Dataset):
     classes = np.array(['BENIGN_MASS', 'MALIGNANT_MASS', 'BENIGN_CALC', 'MALIGNANT_CALC'])
@@ -5,6 +19,8 @@ class  Four_Classes_Features_Pathology_Dataset(Dataset):
     def __init__(self, mass_annotation_file, mass_root_dir, calc_annotation_file, calc_root_dir, uncertainty=0, missed_feats_num=0, missing_feats_fill='zeroes', transform=None, train_rate=1):
         self.mass_annotations = pd.read_csv(mass_annotation_file)
         self.calc_annotations = pd.read_csv(calc_annotation_file)
+        self.mass_index = LesionIndex(self.mass_annotations)
+        self.calc_index = LesionIndex(self.calc_annotations)
         self.uncertainty = uncertainty
         self.missed_feats_num = missed_feats_num
         self.missing_feats_fill = missing_feats_fill
@@ -41,8 +57,8 @@ class  Four_Classes_Features_Pathology_Dataset(Dataset):
                 self.lesion_types += ['CALC'] * len(calc_images)
 
         # For random feature values
-        self.mass_feats_dist = Four_Classes_Features_Pathology_Dataset.get_mass_feats_empirical_dist(self.images_list, self.lesion_types, self.mass_annotations)
-        self.calc_feats_dist = Four_Classes_Features_Pathology_Dataset.get_calc_feats_empirical_dist(self.images_list, self.lesion_types, self.calc_annotations)
+        self.mass_feats_dist = Four_Classes_Features_Pathology_Dataset.get_mass_feats_empirical_dist(self.images_list, self.lesion_types, self.mass_index)
+        self.calc_feats_dist = Four_Classes_Features_Pathology_Dataset.get_calc_feats_empirical_dist(self.images_list, self.lesion_types, self.calc_index)
 
 
     @staticmethod
@@ -168,7 +184,7 @@ class  Four_Classes_Features_Pathology_Dataset(Dataset):
         return ret, one_hot_breast_density
 
     @staticmethod
-    def get_mass_feats_empirical_dist(images_list, lesion_types, mass_annotations):
+    def get_mass_feats_empirical_dist(images_list, lesion_types, mass_index):
         mass_feats_empirical_dist = set()
 
         for img_path, lesion_type in zip(images_list, lesion_types):
@@ -177,23 +193,15 @@ class  Four_Classes_Features_Pathology_Dataset(Dataset):
 
             img_name, _ = os.path.splitext(os.path.basename(img_path))
 
-            roi_idx = 0
-            while True:
-                roi_idx += 1
-                rslt_df = get_info_lesion(mass_annotations, f'{img_name}')
-
-                if len(rslt_df) > 0:
-                    break
-
-            mass_shape = rslt_df['mass shape'].to_numpy()[0]
-            mass_margins = rslt_df['mass margins'].to_numpy()[0]
+            mass_shape = mass_index.get(img_name, 'mass shape')
+            mass_margins = mass_index.get(img_name, 'mass margins')
 
             mass_feats_empirical_dist.add((mass_shape, mass_margins))
 
         return mass_feats_empirical_dist
 
     @staticmethod
-    def get_calc_feats_empirical_dist(images_list, lesion_types, calc_annotations):
+    def get_calc_feats_empirical_dist(images_list, lesion_types, calc_index):
         calc_feats_empirical_dist = set()
 
         for img_path, lesion_type in zip(images_list, lesion_types):
@@ -202,16 +210,8 @@ class  Four_Classes_Features_Pathology_Dataset(Dataset):
 
             img_name, _ = os.path.splitext(os.path.basename(img_path))
 
-            roi_idx = 0
-            while True:
-                roi_idx += 1
-                rslt_df = get_info_lesion(calc_annotations, f'{img_name}')
-
-                if len(rslt_df) > 0:
-                    break
-
-            calc_type = rslt_df['calc type'].to_numpy()[0]
-            calc_distribution = rslt_df['calc distribution'].to_numpy()[0]
+            calc_type = calc_index.get(img_name, 'calc type')
+            calc_distribution = calc_index.get(img_name, 'calc distribution')
 
             calc_feats_empirical_dist.add((calc_type, calc_distribution))
 
@@ -238,17 +238,9 @@ class  Four_Classes_Features_Pathology_Dataset(Dataset):
 
 
         if lesion_type == 'MASS':
-            roi_idx = 0
-            while True:
-                roi_idx += 1
-                rslt_df = get_info_lesion(self.mass_annotations, f'{img_name}')
-
-                if len(rslt_df) > 0:
-                    break
-
-            breast_density = rslt_df['breast_density'].to_numpy()[0]
-            mass_shape = rslt_df['mass shape'].to_numpy()[0]
-            mass_margins = rslt_df['mass margins'].to_numpy()[0]
+            breast_density = self.mass_index.get(img_name, 'breast_density')
+            mass_shape = self.mass_index.get(img_name, 'mass shape')
+            mass_margins = self.mass_index.get(img_name, 'mass margins')
             feature_vector, breast_density_1hot = Four_Classes_Features_Pathology_Dataset.convert_mass_feats_1hot(
                 breast_density, mass_shape, mass_margins, ignore_vector)
 
@@ -264,17 +256,9 @@ class  Four_Classes_Features_Pathology_Dataset(Dataset):
             if random.random() < self.uncertainty:
                 feature_vector = np.zeros(feature_vector.shape)
         elif lesion_type == 'CALC':
-            roi_idx = 0
-            while True:
-                roi_idx += 1
-                rslt_df = get_info_lesion(self.calc_annotations, f'{img_name}')
-
-                if len(rslt_df) > 0:
-                    break
-
-            breast_density = rslt_df['breast density'].to_numpy()[0]
-            calc_type = rslt_df['calc type'].to_numpy()[0]
-            calc_distribution = rslt_df['calc distribution'].to_numpy()[0]
+            breast_density = self.calc_index.get(img_name, 'breast density')
+            calc_type = self.calc_index.get(img_name, 'calc type')
+            calc_distribution = self.calc_index.get(img_name, 'calc distribution')
             feature_vector, breast_density_1hot = Four_Classes_Features_Pathology_Dataset.convert_calc_feats_1hot(
                 breast_density, calc_type, calc_distribution, ignore_vector)
 
@@ -301,6 +285,7 @@ class Features_Pathology_Dataset(Dataset):
 
     def __init__(self, lesion_type, annotation_file, root_dir, transform=None):
         self.annotations = pd.read_csv(annotation_file)
+        self.lesion_index = LesionIndex(self.annotations)
         self.root_dir = root_dir
         self.transform = transform
         self.lesion_type = lesion_type
@@ -420,24 +405,16 @@ class Features_Pathology_Dataset(Dataset):
         image = Image.open(img_path)
         label = self.labels[idx]
 
-        roi_idx = 0
-        while True:
-            roi_idx += 1
-            rslt_df = get_info_lesion(self.annotations, f'{img_name}')
-
-            if len(rslt_df) > 0:
-                break
-
         if self.lesion_type == 'mass':
-            breast_density = rslt_df['breast_density'].to_numpy()[0]
-            mass_shape = rslt_df['mass shape'].to_numpy()[0]
-            mass_margins = rslt_df['mass margins'].to_numpy()[0]
+            breast_density = self.lesion_index.get(img_name, 'breast_density')
+            mass_shape = self.lesion_index.get(img_name, 'mass shape')
+            mass_margins = self.lesion_index.get(img_name, 'mass margins')
             feature_vector = Features_Pathology_Dataset.convert_mass_feats_1hot(
                 breast_density, mass_shape, mass_margins)
         elif self.lesion_type == 'calc':
-            breast_density = rslt_df['breast density'].to_numpy()[0]
-            calc_type = rslt_df['calc type'].to_numpy()[0]
-            calc_distribution = rslt_df['calc distribution'].to_numpy()[0]
+            breast_density = self.lesion_index.get(img_name, 'breast density')
+            calc_type = self.lesion_index.get(img_name, 'calc type')
+            calc_distribution = self.lesion_index.get(img_name, 'calc distribution')
             feature_vector = Features_Pathology_Dataset.convert_calc_feats_1hot(
                 breast_density, calc_type, calc_distribution)
 
@@ -1,5 +1,4 @@
 import os
-import glob
 import pandas as pd
 import torch
 import numpy as np
@@ -9,11 +8,11 @@ import cv2
 import albumentations
 
 from torch.utils.data import Dataset
-from PIL import Image
 from sklearn.preprocessing import label_binarize
 from natsort import natsorted
 
 from features_classification.train.train_utils import compute_classes_weights
+from features_classification.datasets.patch_store import glob_patches, open_patch
 
 
 class CMMD_Dataset(Dataset):
@@ -21,8 +20,9 @@ class CMMD_Dataset(Dataset):
                         'BENIGN_CALC', 'MALIGNANT_CALC',
                         'BENIGN_MASSCALC', 'MALIGNANT_MASSCALC'])
 
-    def __init__(self, data_root_dir, transform=None):
+    def __init__(self, data_root_dir, transform=None, packed=False):
         self.transform = transform
+        self.packed = packed
         self.data_root_dir = data_root_dir
 
         self.images_list = []
@@ -31,9 +31,7 @@ class CMMD_Dataset(Dataset):
         for idx, class_name in enumerate(CMMD_Dataset.classes):
             pathology, lesion_type = class_name.split("_")
 
-            images = glob.glob(os.path.join(
-                data_root_dir, lesion_type, pathology, '*.png'
-            ))
+            images = glob_patches(os.path.join(data_root_dir, lesion_type, pathology), self.packed)
             self.images_list += images
             self.labels += [idx] * len(images)
 
@@ -58,7 +56,7 @@ class CMMD_Dataset(Dataset):
 
         img_path = self.images_list[idx]
         img_name, _ = os.path.splitext(os.path.basename(img_path))
-        image = Image.open(img_path)
+        image = open_patch(img_path, self.packed)
 
         if image.mode == 'L':
             image = image.convert("RGB")
@@ -1,5 +1,4 @@
 import os
-import glob
 import pandas as pd
 import torch
 import numpy as np
@@ -9,19 +8,20 @@ import cv2
 import albumentations
 
 from torch.utils.data import Dataset
-from PIL import Image
 from sklearn.preprocessing import label_binarize
 from natsort import natsorted
 
 from features_classification.train.train_utils import compute_classes_weights
+from features_classification.datasets.patch_store import glob_patches, open_patch
 
 
 class CSAWM_Dataset(Dataset):
     classes = np.array(['BENIGN',
                         'MALIGNANT'])
 
-    def __init__(self, data_root_dir, transform=None):
+    def __init__(self, data_root_dir, transform=None, packed=False):
         self.transform = transform
+        self.packed = packed
         self.data_root_dir = data_root_dir
 
         self.images_list = []
@@ -29,9 +29,9 @@ class CSAWM_Dataset(Dataset):
 
         for idx, class_name in enumerate(CSAWM_Dataset.classes):
             if class_name == 'BENIGN':
-                images = glob.glob(os.path.join(self.data_root_dir, 'BENIGN', '*.png'))
+                images = glob_patches(os.path.join(self.data_root_dir, 'BENIGN'), self.packed)
             elif class_name == 'MALIGNANT':
-                images = glob.glob(os.path.join(self.data_root_dir, 'MALIGNANT', '*.png'))
+                images = glob_patches(os.path.join(self.data_root_dir, 'MALIGNANT'), self.packed)
 
             if len(images) == 0:
                 raise ValueError
@@ -54,7 +54,7 @@ class CSAWM_Dataset(Dataset):
 
         img_path = self.images_list[idx]
         img_name, _ = os.path.splitext(os.path.basename(img_path))
-        image = Image.open(img_path)
+        image = open_patch(img_path, self.packed)
 
         if image.mode == 'L':
             image = image.convert("RGB")
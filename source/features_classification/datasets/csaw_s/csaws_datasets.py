@@ -1,5 +1,4 @@
 import os
-import glob
 import pandas as pd
 import torch
 import numpy as np
@@ -9,11 +8,11 @@ import cv2
 import albumentations
 
 from torch.utils.data import Dataset
-from PIL import Image
 from sklearn.preprocessing import label_binarize
 from natsort import natsorted
 
 from features_classification.train.train_utils import compute_classes_weights
+from features_classification.datasets.patch_store import glob_patches, open_patch
 
 
 class CSAWS_Dataset(Dataset):
@@ -23,8 +22,9 @@ class CSAWS_Dataset(Dataset):
                         'AXILLARY_LYMPH_NODE'])
 
     def __init__(self, cancer_root_dir, calc_root_dir,
-                 axillary_root_dir, bg_root_dir, transform=None):
+                 axillary_root_dir, bg_root_dir, transform=None, packed=False):
         self.transform = transform
+        self.packed = packed
         self.cancer_root_dir = cancer_root_dir
         self.calc_root_dir = calc_root_dir
         self.axillary_root_dir = axillary_root_dir
@@ -35,13 +35,13 @@ class CSAWS_Dataset(Dataset):
 
         for idx, class_name in enumerate(CSAWS_Dataset.classes):
             if class_name == 'BACKGROUND':
-                images = glob.glob(os.path.join(bg_root_dir, '*.png'))
+                images = glob_patches(bg_root_dir, self.packed)
             elif class_name == 'CANCER':
-                images = glob.glob(os.path.join(cancer_root_dir, '*.png'))
+                images = glob_patches(cancer_root_dir, self.packed)
             elif class_name == 'CALC':
-                images = glob.glob(os.path.join(calc_root_dir, '*.png'))
+                images = glob_patches(calc_root_dir, self.packed)
             elif class_name == 'AXILLARY_LYMPH_NODE':
-                images = glob.glob(os.path.join(axillary_root_dir, '*.png'))
+                images = glob_patches(axillary_root_dir, self.packed)
 
             if len(images) == 0:
                 raise ValueError
@@ -64,7 +64,7 @@ class CSAWS_Dataset(Dataset):
 
         img_path = self.images_list[idx]
         img_name, _ = os.path.splitext(os.path.basename(img_path))
-        image = Image.open(img_path)
+        image = open_patch(img_path, self.packed)
 
         if image.mode == 'L':
             image = image.convert("RGB")
@@ -1,5 +1,4 @@
 import os
-import glob
 import pandas as pd
 import torch
 import numpy as np
@@ -9,12 +8,12 @@ import cv2
 import albumentations
 
 from torch.utils.data import Dataset
-from PIL import Image
 # from dataprocessing.process_cbis_ddsm import get_info_lesion
 from sklearn.preprocessing import label_binarize
 from natsort import natsorted
 
 from features_classification.train.train_utils import compute_classes_weights
+from features_classification.datasets.patch_store import glob_patches, open_patch
 
 
 class INBreast_Pathology_Dataset(Dataset):
@@ -30,8 +29,9 @@ class INBreast_Pathology_Dataset(Dataset):
     def __init__(self, mass_root_dir, calc_root_dir,
                  spiculated_root_dir, asymetry_root_dir,
                  distortion_root_dir, cluster_root_dir,
-                 bg_root_dir, transform=None):
+                 bg_root_dir, transform=None, packed=False):
         self.transform = transform
+        self.packed = packed
         self.mass_root_dir = mass_root_dir
         self.calc_root_dir = calc_root_dir
         self.spiculated_root_dir = spiculated_root_dir
@@ -45,7 +45,7 @@ class INBreast_Pathology_Dataset(Dataset):
 
         for idx, class_name in enumerate(INBreast_Pathology_Dataset.classes):
             if class_name == 'BACKGROUND':
-                bg_images = glob.glob(os.path.join(bg_root_dir, '*.png'))
+                bg_images = glob_patches(bg_root_dir, self.packed)
                 self.images_list += bg_images
                 self.labels += [idx] * len(bg_images)
 
@@ -56,48 +56,42 @@ class INBreast_Pathology_Dataset(Dataset):
                 pathology, lesion_type = class_name.split('_')
 
                 if lesion_type == 'MASS':
-                    mass_images = glob.glob(os.path.join(
-                        mass_root_dir, pathology, '*.png'))
+                    mass_images = glob_patches(os.path.join(mass_root_dir, pathology), self.packed)
                     self.images_list += mass_images
                     self.labels += [idx] * len(mass_images)
 
                     if len(mass_images) == 0:
                         raise ValueError
                 elif lesion_type == 'CALC':
-                    calc_images = glob.glob(os.path.join(
-                        calc_root_dir, pathology, '*.png'))
+                    calc_images = glob_patches(os.path.join(calc_root_dir, pathology), self.packed)
                     self.images_list += calc_images
                     self.labels += [idx] * len(calc_images)
 
                     if len(calc_images) == 0:
                         raise ValueError
                 elif lesion_type == 'SPICULATED':
-                    spiculated_images = glob.glob(os.path.join(
-                        spiculated_root_dir, pathology, '*.png'))
+                    spiculated_images = glob_patches(os.path.join(spiculated_root_dir, pathology), self.packed)
                     self.images_list += spiculated_images
                     self.labels += [idx] * len(spiculated_images)
 
                     if len(spiculated_images) == 0:
                         raise ValueError
                 elif lesion_type == 'ASYMETRY':
-                    asymetry_images = glob.glob(os.path.join(
-                        asymetry_root_dir, pathology, '*.png'))
+                    asymetry_images = glob_patches(os.path.join(asymetry_root_dir, pathology), self.packed)
                     self.images_list += asymetry_images
                     self.labels += [idx] * len(asymetry_images)
 
                     if len(asymetry_images) == 0:
                         raise ValueError
                 elif lesion_type == 'DISTORTION':
-                    distortion_images = glob.glob(os.path.join(
-                        distortion_root_dir, pathology, '*.png'))
+                    distortion_images = glob_patches(os.path.join(distortion_root_dir, pathology), self.packed)
                     self.images_list += distortion_images
                     self.labels += [idx] * len(distortion_images)
 
                     if len(distortion_images) == 0:
                         raise ValueError
                 elif lesion_type == 'CLUSTER':
-                    cluster_images = glob.glob(os.path.join(
-                        cluster_root_dir, pathology, '*.png'))
+                    cluster_images = glob_patches(os.path.join(cluster_root_dir, pathology), self.packed)
                     self.images_list += cluster_images
                     self.labels += [idx] * len(cluster_images)
 
@@ -119,7 +113,7 @@ class INBreast_Pathology_Dataset(Dataset):
 
         img_path = self.images_list[idx]
         img_name, _ = os.path.splitext(os.path.basename(img_path))
-        image = Image.open(img_path)
+        image = open_patch(img_path, self.packed)
 
         if image.mode == 'L':
             image = image.convert("RGB")
@@ -151,8 +145,9 @@ class INBreast_Pathology_Without_Background_Dataset(Dataset):
     def __init__(self, mass_root_dir, calc_root_dir,
                  spiculated_root_dir, asymetry_root_dir,
                  distortion_root_dir, cluster_root_dir,
-                 transform=None):
+                 transform=None, packed=False):
         self.transform = transform
+        self.packed = packed
         self.mass_root_dir = mass_root_dir
         self.calc_root_dir = calc_root_dir
         self.spiculated_root_dir = spiculated_root_dir
@@ -167,48 +162,42 @@ class INBreast_Pathology_Without_Background_Dataset(Dataset):
             pathology, lesion_type = class_name.split('_')
 
             if lesion_type == 'MASS':
-                mass_images = glob.glob(os.path.join(
-                    mass_root_dir, pathology, '*.png'))
+                mass_images = glob_patches(os.path.join(mass_root_dir, pathology), self.packed)
                 self.images_list += mass_images
                 self.labels += [idx] * len(mass_images)
 
                 if len(mass_images) == 0:
                     raise ValueError
             elif lesion_type == 'CALC':
-                calc_images = glob.glob(os.path.join(
-                    calc_root_dir, pathology, '*.png'))
+                calc_images = glob_patches(os.path.join(calc_root_dir, pathology), self.packed)
                 self.images_list += calc_images
                 self.labels += [idx] * len(calc_images)
 
                 if len(calc_images) == 0:
                     raise ValueError
             elif lesion_type == 'SPICULATED':
-                spiculated_images = glob.glob(os.path.join(
-                    spiculated_root_dir, pathology, '*.png'))
+                spiculated_images = glob_patches(os.path.join(spiculated_root_dir, pathology), self.packed)
                 self.images_list += spiculated_images
                 self.labels += [idx] * len(spiculated_images)
 
                 if len(spiculated_images) == 0:
                     raise ValueError
             elif lesion_type == 'ASYMETRY':
-                asymetry_images = glob.glob(os.path.join(
-                    asymetry_root_dir, pathology, '*.png'))
+                asymetry_images = glob_patches(os.path.join(asymetry_root_dir, pathology), self.packed)
                 self.images_list += asymetry_images
                 self.labels += [idx] * len(asymetry_images)
 
                 if len(asymetry_images) == 0:
                     raise ValueError
             elif lesion_type == 'DISTORTION':
-                distortion_images = glob.glob(os.path.join(
-                    distortion_root_dir, pathology, '*.png'))
+                distortion_images = glob_patches(os.path.join(distortion_root_dir, pathology), self.packed)
                 self.images_list += distortion_images
                 self.labels += [idx] * len(distortion_images)
 
                 if len(distortion_images) == 0:
                     raise ValueError
             elif lesion_type == 'CLUSTER':
-                cluster_images = glob.glob(os.path.join(
-                    cluster_root_dir, pathology, '*.png'))
+                cluster_images = glob_patches(os.path.join(cluster_root_dir, pathology), self.packed)
                 self.images_list += cluster_images
                 self.labels += [idx] * len(cluster_images)
 
@@ -230,7 +219,7 @@ class INBreast_Pathology_Without_Background_Dataset(Dataset):
 
         img_path = self.images_list[idx]
         img_name, _ = os.path.splitext(os.path.basename(img_path))
-        image = Image.open(img_path)
+        image = open_patch(img_path, self.packed)
 
         if image.mode == 'L':
             image = image.convert("RGB")
@@ -0,0 +1,227 @@
+import os
+import io
+import glob
+import fnmatch
+import argparse
+import numpy as np
+import torch
+import albumentations
+
+from torch.utils.data import Dataset
+from PIL import Image
+
+
+# Shard layout: [uint8 pixel blob][npz index][int64 byte offset of the npz index]
+SHARD_FILENAME = 'patches.shard'
+
+
+def pack_patches(root_dir, shard_path=None, pattern='*.png'):
+    '''Pack every image under a class-folder tree into one shard file
+
+    Args:
+    root_dir - root of the tree, e.g. <root>/<class>/*.png (images directly under root_dir are packed too)
+    shard_path - defaults to <root_dir>/patches.shard, which is where the datasets look for it
+
+    Returns:
+    number of packed images
+    '''
+    if shard_path is None:
+        shard_path = os.path.join(root_dir, SHARD_FILENAME)
+
+    images = sorted(glob.glob(os.path.join(root_dir, '**', pattern), recursive=True))
+
+    keys = []
+    labels = []
+    offsets = np.zeros(len(images), dtype=np.int64)
+    shapes = np.zeros((len(images), 3), dtype=np.int64)
+
+    offset = 0
+    tmp_shard_path = shard_path + '.tmp'
+    with open(tmp_shard_path, 'wb') as f:
+        for idx, img_path in enumerate(images):
+            img = np.asarray(Image.open(img_path))
+            if img.dtype != np.uint8:
+                raise ValueError(f'{img_path} is not an 8-bit image ({img.dtype})')
+
+            key = os.path.relpath(img_path, root_dir)
+            keys.append(key)
+            # class folder name, '' for images directly under root_dir
+            labels.append(os.path.dirname(key).split(os.sep)[0])
+
+            offsets[idx] = offset
+            # channels == 0 means a single channel (H, W) image
+            shapes[idx] = img.shape if img.ndim == 3 else img.shape + (0,)
+
+            f.write(np.ascontiguousarray(img).tobytes())
+            offset += img.nbytes
+
+        index = io.BytesIO()
+        np.savez(index, keys=np.array(keys, dtype=str), labels=np.array(labels, dtype=str),
+                 offsets=offsets, shapes=shapes)
+        f.write(index.getvalue())
+        f.write(np.array(offset, dtype='<i8').tobytes())
+
+    os.replace(tmp_shard_path, shard_path)
+
+    return len(images)
+
+
+class PatchStore:
+    '''Read-only view over a packed shard. Patches are returned as slices of an
+    np.memmap of the pixel blob, nothing is copied until the caller does (e.g.
+    open_patch, which copies into a PIL image)'''
+    def __init__(self, shard_path):
+        self.shard_path = shard_path
+        self.root_dir = os.path.dirname(os.path.abspath(shard_path))
+
+        with open(shard_path, 'rb') as f:
+            f.seek(-8, os.SEEK_END)
+            blob_size = int(np.frombuffer(f.read(8), dtype='<i8')[0])
+            f.seek(blob_size)
+            index = np.load(io.BytesIO(f.read()[:-8]))
+
+            self.keys = index['keys'].tolist()
+            self.labels = index['labels'].tolist()
+            self.offsets = index['offsets']
+            self.shapes = index['shapes']
+
+        self.blob_size = blob_size
+        self.blob = None
+
+        self.positions = {key: pos for pos, key in enumerate(self.keys)}
+        self.dirs = dict()
+        for key in self.keys:
+            self.dirs.setdefault(os.path.dirname(key), []).append(key)
+
+    def __getstate__(self):
+        # memmaps are re-opened in DataLoader workers instead of being pickled
+        state = self.__dict__.copy()
+        state['blob'] = None
+        return state
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, pos):
+        if self.blob is None:
+            self.blob = np.memmap(self.shard_path, dtype=np.uint8, mode='r',
+                                  shape=(self.blob_size,))
+
+        height, width, channels = self.shapes[pos]
+        shape = (height, width, channels) if channels > 0 else (height, width)
+        offset = self.offsets[pos]
+        return self.blob[offset:offset + int(np.prod(shape))].reshape(shape)
+
+    def read(self, img_path):
+        return self[self.positions[os.path.relpath(os.path.abspath(img_path), self.root_dir)]]
+
+    def glob(self, pathname):
+        '''Same as glob.glob for a `<dir>/<name pattern>` path inside the shard'''
+        rel_dir, name_pattern = os.path.split(
+            os.path.relpath(os.path.abspath(pathname), self.root_dir))
+        if rel_dir == os.curdir:
+            rel_dir = ''
+
+        return [os.path.join(self.root_dir, key) for key in self.dirs.get(rel_dir, [])
+                if fnmatch.fnmatch(os.path.basename(key), name_pattern)]
+
+
+# One store per shard and per process
+_patch_stores = dict()
+# image dir -> store of its shard, so that the filesystem is only searched once per dir
+_dir_stores = dict()
+
+
+def get_patch_store(image_dir):
+    '''Store of the closest shard found in image_dir or one of its parents'''
+    image_dir = os.path.abspath(image_dir)
+    if image_dir in _dir_stores:
+        return _dir_stores[image_dir]
+
+    search_dir = image_dir
+    while True:
+        shard_path = os.path.join(search_dir, SHARD_FILENAME)
+        if os.path.exists(shard_path):
+            break
+
+        parent_dir = os.path.dirname(search_dir)
+        if parent_dir == search_dir:
+            raise FileNotFoundError(f'No {SHARD_FILENAME} found for {image_dir}')
+        search_dir = parent_dir
+
+    if shard_path not in _patch_stores:
+        _patch_stores[shard_path] = PatchStore(shard_path)
+
+    _dir_stores[image_dir] = _patch_stores[shard_path]
+    return _dir_stores[image_dir]
+
+
+def glob_patches(image_dir, packed=False, pattern='*.png'):
+    '''List the images of image_dir, from the filesystem or from its packed shard'''
+    if not packed:
+        return glob.glob(os.path.join(image_dir, pattern))
+
+    return get_patch_store(image_dir).glob(os.path.join(image_dir, pattern))
+
+
+def open_patch(img_path, packed=False):
+    '''Drop-in replacement for Image.open used by the datasets. From a shard the
+    patch is read through the memmap but copied into the PIL image (one copy of the
+    patch, no file open/stat); use get_patch_store(...).read(img_path) for the
+    zero-copy array'''
+    if not packed:
+        return Image.open(img_path)
+
+    return Image.fromarray(get_patch_store(os.path.dirname(img_path)).read(img_path))
+
+
+class Packed_Patch_Dataset(Dataset):
+    '''Generic class-folder dataset served straight from a shard'''
+    def __init__(self, shard_path, classes, transform=None):
+        self.store = PatchStore(shard_path)
+        self.classes = np.array(classes)
+        self.transform = transform
+
+        classes_map = {class_name: idx for idx, class_name in enumerate(self.classes)}
+        self.positions = [pos for pos, label in enumerate(self.store.labels)
+                          if label in classes_map]
+        self.labels = [classes_map[self.store.labels[pos]] for pos in self.positions]
+
+    def get_labels(self):
+        return self.labels
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, idx):
+        if torch.is_tensor(idx):
+            idx = idx.tolist()
+
+        pos = self.positions[idx]
+        img_path = os.path.join(self.store.root_dir, self.store.keys[pos])
+        image = Image.fromarray(self.store[pos])
+
+        if image.mode == 'L':
+            image = image.convert("RGB")
+
+        label = self.labels[idx]
+
+        if self.transform:
+            if isinstance(self.transform, albumentations.core.composition.Compose):
+                res = self.transform(image=np.array(image))
+                image = res['image'].astype(np.float32)
+                image = image.transpose(2, 0, 1)
+            else:
+                image = self.transform(image)
+
+        return {'image': image, 'label': label, 'img_path': img_path}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack class-folder trees of lesion patches into shards')
+    parser.add_argument('roots', nargs='+', help='dataset roots, e.g. <mass_pathology>/train')
+    args = parser.parse_args()
+
+    for root_dir in args.roots:
+        num_images = pack_patches(root_dir)
+        print(f'{root_dir}: packed {num_images} images into {SHARD_FILENAME}')
@@ -0,0 +1,175 @@
+import os
+import tempfile
+import collections
+import numpy as np
+import torch
+
+from torch.utils.data import Dataset
+
+
+def _nbytes(value):
+    if torch.is_tensor(value):
+        return value.element_size() * value.nelement()
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    return 0
+
+
+class Cached_Dataset(Dataset):
+    '''Caches the samples of a dataset whose transform is deterministic
+    (the val/test splits), so that only the first epoch decodes, resizes and
+    normalizes the images.
+
+    Args:
+    dataset - the wrapped dataset, its attributes (classes, get_labels, ...) stay reachable
+    backend - 'ram' keeps the samples in memory, 'disk' keeps the tensors in an
+              unlinked np.memmap file under cache_dir (only the page cache uses RAM)
+    max_bytes - size cap of the cached tensors, least recently used samples are evicted.
+                The cap is shared evenly between the DataLoader workers
+    cache_dir - where the disk backend creates its file (defaults to the system tmp dir)
+
+    Every process (main process or DataLoader worker) owns its cache, so the
+    DataLoader must keep its workers alive between epochs (persistent_workers=True)
+    for the cache to be reused. With shuffle=False each worker always gets the
+    same batches.
+    '''
+    def __init__(self, dataset, backend='ram', max_bytes=4 * 1024 ** 3, cache_dir=None):
+        if backend not in ['ram', 'disk']:
+            raise ValueError(f'Unknown cache backend: {backend}')
+
+        self.dataset = dataset
+        self.backend = backend
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        # every worker caches its own samples, within its share of the cap
+        worker_info = torch.utils.data.get_worker_info()
+        num_workers = worker_info.num_workers if worker_info is not None else 1
+        self.process_max_bytes = self.max_bytes // num_workers
+        # idx -> sample ('ram') or idx -> (slot, non-tensor fields) ('disk'), in LRU order
+        self.entries = collections.OrderedDict()
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        # disk backend storage, allocated from the first sample
+        self.storage = None
+        self.free_slots = []
+
+    def __getstate__(self):
+        # memmaps are re-created by each DataLoader worker instead of being pickled
+        state = self.__dict__.copy()
+        state['entries'] = collections.OrderedDict()
+        state['cached_bytes'] = 0
+        state['storage'] = None
+        state['free_slots'] = []
+        return state
+
+    def __getattr__(self, name):
+        # only called for attributes not found on the wrapper
+        if name == 'dataset':
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        if torch.is_tensor(idx):
+            idx = idx.tolist()
+
+        if self._pid != os.getpid():
+            # forked worker: do not share the parent's disk slots
+            self._reset()
+
+        if idx in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(idx)
+            if self.backend == 'ram':
+                return self.entries[idx]
+            return self._read_slot(*self.entries[idx])
+
+        self.misses += 1
+        sample = self.dataset[idx]
+        if self.backend == 'ram':
+            self._put_ram(idx, sample)
+        else:
+            self._put_disk(idx, sample)
+
+        return sample
+
+    def _put_ram(self, idx, sample):
+        sample_bytes = sum(_nbytes(value) for value in sample.values())
+        if sample_bytes > self.process_max_bytes:
+            return
+
+        while self.cached_bytes + sample_bytes > self.process_max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.cached_bytes -= sum(_nbytes(value) for value in evicted.values())
+
+        self.entries[idx] = sample
+        self.cached_bytes += sample_bytes
+
+    def _allocate_storage(self, sample):
+        arrays = {key: np.asarray(value) for key, value in sample.items()
+                  if torch.is_tensor(value) or isinstance(value, np.ndarray)}
+        sample_bytes = sum(array.nbytes for array in arrays.values())
+        num_slots = min(len(self.dataset), self.process_max_bytes // max(sample_bytes, 1))
+
+        self.storage = dict()
+        for key, array in arrays.items():
+            with tempfile.NamedTemporaryFile(dir=self.cache_dir, suffix='.cache') as f:
+                # the mapping outlives the unlinked file, nothing is left behind on exit
+                self.storage[key] = np.memmap(f.name, dtype=array.dtype, mode='w+',
+                                              shape=(max(num_slots, 1),) + array.shape)
+        self.tensor_keys = {key for key, value in sample.items() if torch.is_tensor(value)}
+        self.slot_bytes = sample_bytes
+        self.free_slots = list(range(num_slots))
+
+    def _put_disk(self, idx, sample):
+        if self.storage is None:
+            self._allocate_storage(sample)
+
+        # samples whose tensors do not fit the allocated slots are not cached
+        if any(key not in sample or np.shape(sample[key]) != storage.shape[1:]
+               for key, storage in self.storage.items()):
+            return
+
+        if not self.free_slots:
+            if not self.entries:
+                return
+            _, (slot, _) = self.entries.popitem(last=False)
+            self.free_slots.append(slot)
+            self.cached_bytes -= self.slot_bytes
+
+        slot = self.free_slots.pop()
+        for key, storage in self.storage.items():
+            storage[slot] = np.asarray(sample[key])
+
+        fields = {key: value for key, value in sample.items() if key not in self.storage}
+        self.entries[idx] = (slot, fields)
+        self.cached_bytes += self.slot_bytes
+
+    def _read_slot(self, slot, fields):
+        sample = dict(fields)
+        for key, storage in self.storage.items():
+            array = np.array(storage[slot])
+            sample[key] = torch.from_numpy(array) if key in self.tensor_keys else array
+        return sample
+
+
+def cache_eval_datasets(image_datasets, backend='ram', max_megabytes=4096, cache_dir=None,
+                        splits=('val', 'test')):
+    '''Wrap the deterministic splits of image_datasets with Cached_Dataset.
+    The size cap is shared evenly between the splits (and then between the
+    DataLoader workers of each split)'''
+    max_bytes = int(max_megabytes * 1024 ** 2) // len(splits)
+
+    return {split: Cached_Dataset(image_dataset, backend=backend, max_bytes=max_bytes,
+                                  cache_dir=cache_dir)
+            if split in splits else image_dataset
+            for split, image_dataset in image_datasets.items()}
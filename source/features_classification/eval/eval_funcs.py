@@ -33,6 +33,16 @@ def evaluate(model, classes, dataloader, device, writer, epoch,
                                          dataset, use_clinical_feats=use_clinical_feats,
                                          parallel_output=parallel_output)
 
+    model.train()
+
+    return evaluate_preds(preds, labels, classes, writer, epoch,
+                          multilabel_mode, eval_split)
+
+
+@torch.no_grad()
+def evaluate_preds(preds, labels, classes, writer, epoch, multilabel_mode, eval_split):
+    '''Acc/AP/AUC of already computed logits, e.g. the ones accumulated by the
+    training loop, so that the split does not need another forward pass'''
     if not multilabel_mode:
         y_proba_pred = torch.softmax(preds, dim=-1)
     else:
@@ -81,8 +91,6 @@ def evaluate(model, classes, dataloader, device, writer, epoch,
     #         writer.add_scalar(f'test roc auc - {class_name}', roc_aucs[idx], epoch)
     #         idx += 1
 
-    model.train()
-
     return acc, macro_ap, micro_ap, macro_auc, micro_auc
 
 
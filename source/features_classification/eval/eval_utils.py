@@ -91,6 +91,17 @@ def evalplot_confusion_matrix(y_true, y_pred, classes, save_root=None, fig_only=
     return cm
 
 
+def interpolate_precisions(precisions):
+    ''' max(precisions[idx:]) for every idx, built with a reverse cumulative max
+    instead of a quadratic loop. The last point is set to 0, as it always was. '''
+    interpolated_precisions = np.maximum.accumulate(
+        np.asarray(precisions, dtype=np.float64)[::-1])[::-1]
+    if len(interpolated_precisions) > 0:
+        interpolated_precisions[-1] = 0
+
+    return interpolated_precisions.tolist()
+
+
 def plot_precision_recall_curve(binarized_y_true, y_proba_pred, class_name, color='b'):
     precisions, recalls, thresholds = precision_recall_curve(
         binarized_y_true, y_proba_pred)
@@ -104,9 +115,7 @@ def plot_precision_recall_curve(binarized_y_true, y_proba_pred, class_name, colo
     thresholds = thresholds[:-1].tolist()
     thresholds.reverse()
 
-    interpolated_precisions = [0] * len(precisions)
-    for idx in range(0, len(precisions) - 1):
-        interpolated_precisions[idx] = max(precisions[idx:])
+    interpolated_precisions = interpolate_precisions(precisions)
 
     plt.plot(recalls[:], interpolated_precisions[:],
              label=f"{class_name} (AP={ap})", color=color, linewidth=2)
@@ -158,9 +167,7 @@ def evalplot_precision_recall_curve(binarized_y_true, y_proba_pred, classes, sav
     micro_recalls = micro_recalls[:-1].tolist()
     micro_recalls.reverse()
 
-    interpolated_micro_precisions = [0] * len(micro_precisions)
-    for idx in range(0, len(micro_precisions) - 1):
-        interpolated_micro_precisions[idx] = max(micro_precisions[idx:])
+    interpolated_micro_precisions = interpolate_precisions(micro_precisions)
     plt.plot(micro_recalls[:], interpolated_micro_precisions[:],
              label=f"Micro-average (AP={micro_average_precision})", color='blue',
              linewidth=1, linestyle='dashed')
@@ -168,7 +175,6 @@ def evalplot_precision_recall_curve(binarized_y_true, y_proba_pred, classes, sav
     # Calculate macro-average AP
     macro_average_precision = round(average_precision_score(binarized_y_true,
                                                             y_proba_pred, average="macro"), 2)
-    --------------------------------------------------------------------------
 
     plt.xlabel("Recall")
     plt.ylabel("Precision")
@@ -11,101 +11,96 @@ from torch.nn import CosineSimilarity, MarginRankingLoss
 
 
 def ranking_loss(z_image, z_text, y,
-                 similarity_function='dot', margin=3):
+                 similarity_function='dot', margin=3, imposter='neighbor'):
     """
     A custom ranking-based loss function
     Args:
         z_image: a mini-batch of image embedding features
         z_text: a mini-batch of text embedding features
         y: a 1D mini-batch of image-text labels 
+        imposter: 'neighbor' pairs sample i with sample i+1 (wrapping around),
+                  'hardest' with the most similar other sample of the batch
     """
-    return imposter_img_loss(z_image, z_text, y, similarity_function, margin) + \
-           imposter_txt_loss(z_image, z_text, y, similarity_function, margin)
+    return imposter_img_loss(z_image, z_text, y, similarity_function, margin, imposter) + \
+           imposter_txt_loss(z_image, z_text, y, similarity_function, margin, imposter)
 
 
-def imposter_img_loss(z_image, z_text, y, similarity_function, margin):
+def paired_similarities(z_a, z_b, similarity_function):
+    """
+    Similarities of the rows of z_a with the rows of z_b, s[i] = sim(z_a[i], z_b[i])
+    """
+    if similarity_function == 'dot':
+        return (z_a * z_b).sum(dim=1)
+    if similarity_function == 'cosine':
+        return (z_a * z_b).sum(dim=1) / (torch.norm(z_a, dim=1) * torch.norm(z_b, dim=1))
+    if similarity_function == 'l2':
+        return -1 * torch.norm(z_a - z_b, dim=1)
+
+    raise ValueError(f'Unknown similarity function: {similarity_function}')
+
+
+def pairwise_similarities(z_a, z_b, similarity_function):
+    """
+    Similarities of every row of z_a with every row of z_b, s[i, j] = sim(z_a[i], z_b[j])
+    """
+    if similarity_function == 'dot':
+        return z_a @ z_b.t()
+    if similarity_function == 'cosine':
+        return (z_a @ z_b.t()) / (torch.norm(z_a, dim=1)[:, None] * torch.norm(z_b, dim=1)[None, :])
+    if similarity_function == 'l2':
+        return -1 * torch.cdist(z_a, z_b, compute_mode='donot_use_mm_for_euclid_dist')
+
+    raise ValueError(f'Unknown similarity function: {similarity_function}')
+
+
+def _imposter_loss(z_anchor, z_paired, similarity_function, margin, imposter):
+    """
+    Hinge difference between the similarity of each (z_paired[i], z_anchor[i])
+    pair and the similarity of z_anchor[i] with an imposter z_paired[j]
+    """
+    batch_size = z_anchor.size(0)
+
+    paired_similarity = paired_similarities(z_paired, z_anchor, similarity_function)
+
+    if imposter == 'neighbor':
+        # j = i+1, and 0 for the last sample
+        imposter_similarity = paired_similarities(torch.roll(z_paired, -1, dims=0),
+                                                  z_anchor, similarity_function)
+    elif imposter == 'hardest':
+        similarities = pairwise_similarities(z_anchor, z_paired, similarity_function)
+        self_pairs = torch.eye(batch_size, dtype=torch.bool, device=z_anchor.device)
+        imposter_similarity = similarities.masked_fill(self_pairs, float('-inf')).max(dim=1)[0]
+    else:
+        raise ValueError(f'Unknown imposter selection: {imposter}')
+
+    # relu has no gradient at 0, same as only adding the positive differences
+    diff_similarity = torch.relu(imposter_similarity - paired_similarity + margin)
+
+    return diff_similarity.sum().reshape(1) / batch_size # 'mean' reduction
+
+
+def imposter_img_loss(z_image, z_text, y, similarity_function, margin, imposter='neighbor'):
     """
     A custom loss function for computing the hinge difference 
     between the similarity of an image-text pair and 
     the similarity of an imposter image-text pair
     where the image is an imposter image chosen from the batch 
     """
-    loss = torch.zeros(1, device=z_image.device, requires_grad=True)
-    batch_size = z_image.size(0)
-
-    for i in range(batch_size):
-        if similarity_function == 'dot':
-            paired_similarity = torch.dot(z_image[i], z_text[i])
-        if similarity_function == 'cosine':
-            paired_similarity = \
-                torch.dot(z_image[i], z_text[i])/(torch.norm(z_image[i])*torch.norm(z_text[i]))
-        if similarity_function == 'l2':
-            paired_similarity = -1*torch.norm(z_image[i]-z_text[i])
-
-        # Select an imposter image index and 
-        # compute the maximum margin based on the image label difference
-        j = i+1 if i < batch_size - 1 else 0
-
-        # margin = 3 
-        # if y[i].item() == -1 or y[j].item() == -1: # '-1' means unlabeled 
-        #     margin = 0.5
-        # else:
-        #     margin = max(0.5, (y[i] - y[j]).abs().item())
-
-        if similarity_function == 'dot':
-            imposter_similarity = torch.dot(z_image[j], z_text[i])
-        if similarity_function == 'cosine':
-            imposter_similarity = \
-                torch.dot(z_image[j], z_text[i])/(torch.norm(z_image[j])*torch.norm(z_text[i]))
-        if similarity_function == 'l2':
-            imposter_similarity = -1*torch.norm(z_image[j]-z_text[i])
-
-        diff_similarity = imposter_similarity - paired_similarity + margin
-        if diff_similarity > 0:
-            loss = loss + diff_similarity
-
-    return loss / batch_size # 'mean' reduction
-
-def imposter_txt_loss(z_image, z_text, y, similarity_function, margin):
+    # margin = 3 
+    # if y[i].item() == -1 or y[j].item() == -1: # '-1' means unlabeled 
+    #     margin = 0.5
+    # else:
+    #     margin = max(0.5, (y[i] - y[j]).abs().item())
+    return _imposter_loss(z_text, z_image, similarity_function, margin, imposter)
+
+def imposter_txt_loss(z_image, z_text, y, similarity_function, margin, imposter='neighbor'):
     """
     A custom loss function for computing the hinge difference 
     between the similarity of an image-text pair and 
     the similarity of an imposter image-text pair
     where the text is an imposter text chosen from the batch 
     """
-    loss = torch.zeros(1, device=z_image.device, requires_grad=True)
-    batch_size = z_image.size(0)
-
-    for i in range(batch_size):
-        if similarity_function == 'dot':
-            paired_similarity = torch.dot(z_image[i], z_text[i])
-        if similarity_function == 'cosine':
-            paired_similarity = \
-                torch.dot(z_image[i], z_text[i])/(torch.norm(z_image[i])*torch.norm(z_text[i]))
-        if similarity_function == 'l2':
-            paired_similarity = -1*torch.norm(z_image[i]-z_text[i])
-
-        # Select an imposter text index and 
-        # compute the maximum margin based on the image label difference
-        j = i+1 if i < batch_size - 1 else 0
-        # if y[i].item() == -1 or y[j].item() == -1: # '-1' means unlabeled
-        #     margin = 0.5
-        # else:
-        #     margin = max(0.5, (y[i] - y[j]).abs().item())
-
-        if similarity_function == 'dot':
-            imposter_similarity = torch.dot(z_text[j], z_image[i])
-        if similarity_function == 'cosine':
-            imposter_similarity = \
-                torch.dot(z_text[j], z_image[i])/(torch.norm(z_text[j])*torch.norm(z_image[i]))
-        if similarity_function == 'l2':
-            imposter_similarity = -1*torch.norm(z_text[j]-z_image[i])
-
-        diff_similarity = imposter_similarity - paired_similarity + margin
-        if diff_similarity > 0:
-            loss = loss + diff_similarity
-
-    return loss / batch_size # 'mean' reduction
+    return _imposter_loss(z_image, z_text, similarity_function, margin, imposter)
 
 def dot_product_loss(z_image, z_text):
     batch_size = z_image.size(0)
@@ -28,6 +28,7 @@ from efficientnet_pytorch import EfficientNet
 from features_classification.augmentation.augmentation_funcs import torch_aug, albumentations_aug, augmix_aug
 from features_classification.augmentation import custom_transforms
 from features_classification.datasets import cbis_ddsm, cub_200_2011
+from features_classification.datasets.tensor_cache import cache_eval_datasets
 from features_classification.eval.eval_utils import eval_all, evalplot_precision_recall_curve, evalplot_roc_curve, evalplot_confusion_matrix, plot_train_val_loss
 from features_classification.eval.eval_utils import plot_classes_preds, add_pr_curve_tensorboard
 from features_classification.eval.eval_funcs import final_evaluate
@@ -75,6 +76,12 @@ if __name__ == '__main__':
     # Create Training, Validation and Test datasets
     dataset, image_datasets, classes = cbis_ddsm.initialize(options, data_transforms)
 
+    # val/test transforms are deterministic, decode them only once
+    if options.eval_cache != 'none':
+        image_datasets = cache_eval_datasets(image_datasets, backend=options.eval_cache,
+                                             max_megabytes=options.eval_cache_size,
+                                             cache_dir=options.eval_cache_dir)
+
     # Fix random seed
     set_seed()
 
@@ -118,11 +125,13 @@ if __name__ == '__main__':
         'val': torch.utils.data.DataLoader(
             image_datasets['val'], batch_size=batch_size,
             worker_init_fn=np.random.seed(42),
-            shuffle=False, num_workers=options.num_workers),
+            shuffle=False, num_workers=options.num_workers,
+            persistent_workers=options.eval_cache != 'none' and options.num_workers > 0),
         'test': torch.utils.data.DataLoader(
             image_datasets['test'], batch_size=batch_size,
             shuffle=False,
-            worker_init_fn=np.random.seed(42), num_workers=options.num_workers)
+            worker_init_fn=np.random.seed(42), num_workers=options.num_workers,
+            persistent_workers=options.eval_cache != 'none' and options.num_workers > 0)
     }
 
     with torch.no_grad():
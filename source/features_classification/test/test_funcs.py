@@ -2,64 +2,126 @@ import torch
 import numpy as np
 import torch.nn.functional as F
 
-from features_classification.eval.eval_utils import plot_classes_preds
-
-@torch.no_grad()
-def get_all_preds(model, loader, device, writer, multilabel_mode, dataset,
-                  plot_test_images=False, use_clinical_feats=False,
-                  use_clinical_feats_only=False,
-                  parallel_output=False):
-    all_preds = torch.tensor([])
-    all_preds = all_preds.to(device)
-
-    all_labels = torch.tensor([], dtype=torch.long)
-    all_labels = all_labels.to(device)
-
-    all_paths = []
-
-    for idx, data_info in enumerate(loader):
-        images = data_info['image']
-        labels = data_info['label']
-        image_paths = data_info['img_path']
+from concurrent.futures import ThreadPoolExecutor
 
-        images = images.to(device)
-        labels = labels.to(device)
-
-        input_vectors = None
-        if use_clinical_feats or use_clinical_feats_only:
-            input_vectors = data_info['feature_vector'].type(torch.FloatTensor)
-            input_vectors = input_vectors.to(device)
+from features_classification.eval.eval_utils import plot_classes_preds
 
-        if plot_test_images:
-            writer.add_figure(f'test predictions vs. actuals',
-                            plot_classes_preds(model, images, labels,
-                                               num_images=images.shape[0],
-                                               multilabel_mode=multilabel_mode,
-                                               dataset=dataset,
-                                               input_vectors=input_vectors,
-                                               input_vectors_only=use_clinical_feats_only,
-                                               parallel_output=parallel_output),
-                            global_step=idx)
 
+def _plot_batch(writer, outputs, images, labels, idx, multilabel_mode, dataset,
+                input_vectors, use_clinical_feats_only, parallel_output):
+    # outputs were already computed by iter_preds, the "network" just returns them
+    writer.add_figure(f'test predictions vs. actuals',
+                    plot_classes_preds(lambda *inputs: outputs, images, labels,
+                                       num_images=images.shape[0],
+                                       multilabel_mode=multilabel_mode,
+                                       dataset=dataset,
+                                       input_vectors=input_vectors,
+                                       input_vectors_only=use_clinical_feats_only,
+                                       parallel_output=parallel_output),
+                    global_step=idx)
 
-        all_labels = torch.cat((all_labels, labels), dim=0)
 
-        if not (use_clinical_feats or use_clinical_feats_only):
-            preds = model(images)
-        elif use_clinical_feats_only:
-            preds = model(input_vectors)
-        elif use_clinical_feats:
-            preds = model(images, input_vectors)
+@torch.no_grad()
+def iter_preds(model, loader, device, writer, multilabel_mode, dataset,
+               plot_test_images=False, num_plot_batches=8,
+               use_clinical_feats=False, use_clinical_feats_only=False,
+               parallel_output=False):
+    '''Generator version of get_all_preds, yields (preds, labels, image_paths)
+    batch by batch so that the logits of a large dataset never need to be held
+    at once. preds stay on device, labels are returned as loaded.
+
+    When plot_test_images is set, figures are drawn for at most
+    num_plot_batches evenly spaced batches (all batches if None) in a
+    background thread, from the outputs of the same forward pass.
+    '''
+    plot_batches = set()
+    if plot_test_images:
+        num_batches = len(loader)
+        if num_plot_batches is None or num_plot_batches >= num_batches:
+            plot_batches = set(range(num_batches))
+        elif num_plot_batches > 0:
+            plot_batches = set(np.linspace(0, num_batches - 1,
+                                           num_plot_batches).round().astype(int).tolist())
+
+    plotter = ThreadPoolExecutor(max_workers=1) if plot_batches else None
+    plots = []
+
+    try:
+        for idx, data_info in enumerate(loader):
+            images = data_info['image']
+            labels = data_info['label']
+            image_paths = data_info['img_path']
+
+            images = images.to(device, non_blocking=True)
+
+            input_vectors = None
+            if use_clinical_feats or use_clinical_feats_only:
+                input_vectors = data_info['feature_vector'].type(torch.FloatTensor)
+                input_vectors = input_vectors.to(device, non_blocking=True)
+
+            if not (use_clinical_feats or use_clinical_feats_only):
+                outputs = model(images)
+            elif use_clinical_feats_only:
+                outputs = model(input_vectors)
+            elif use_clinical_feats:
+                outputs = model(images, input_vectors)
+
+            if idx in plot_batches:
+                plots.append(plotter.submit(_plot_batch, writer, outputs, images, labels,
+                                            idx, multilabel_mode, dataset, input_vectors,
+                                            use_clinical_feats_only, parallel_output))
+
+            preds = outputs[1] if parallel_output else outputs
+
+            yield preds, labels, image_paths
+    finally:
+        if plotter is not None:
+            for plot in plots:
+                plot.result()
+            plotter.shutdown()
 
-        if parallel_output:
-            preds = preds[1]
 
-        all_preds = torch.cat(
-            (all_preds, preds), dim=0
-        )
+@torch.no_grad()
+def get_all_preds(model, loader, device, writer, multilabel_mode, dataset,
+                  plot_test_images=False, use_clinical_feats=False,
+                  use_clinical_feats_only=False,
+                  parallel_output=False, num_plot_batches=8):
+    '''Logits, labels and image paths of the whole loader.
+
+    The results are written into buffers preallocated from len(loader.dataset)
+    (pinned CPU memory when running on GPU, copied asynchronously) instead of
+    being concatenated batch after batch on the device.
+    '''
+    num_samples = len(loader.dataset)
+    pin_memory = torch.device(device).type == 'cuda'
+
+    all_preds = None
+    all_labels = torch.empty(num_samples, dtype=torch.long, pin_memory=pin_memory)
+    all_paths = []
 
+    start = 0
+    for preds, labels, image_paths in iter_preds(model, loader, device, writer,
+                                                 multilabel_mode, dataset,
+                                                 plot_test_images=plot_test_images,
+                                                 num_plot_batches=num_plot_batches,
+                                                 use_clinical_feats=use_clinical_feats,
+                                                 use_clinical_feats_only=use_clinical_feats_only,
+                                                 parallel_output=parallel_output):
+        if all_preds is None:
+            all_preds = torch.empty((num_samples,) + tuple(preds.shape[1:]),
+                                    dtype=preds.dtype, pin_memory=pin_memory)
+
+        end = start + preds.shape[0]
+        all_preds[start:end].copy_(preds, non_blocking=True)
+        all_labels[start:end].copy_(labels)
         all_paths += image_paths
-            
-    return all_preds, all_labels, all_paths
+        start = end
+
+    if pin_memory:
+        torch.cuda.synchronize()
 
+    if all_preds is None:
+        all_preds = torch.tensor([])
 
+    # loaders with drop_last=True do not fill the whole buffer
+    return all_preds[:start], all_labels[:start], all_paths
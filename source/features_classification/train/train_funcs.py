@@ -3,12 +3,11 @@ import time
 import copy
 import logging
 import torch
-import numpy as np
 import transformers
 import torch.nn.functional as F
 
 from features_classification.models.model_initializer import initialize_model, set_parameter_requires_grad
-from features_classification.eval.eval_funcs import evaluate
+from features_classification.eval.eval_funcs import evaluate, evaluate_preds
 from features_classification.eval.eval_utils import plot_classes_preds
 from features_classification.train.train_utils import compute_classes_weights_within_batch
 
@@ -29,6 +28,17 @@ def train_model(options, model, dataloaders_dict, criterion, optimizer, writer,
     best_eval = 0.0
     best_acc = 0.0
 
+    # Calculate other evaluation metrics (Acc, AP, AUC)
+    if options.criterion in ['ce', 'ce_rank', 'ce_supcon', 'ce_simclr',
+                             'ce_rank_supcon', 'ce_rank_simclr']:
+        _multilabel_mode = False
+    elif options.criterion == 'bce':
+        _multilabel_mode = True
+
+    # models trained with a joint loss return (img_emb, img_logits, vec_emb, vec_logits)
+    parallel_output = options.criterion in ['ce_rank', 'ce_supcon', 'ce_simclr',
+                                            'ce_rank_supcon', 'ce_rank_simclr']
+
     for epoch in range(num_epochs):
         global GLOBAL_EPOCH
         GLOBAL_EPOCH += 1
@@ -49,6 +59,10 @@ def train_model(options, model, dataloaders_dict, criterion, optimizer, writer,
             running_loss = 0.0
             running_corrects = 0
 
+            # logits of the epoch, the metrics are computed from them without another pass
+            epoch_preds = []
+            epoch_labels = []
+
             # Iterate over data.
             for it, data_info in enumerate(dataloaders_dict[phase]):
                 # enumerate is used here to reset data loader
@@ -105,7 +119,8 @@ def train_model(options, model, dataloaders_dict, criterion, optimizer, writer,
                         vec_loss = ce_criterion(vec_logits, labels)
 
                         joint_loss = rank_criterion(img_emb, vec_emb, labels,
-                                                    options.sim_func, options.margin)
+                                                    options.sim_func, options.margin,
+                                                    imposter=options.imposter)
 
                         loss = img_loss + vec_loss + joint_loss
                     elif options.criterion == 'ce_supcon':
@@ -144,7 +159,8 @@ def train_model(options, model, dataloaders_dict, criterion, optimizer, writer,
                         vec_loss = ce_criterion(vec_logits, labels)
 
                         # rank loss
-                        rank_loss = rank_criterion(img_emb, vec_emb, labels)
+                        rank_loss = rank_criterion(img_emb, vec_emb, labels,
+                                                   imposter=options.imposter)
 
                         # supervised contrastive loss
                         img_features = img_emb[:, None, :]
@@ -166,7 +182,8 @@ def train_model(options, model, dataloaders_dict, criterion, optimizer, writer,
                         vec_loss = ce_criterion(vec_logits, labels)
 
                         # rank loss
-                        rank_loss = rank_criterion(img_emb, vec_emb, labels)
+                        rank_loss = rank_criterion(img_emb, vec_emb, labels,
+                                                   imposter=options.imposter)
 
                         # simclr contrastive loss
                         features = torch.cat((img_emb, vec_emb), 1)
@@ -181,7 +198,6 @@ def train_model(options, model, dataloaders_dict, criterion, optimizer, writer,
 
                     if weight_sample and phase == 'train':
                         sample_weight = compute_classes_weights_within_batch(labels)
-                        sample_weight = torch.from_numpy(np.array(sample_weight)).to(device)
                         loss = (loss * sample_weight / sample_weight.sum()).sum()
 
                     # backward + optimize only if in training phase
@@ -193,6 +209,9 @@ def train_model(options, model, dataloaders_dict, criterion, optimizer, writer,
                 # statistics
                 running_loss += loss.item() * inputs.size(0)
 
+                epoch_preds.append((outputs[1] if parallel_output else outputs).detach())
+                epoch_labels.append(labels)
+
 
                 if it == 0:
                     if not (options.use_clinical_feats or options.use_clinical_feats_only):
@@ -237,28 +256,13 @@ def train_model(options, model, dataloaders_dict, criterion, optimizer, writer,
             epoch_loss = running_loss / len(dataloaders_dict[phase].dataset)
             writer.add_scalar(f'{phase} loss', epoch_loss, GLOBAL_EPOCH)
 
-            # Calculate other evaluation metrics (Acc, AP, AUC)
-            if options.criterion in ['ce', 'ce_rank', 'ce_supcon', 'ce_simclr',
-                                     'ce_rank_supcon', 'ce_rank_simclr']:
-                _multilabel_mode = False
-            elif options.criterion == 'bce':
-                _multilabel_mode = True
-
             # Evaluate on train/val set at each epoch
             epoch_acc, epoch_macro_ap, epoch_micro_ap, \
                 epoch_macro_auc, epoch_micro_auc = \
-                    evaluate(model, classes, dataloaders_dict[phase],
-                             device, writer, epoch=GLOBAL_EPOCH,
-                             multilabel_mode=_multilabel_mode,
-                             dataset=dataset, eval_split=phase,
-                             use_clinical_feats=options.use_clinical_feats,
-                             use_clinical_feats_only=options.use_clinical_feats_only,
-                             parallel_output=(options.criterion == 'ce_rank' \
-                                              or options.criterion == 'ce_supcon' \
-                                              or options.criterion == 'ce_rank_supcon' \
-                                              or options.criterion == 'ce_simclr' \
-                                              or options.criterion == 'ce_rank_simclr')
-                             )
+                    evaluate_preds(torch.cat(epoch_preds), torch.cat(epoch_labels),
+                                   classes, writer, epoch=GLOBAL_EPOCH,
+                                   multilabel_mode=_multilabel_mode,
+                                   eval_split=phase)
 
             print('{:>5} Loss: {:.4f} Acc: {:.4f} \
             Macro AP: {:.4f} Micro AP: {:.4f} \
@@ -274,20 +278,6 @@ def train_model(options, model, dataloaders_dict, criterion, optimizer, writer,
                 epoch_macro_ap, epoch_micro_ap,
                 epoch_macro_auc, epoch_micro_auc))
 
-            # Evaluate on test set at each epoch
-            evaluate(model, classes, dataloaders_dict['test'],
-                     device, writer, epoch=GLOBAL_EPOCH,
-                     multilabel_mode=_multilabel_mode,
-                     dataset=dataset, eval_split='test',
-                     use_clinical_feats=options.use_clinical_feats,
-                     use_clinical_feats_only=options.use_clinical_feats_only,
-                     parallel_output=(options.criterion == 'ce_rank' \
-                                      or options.criterion == 'ce_supcon' \
-                                      or options.criterion == 'ce_simclr' \
-                                      or options.criterion == 'ce_rank_supcon' \
-                                      or options.criterion == 'ce_rank_simclr')
-                     )
-
             epoch_info = {
                 'acc': epoch_acc,
                 'macro_ap': epoch_macro_ap,
@@ -322,6 +312,16 @@ def train_model(options, model, dataloaders_dict, criterion, optimizer, writer,
                 train_loss_history.append(epoch_loss)
                 train_acc_history.append(epoch_acc)
 
+        # Evaluate on test set every options.test_every epochs
+        if options.test_every > 0 and GLOBAL_EPOCH % options.test_every == 0:
+            evaluate(model, classes, dataloaders_dict['test'],
+                     device, writer, epoch=GLOBAL_EPOCH,
+                     multilabel_mode=_multilabel_mode,
+                     dataset=dataset, eval_split='test',
+                     use_clinical_feats=options.use_clinical_feats,
+                     use_clinical_feats_only=options.use_clinical_feats_only,
+                     parallel_output=parallel_output)
+
         print()
 
     time_elapsed = time.time() - since
@@ -2,6 +2,7 @@ import numpy as np
 import os
 import glob
 import random
+import time
 import torch
 import matplotlib
 import matplotlib.pyplot as plt
@@ -12,22 +13,31 @@ from torchvision import transforms
 import torch.nn.functional as F
 
 
-def compute_classes_weights(data_root, classes_names, combined_classes_names=None):
+def count_images(image_dir, image_counts=None):
+    '''Number of images of image_dir, taken from image_counts (image dir -> number
+    of images, as listed by the dataset, e.g. from its shard) when given, otherwise
+    globbed on disk'''
+    if image_counts is None:
+        return len(glob.glob(os.path.join(image_dir, '*.png')))
+    return image_counts[image_dir]
+
+
+def compute_classes_weights(data_root, classes_names, combined_classes_names=None,
+                            image_counts=None):
     num_classes = len(classes_names)
 
     weights = np.zeros(num_classes)
 
     for idx, class_name in enumerate(classes_names):
-        weights[idx] = len(
-            glob.glob(os.path.join(data_root, class_name, '*.png')))
+        weights[idx] = count_images(os.path.join(data_root, class_name), image_counts)
 
     if combined_classes_names is not None:
         for combined_class_name in combined_classes_names:
             for label in combined_class_name.split('-'):
                 idx = np.where(classes_names == label)
 
-                weights[idx] += len(
-                    glob.glob(os.path.join(data_root, combined_class_name, '*.png')))
+                weights[idx] += count_images(os.path.join(data_root, combined_class_name),
+                                             image_counts)
 
     total_samples = np.sum(weights)
 
@@ -36,14 +46,14 @@ def compute_classes_weights(data_root, classes_names, combined_classes_names=Non
     return weights
 
 
-def compute_classes_weights_mass_calc(mass_root, calc_root, classes_names):
+def compute_classes_weights_mass_calc(mass_root, calc_root, classes_names, image_counts=None):
     num_classes = len(classes_names)
 
     weights = np.zeros(num_classes)
 
     for idx, class_name in enumerate(classes_names):
-        weights[idx] = len(glob.glob(os.path.join(mass_root, class_name, '*.png')) +
-                           glob.glob(os.path.join(calc_root, class_name, '*.png')))
+        weights[idx] = count_images(os.path.join(mass_root, class_name), image_counts) + \
+            count_images(os.path.join(calc_root, class_name), image_counts)
 
     total_samples = np.sum(weights)
 
@@ -52,7 +62,8 @@ def compute_classes_weights_mass_calc(mass_root, calc_root, classes_names):
     return weights
 
 
-def compute_classes_weights_mass_calc_pathology_4class(mass_root, calc_root, classes_names):
+def compute_classes_weights_mass_calc_pathology_4class(mass_root, calc_root, classes_names,
+                                                      image_counts=None):
     num_classes = len(classes_names)
 
     weights = np.zeros(num_classes)
@@ -61,9 +72,9 @@ def compute_classes_weights_mass_calc_pathology_4class(mass_root, calc_root, cla
         pathology, lesion_type = class_name.split('_')
 
         if lesion_type == 'MASS':
-            weights[idx] = len(glob.glob(os.path.join(mass_root, pathology, '*.png')))
+            weights[idx] = count_images(os.path.join(mass_root, pathology), image_counts)
         elif lesion_type == 'CALC':
-            weights[idx] = len(glob.glob(os.path.join(calc_root, pathology, '*.png')))
+            weights[idx] = count_images(os.path.join(calc_root, pathology), image_counts)
 
     total_samples = np.sum(weights)
 
@@ -76,10 +87,27 @@ def compute_classes_weights_within_batch(batch_labels):
     '''
     Params:
     batch_labels - torch array of label. e.g.: torch([0, 1, 1, 2, 3, 4])
+
+    Returns:
+    float32 tensor of per-sample weights on the device of batch_labels,
+    (1 / class count) * batch size / number of classes in the batch
+
+    torch.unique/bincount have a data-dependent output size and synchronize
+    with the host on GPU, a batch is small enough to compare all pairs instead.
     '''
+    same_class = batch_labels[:, None] == batch_labels[None, :]
+
+    counts = same_class.sum(dim=1).float()
+    # a sample is the first of its class if no earlier sample has the same label
+    num_classes = (~torch.tril(same_class, diagonal=-1).any(dim=1)).sum()
+
+    return (1 / counts) * batch_labels.shape[0] / num_classes
+
+
+def _compute_classes_weights_within_batch_loop(batch_labels):
+    # former per-class loop, kept as the reference of benchmark_classes_weights_within_batch
     classes, counts = torch.unique(batch_labels, return_counts=True)
 
-    batch_weights = torch.zeros(batch_labels.shape[0])
     weights = torch.zeros(classes.shape[0])
 
     classes_map = dict()
@@ -90,35 +118,63 @@ def compute_classes_weights_within_batch(batch_labels):
 
     weights = (1/weights) * batch_labels.shape[0] / classes.shape[0]
 
-    batch_weights = [weights[classes_map[label.item()]] for label in batch_labels]
+    return [weights[classes_map[label.item()]] for label in batch_labels]
 
-    # Log info
-    log_batch_weights = [el.item() for el in batch_weights]
-    log_batch_labels = batch_labels.cpu().numpy().tolist()
 
-    log_info = list(zip(log_batch_labels, log_batch_weights))
+def benchmark_classes_weights_within_batch(batch_size=32, num_classes=4, num_steps=500,
+                                           device=None, seed=42):
+    '''Per-step overhead of the sample weighting done by train_model'''
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-    # print('[+] Compute Classes Weights within Batch')
-    # print('(Label, Weight): Frequency -', Counter(el for el in log_info))
+    generator = torch.Generator().manual_seed(seed)
+    batches = [torch.randint(num_classes, (batch_size,), generator=generator).to(device)
+               for _ in range(num_steps)]
 
-    return batch_weights
+    def _sync():
+        if torch.device(device).type == 'cuda':
+            torch.cuda.synchronize()
 
+    # what train_model used to do with the list of weights
+    _sync()
+    since = time.time()
+    for labels in batches:
+        loop_weights = torch.from_numpy(
+            np.array(_compute_classes_weights_within_batch_loop(labels))).to(device)
+    _sync()
+    loop_latency = (time.time() - since) / num_steps
 
-def compute_classes_weights_mass_calc_pathology_5class(mass_root, calc_root, bg_root, classes_names):
+    since = time.time()
+    for labels in batches:
+        weights = compute_classes_weights_within_batch(labels)
+    _sync()
+    vectorized_latency = (time.time() - since) / num_steps
+
+    assert torch.equal(loop_weights, weights)
+
+    print(f'batch size: {batch_size}, classes: {num_classes}, device: {device}')
+    print(f'per-class loop: {loop_latency * 1e6:.1f} us/step')
+    print(f'vectorized: {vectorized_latency * 1e6:.1f} us/step')
+
+    return loop_latency, vectorized_latency
+
+
+def compute_classes_weights_mass_calc_pathology_5class(mass_root, calc_root, bg_root, classes_names,
+                                                      image_counts=None):
     num_classes = len(classes_names)
 
     weights = np.zeros(num_classes)
 
     for idx, class_name in enumerate(classes_names):
         if class_name == 'BG':
-            weights[idx] = len(glob.glob(os.path.join(bg_root, '*.png')))
+            weights[idx] = count_images(bg_root, image_counts)
         else:
             pathology, lesion_type = class_name.split('_')
 
             if lesion_type == 'MASS':
-                weights[idx] = len(glob.glob(os.path.join(mass_root, pathology, '*.png')))
+                weights[idx] = count_images(os.path.join(mass_root, pathology), image_counts)
             elif lesion_type == 'CALC':
-                weights[idx] = len(glob.glob(os.path.join(calc_root, pathology, '*.png')))
+                weights[idx] = count_images(os.path.join(calc_root, pathology), image_counts)
 
     total_samples = np.sum(weights)
 
@@ -138,3 +194,7 @@ def set_seed(seed=42):
     torch.backends.cudnn.enabled = False
     torch.backends.cudnn.benchmark = False
     torch.backends.cudnn.deterministic = True
+
+
+if __name__ == '__main__':
+    benchmark_classes_weights_within_batch()
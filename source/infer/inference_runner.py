@@ -0,0 +1,146 @@
+import os
+import time
+import collections
+import warnings
+import numpy as np
+import cv2
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+def imread(img_path):
+    img = cv2.imread(img_path, cv2.IMREAD_COLOR)
+    if img is None:
+        raise FileNotFoundError(f'Cannot read {img_path}')
+    return img
+
+
+def run_inference(model, jobs, write_fn, load_fn=imread, batch_size=4, num_workers=4,
+                  max_pending_writes=16, skip_existing=True):
+    '''
+    Run a detector over a list of images with the disk reads/decoding, the
+    forward passes and the writing of the results overlapped:
+    images are decoded ahead on a pool of num_workers threads, batched through
+    the model on the calling thread, and written by a background writer thread.
+
+    Args:
+    model - any callable taking a list of loaded images and returning the list
+            of their results, e.g. functools.partial(inference_detector, model)
+    jobs - list of (img_path, save_path)
+    write_fn - write_fn(img, result, save_path), run on the writer thread
+    load_fn - img_path -> image given to the model (BGR np.ndarray by default)
+    skip_existing - jobs whose save_path already exists are skipped, so an
+                    interrupted run resumes where it stopped
+
+    Returns:
+    number of processed images
+    '''
+    if skip_existing:
+        todo = [(img_path, save_path) for img_path, save_path in jobs
+                if not os.path.exists(save_path)]
+        if len(todo) < len(jobs):
+            warnings.warn(f'{len(jobs) - len(todo)} images have already been processed! Skip!')
+        jobs = todo
+
+    if len(jobs) == 0:
+        return 0
+
+    # decoded images are prefetched up to two batches ahead
+    prefetch = 2 * batch_size
+    loader = ThreadPoolExecutor(max_workers=num_workers)
+    writer = ThreadPoolExecutor(max_workers=1)
+    loads = collections.deque()
+    writes = collections.deque()
+    next_job = 0
+
+    load_time = 0.0
+    model_time = 0.0
+    since = time.time()
+
+    try:
+        for start in range(0, len(jobs), batch_size):
+            batch_jobs = jobs[start:start + batch_size]
+
+            while next_job < len(jobs) and next_job < start + batch_size + prefetch:
+                loads.append(loader.submit(load_fn, jobs[next_job][0]))
+                next_job += 1
+
+            tic = time.time()
+            imgs = [loads.popleft().result() for _ in batch_jobs]
+            load_time += time.time() - tic
+
+            tic = time.time()
+            results = model(imgs)
+            model_time += time.time() - tic
+            if len(results) != len(imgs):
+                raise ValueError(f'The model returned {len(results)} results for {len(imgs)} images')
+
+            for img, result, (_, save_path) in zip(imgs, results, batch_jobs):
+                writes.append(writer.submit(write_fn, img, result, save_path))
+            # bound the memory held by the images waiting to be written
+            while len(writes) > max_pending_writes:
+                writes.popleft().result()
+
+        tic = time.time()
+        while writes:
+            writes.popleft().result()
+        write_wait = time.time() - tic
+    finally:
+        for load in loads:
+            load.cancel()
+        loader.shutdown(wait=True)
+        writer.shutdown(wait=True)
+
+    elapsed = time.time() - since
+    print(f'{len(jobs)} images in {elapsed:.1f}s ({len(jobs) / elapsed:.2f} images/sec), '
+          f'waiting on loading {load_time:.1f}s, model {model_time:.1f}s, '
+          f'final writes {write_wait:.1f}s')
+
+    return len(jobs)
+
+
+def benchmark_inference_runner(num_images=64, img_size=512, batch_size=4, num_workers=4,
+                               forward_time=0.02):
+    '''
+    Serial loop vs run_inference on synthetic images with a stand-in detector
+    (sleeps forward_time per batch and returns one box per image), on CPU
+    '''
+    import tempfile
+
+    def stand_in_detector(imgs):
+        time.sleep(forward_time)
+        return [[np.array([[0, 0, img.shape[1] - 1, img.shape[0] - 1, img.mean() / 255]],
+                          dtype=np.float32)] for img in imgs]
+
+    def write_boxes(img, result, save_path):
+        cv2.imwrite(save_path, img)
+        np.savetxt(save_path + '.txt', np.vstack(result))
+
+    rng = np.random.RandomState(0)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        jobs = []
+        for idx in range(num_images):
+            img_path = os.path.join(tmp_dir, f'{idx}.png')
+            cv2.imwrite(img_path, rng.randint(0, 256, size=(img_size, img_size, 3), dtype=np.uint8))
+            jobs.append((img_path, os.path.join(tmp_dir, f'{idx}_serial.png')))
+
+        since = time.time()
+        for img_path, save_path in jobs:
+            img = imread(img_path)
+            write_boxes(img, stand_in_detector([img])[0], save_path)
+        serial_time = time.time() - since
+        print(f'serial: {num_images / serial_time:.2f} images/sec')
+
+        runner_jobs = [(img_path, save_path.replace('_serial', '_runner'))
+                       for img_path, save_path in jobs]
+        run_inference(stand_in_detector, runner_jobs, write_boxes,
+                      batch_size=batch_size, num_workers=num_workers)
+
+        # same results, and nothing left to do on a second run
+        for (_, serial_path), (_, runner_path) in zip(jobs, runner_jobs):
+            assert np.array_equal(np.loadtxt(serial_path + '.txt'), np.loadtxt(runner_path + '.txt'))
+        assert run_inference(stand_in_detector, runner_jobs, write_boxes) == 0
+
+
+if __name__ == '__main__':
+    benchmark_inference_runner()
@@ -3,12 +3,14 @@ from dataprocessing.process_cbis_ddsm import read_annotation_json
 from utilities.fileio import json
 from config.cfg_loader import proj_paths_json
 from mmdet.apis import init_detector, inference_detector
+from infer.inference_runner import run_inference
 import mmcv
 import os
 import glob
 import numpy as np
 import warnings
 import math
+import functools
 import matplotlib
 matplotlib.use('Agg')
 
@@ -54,28 +56,19 @@ if __name__ == '__main__':
     os.makedirs(save_root_negative, exist_ok=True)
     os.makedirs(save_root_positive, exist_ok=True)
 
-    for patient in mmcv.track_iter_progress(glob.glob(os.path.join(Deidentified_Negative_JPEG, 'Patient*'))):
-        patient_id = os.path.basename(patient)
-        save_path = os.path.join(save_root_negative, patient_id)
-        os.makedirs(save_path, exist_ok=True)
-
-        for mamm in glob.glob(os.path.join(patient, 'Mammoimage', '**', '*.jpg')):
-            mamm_id = os.path.basename(mamm)
-            if os.path.exists(os.path.join(save_path, mamm_id)):
-                continue
-            result = inference_detector(model, mamm)
-            model.show_result(
-                mamm, result, out_file=os.path.join(save_path, mamm_id))
-
-    for patient in mmcv.track_iter_progress(glob.glob(os.path.join(Deidentified_Positive_JPEG, 'Patient*'))):
-        patient_id = os.path.basename(patient)
-        save_path = os.path.join(save_root_positive, patient_id)
-        os.makedirs(save_path, exist_ok=True)
-
-        for mamm in glob.glob(os.path.join(patient, 'Mammoimage', '**', '*.jpg')):
-            mamm_id = os.path.basename(mamm)
-            if os.path.exists(os.path.join(save_path, mamm_id)):
-                continue
-            result = inference_detector(model, mamm)
-            model.show_result(
-                mamm, result, out_file=os.path.join(save_path, mamm_id))
+    jobs = []
+    for data_dir, save_dir in [(Deidentified_Negative_JPEG, save_root_negative),
+                               (Deidentified_Positive_JPEG, save_root_positive)]:
+        for patient in glob.glob(os.path.join(data_dir, 'Patient*')):
+            patient_id = os.path.basename(patient)
+            save_path = os.path.join(save_dir, patient_id)
+            os.makedirs(save_path, exist_ok=True)
+
+            for mamm in glob.glob(os.path.join(patient, 'Mammoimage', '**', '*.jpg')):
+                mamm_id = os.path.basename(mamm)
+                jobs.append((mamm, os.path.join(save_path, mamm_id)))
+
+    # renderings which already exist are skipped
+    run_inference(functools.partial(inference_detector, model), jobs,
+                  lambda img, result, out_file: model.show_result(img, result, out_file=out_file),
+                  load_fn=mmcv.imread, batch_size=4, num_workers=4)
@@ -2,34 +2,50 @@ import mmcv
 import os
 import glob
 import numpy as np
-import warnings
 import math
+import functools
 
 from mmdet.apis import init_detector, inference_detector
 from config.cfg_loader import proj_paths_json
 from utils.fileio import json
 from dataprocessing.process_cbis_ddsm import read_annotation_json
 from evaluation.eval_mmdet_models import get_best_ckpt
+from infer.inference_runner import run_inference
 
 
-def get_predictions(config_file, checkpoint_file, data_root, data_json, save_root):
+def write_detections_txt(bbox_result, categories, save_path):
+    ''' One `<class name> <score> <x1> <y1> <x2> <y2>` line per detected box '''
+    bboxes = np.vstack(bbox_result)  # format: x1, y1, x2, y2, score
+
+    labels = [
+        np.full(bbox.shape[0], i, dtype=np.int32)
+        for i, bbox in enumerate(bbox_result)
+    ]
+    labels = np.concatenate(labels)
+
+    with open(save_path, 'w') as f:
+        for bbox, label in zip(bboxes, labels):
+            x1, y1, x2, y2, s = (str(el) for el in bbox)
+            c = categories[label]
+            f.write(' '.join((c, s, x1, y1, x2, y2, '\n')))
+
+
+def get_predictions(config_file, checkpoint_file, data_root, data_json, save_root,
+                    batch_size=4, num_workers=4):
     model = init_detector(config_file, checkpoint_file, device='cuda:0')
     print(model)
 
     img_annotations, categories = read_annotation_json(
         os.path.join(data_root, data_json))
+    category_names = {el['id']: el['name'] for el in categories}
 
-    for img, anns in mmcv.track_iter_progress(img_annotations):
+    jobs = []
+    for img, anns in img_annotations:
         img_path = os.path.join(data_root, img['file_name'])
         file_name, _ = os.path.splitext(os.path.basename(img['file_name']))
-        save_path = os.path.join(save_root, f"{file_name}.txt")
+        jobs.append((img_path, os.path.join(save_root, f"{file_name}.txt")))
 
-        if os.path.exists(save_path):
-            warnings.warn(f"{save_path} has already existed! Skip!")
-            continue
-
-        result = inference_detector(model, img_path)
-        print('result', result)
+    def write_fn(img, result, save_path):
         if isinstance(result, tuple):
             bbox_result, segm_result = result
             if isinstance(segm_result, tuple):
@@ -37,21 +53,10 @@ def get_predictions(config_file, checkpoint_file, data_root, data_json, save_roo
         else:
             bbox_result, segm_result = result, None
 
-        bboxes = np.vstack(bbox_result)  # format: x1, y1, x2, y2, score
-
-        labels = [
-            np.full(bbox.shape[0], i, dtype=np.int32)
-            for i, bbox in enumerate(bbox_result)
-        ]
-        labels = np.concatenate(labels)
+        write_detections_txt(bbox_result, category_names, save_path)
 
-        with open(save_path, 'w') as f:
-            for bbox, label in zip(bboxes, labels):
-                x1, y1, x2, y2, s = (str(el) for el in bbox)
-                c = [el['name'] for el in categories if el['id'] == label][0]
-                f.write(' '.join((c, s, x1, y1, x2, y2, '\n')))
-
-        break
+    run_inference(functools.partial(inference_detector, model), jobs, write_fn,
+                  load_fn=mmcv.imread, batch_size=batch_size, num_workers=num_workers)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,77 @@
+import os
+import sys
+import unittest
+
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from features_classification.datasets.tensor_cache import Cached_Dataset  # noqa: E402
+
+
+class ToyDataset(Dataset):
+    def __len__(self):
+        return 64
+
+    def __getitem__(self, idx):
+        return {'image': torch.full((3, 16, 16), float(idx)), 'label': idx}
+
+
+class ReportingCache(Cached_Dataset):
+    '''Adds to every sample the cache usage of the process which loaded it'''
+    def __getitem__(self, idx):
+        sample = dict(super().__getitem__(idx))
+        if self.backend == 'disk':
+            num_slots = len(self.free_slots) + len(self.entries)
+            allocated_bytes = num_slots * self.slot_bytes
+        else:
+            allocated_bytes = self.cached_bytes
+        sample['pid'] = os.getpid()
+        sample['cached_bytes'] = self.cached_bytes
+        sample['allocated_bytes'] = allocated_bytes
+        return sample
+
+
+class TestCachedDatasetWorkers(unittest.TestCase):
+
+    sample_bytes = 3 * 16 * 16 * 4
+
+    def _check_cap(self, backend, num_workers=2, max_bytes=20 * 3 * 16 * 16 * 4):
+        dataset = ReportingCache(ToyDataset(), backend=backend, max_bytes=max_bytes)
+        loader = DataLoader(dataset, batch_size=4, shuffle=False, num_workers=num_workers,
+                            persistent_workers=True)
+
+        for epoch in range(2):
+            cached = {}
+            allocated = {}
+            for batch in loader:
+                self.assertTrue(torch.equal(batch['image'][:, 0, 0, 0], batch['label'].float()))
+                for pid, cached_bytes, allocated_bytes in zip(
+                        batch['pid'].tolist(), batch['cached_bytes'].tolist(),
+                        batch['allocated_bytes'].tolist()):
+                    cached[pid] = max(cached.get(pid, 0), cached_bytes)
+                    allocated[pid] = max(allocated.get(pid, 0), allocated_bytes)
+
+            self.assertEqual(len(cached), num_workers)
+            self.assertLessEqual(sum(cached.values()), max_bytes)
+            self.assertLessEqual(sum(allocated.values()), max_bytes)
+            # the cap is used, not only respected
+            self.assertGreater(sum(cached.values()), max_bytes - num_workers * self.sample_bytes)
+
+    def test_ram_cap_with_workers(self):
+        self._check_cap('ram')
+
+    def test_disk_cap_with_workers(self):
+        self._check_cap('disk')
+
+    def test_main_process_gets_whole_cap(self):
+        max_bytes = 10 * self.sample_bytes
+        dataset = Cached_Dataset(ToyDataset(), backend='ram', max_bytes=max_bytes)
+        for idx in range(len(dataset)):
+            dataset[idx]
+        self.assertEqual(dataset.cached_bytes, max_bytes)
+
+
+if __name__ == '__main__':
+    unittest.main()
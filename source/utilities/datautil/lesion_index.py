@@ -0,0 +1,116 @@
+import time
+import numpy as np
+import pandas as pd
+
+
+def parse_roi_id(ROI_ID):
+    '''Split a CBIS-DDSM ROI_ID (e.g. Mass-Training_P_00001_LEFT_CC_1) into
+    the (patient_id, side, view, abnormality_id) key of the annotation csv'''
+    _, _, patient_id, left_or_right, image_view, abnormality_id = ROI_ID.split(
+        '_')
+
+    return ('P_' + patient_id, left_or_right, image_view, int(abnormality_id))
+
+
+def get_info_lesion(df, ROI_ID):
+    patient_id, left_or_right, image_view, abnormality_id = parse_roi_id(ROI_ID)
+
+    rslt_df = df[(df['patient_id'] == patient_id) &
+                 (df['left or right breast'] == left_or_right) &
+                 (df['image view'] == image_view) &
+                 (df['abnormality id'] == abnormality_id)]
+
+    return rslt_df
+
+
+class LesionIndex:
+    '''Prebuilt lookup table over a CBIS-DDSM case description csv.
+
+    Rows are grouped once by (patient_id, side, view, abnormality_id) so that
+    resolving a ROI_ID is a dict lookup instead of four boolean masks over the
+    whole DataFrame. Column values are kept as numpy arrays, hence `get`
+    returns exactly what `get_info_lesion(df, ROI_ID)[column].to_numpy()[0]`
+    used to return.
+    '''
+    def __init__(self, df):
+        self.df = df
+        self.columns = {column: df[column].to_numpy() for column in df.columns}
+
+        self.rows = dict()
+        keys = zip(df['patient_id'], df['left or right breast'],
+                   df['image view'], df['abnormality id'])
+        for pos, (patient_id, left_or_right, image_view, abnormality_id) in enumerate(keys):
+            key = (patient_id, left_or_right, image_view, int(abnormality_id))
+            self.rows.setdefault(key, []).append(pos)
+
+    @classmethod
+    def from_csv(cls, annotation_filepath):
+        return cls(pd.read_csv(annotation_filepath))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, ROI_ID):
+        return parse_roi_id(ROI_ID) in self.rows
+
+    def lookup(self, ROI_ID):
+        '''Same result as get_info_lesion(df, ROI_ID)'''
+        return self.df.iloc[self.rows.get(parse_roi_id(ROI_ID), [])]
+
+    def get(self, ROI_ID, column):
+        '''Value of `column` for the first annotation row of ROI_ID'''
+        pos = self.rows[parse_roi_id(ROI_ID)][0]
+        return self.columns[column][pos]
+
+
+def _synthetic_annotations(num_patients=1500, num_abnormalities=2):
+    records = []
+    for patient in range(num_patients):
+        for side in ['LEFT', 'RIGHT']:
+            for view in ['CC', 'MLO']:
+                for abnormality_id in range(1, num_abnormalities + 1):
+                    records.append({'patient_id': 'P_%05d' % patient,
+                                    'left or right breast': side,
+                                    'image view': view,
+                                    'abnormality id': abnormality_id,
+                                    'pathology': 'BENIGN',
+                                    'mass shape': 'OVAL'})
+    return pd.DataFrame(records)
+
+
+def benchmark_lookup(num_patients=1500, num_queries=2000, seed=42):
+    '''Per-sample latency of get_info_lesion vs. LesionIndex.get'''
+    df = _synthetic_annotations(num_patients)
+    rng = np.random.RandomState(seed)
+    roi_ids = ['Mass-Training_P_%05d_%s_%s_%d' % (rng.randint(num_patients),
+                                                  rng.choice(['LEFT', 'RIGHT']),
+                                                  rng.choice(['CC', 'MLO']),
+                                                  rng.randint(1, 3))
+               for _ in range(num_queries)]
+
+    since = time.time()
+    for ROI_ID in roi_ids:
+        mask_value = get_info_lesion(df, ROI_ID)['mass shape'].to_numpy()[0]
+    mask_latency = (time.time() - since) / num_queries
+
+    since = time.time()
+    lesion_index = LesionIndex(df)
+    build_time = time.time() - since
+
+    since = time.time()
+    for ROI_ID in roi_ids:
+        index_value = lesion_index.get(ROI_ID, 'mass shape')
+    index_latency = (time.time() - since) / num_queries
+
+    assert mask_value == index_value
+
+    print(f'annotation rows: {len(df)}, queries: {num_queries}')
+    print(f'boolean masks: {mask_latency * 1e6:.1f} us/sample')
+    print(f'lesion index: {index_latency * 1e6:.1f} us/sample '
+          f'(built in {build_time * 1e3:.1f} ms)')
+
+    return mask_latency, index_latency
+
+
+if __name__ == '__main__':
+    benchmark_lookup()